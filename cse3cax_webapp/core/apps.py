@@ -7,6 +7,7 @@
 # Author: Jacob Paff
 # Revisions:
 #   - 17-09-24: Initial file created by Jacob Paff. Configured the "core" app with default primary key field.
+#   - 17-10-26: Connect the model signal handlers in ready().
 # 
 
 from django.apps import AppConfig
@@ -15,7 +16,11 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     """
     Core application configuration class for the project.
-    Sets the default auto field for models and assigns the name of the app.
+    Sets the default auto field for models, assigns the name of the app and connects its signal handlers.
     """
     default_auto_field = "django.db.models.BigAutoField"
     name = "core"
+
+    def ready(self):
+        from core import signals  # noqa: F401
+
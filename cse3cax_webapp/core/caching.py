@@ -0,0 +1,190 @@
+#
+# Cache Versioning
+# ================
+# This file defines the version counters used to key cached data. Data cached under the current version
+# of what it was built from (a subject instance, a lecturer's assignments, or all lecturer workloads) is
+# valid until something that changes it bumps that version, after which the old entry is never read again
+# and simply expires. Expensive cached values are read through get_or_rebuild, which lets only one request
+# rebuild a value while the others are served the previous one.
+#
+# The versions live in the 'versions' cache, a Redis cache shared by every process, so a bump made by one
+# worker invalidates what all the others cached without a database query. The cached data itself stays in
+# the default cache.
+#
+# File: caching.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial file created. Added subject instance versions.
+#   - 17-10-26: Added the workload version.
+#   - 17-10-26: Added lecturer versions.
+#   - 17-10-26: Added get_or_rebuild, a single-flight cache read with stale-while-revalidate.
+#   - 17-10-26: Bump instance versions when the transaction commits.
+#   - 17-10-26: Keep the versions in the shared 'versions' cache and bump them to new clock values.
+#   - 17-10-26: Start missing instance versions with one write, and only where the caller asks for it.
+#   - 17-10-26: Added get_or_rebuild_versioned, which also returns the version of the value it serves.
+#   - 17-10-26: Bump the workload version when the transaction commits.
+#
+
+import time
+import uuid
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.utils.connection import ConnectionProxy
+
+INSTANCE_VERSION_KEY = 'instance_version:{}'
+WORKLOAD_VERSION_KEY = 'workload_version'
+LECTURER_VERSION_KEY = 'lecturer_version:{}'
+REBUILD_LOCK_KEY = '{}:rebuilding'
+
+# Cache shared by every process holding the versions
+version_cache = ConnectionProxy(caches, 'versions')
+
+
+def _new_version():
+    # Versions are clock values, so an evicted version is never reused and concurrent bumps never collapse
+    # into the same version the way a non-atomic increment could
+    return time.time_ns()
+
+
+def instance_versions(instance_ids, start=True):
+    """
+    Return {instance_id: version} for the given subject instances.
+
+    With start=True a version is started for every instance that has none, all in one write, so only pass
+    ids of instances known to exist. Otherwise their version is None.
+    """
+    keys = {INSTANCE_VERSION_KEY.format(instance_id): instance_id for instance_id in instance_ids}
+    found = version_cache.get_many(keys)
+    if start:
+        missing = {key: _new_version() for key in keys if key not in found}
+        if missing:
+            # A version started by a concurrent request may be replaced, which only costs it a re-render
+            version_cache.set_many(missing, None)
+            found.update(missing)
+    return {instance_id: found.get(key) for key, instance_id in keys.items()}
+
+
+def instance_version(instance_id, start=True):
+    return instance_versions([instance_id], start)[instance_id]
+
+
+def bump_instance_versions(instance_ids):
+    """
+    Invalidate every fragment cached for the given subject instances once the current transaction commits,
+    so a fragment rendered from the old data is never cached under the new version.
+    """
+    instance_ids = set(instance_ids)
+    if instance_ids:
+        transaction.on_commit(lambda: version_cache.set_many(
+            {INSTANCE_VERSION_KEY.format(instance_id): _new_version() for instance_id in instance_ids}, None
+        ))
+
+
+def workload_version():
+    """
+    Return the current version of all lecturer workloads, starting one if there is none.
+    """
+    version = version_cache.get(WORKLOAD_VERSION_KEY)
+    if version is None:
+        version_cache.add(WORKLOAD_VERSION_KEY, _new_version(), None)
+        version = version_cache.get(WORKLOAD_VERSION_KEY)
+    return version
+
+
+def bump_workload_version():
+    """
+    Invalidate everything cached from lecturer workloads once the current transaction commits, so a report
+    rebuilt from the old workloads is never cached under the new version.
+    """
+    transaction.on_commit(lambda: version_cache.set(WORKLOAD_VERSION_KEY, _new_version(), None))
+
+
+def lecturer_version(user_id):
+    """
+    Return the current version of a lecturer's assignments, starting one if there is none.
+    Lecturer versions are the time of the last change in nanoseconds.
+    """
+    key = LECTURER_VERSION_KEY.format(user_id)
+    version = version_cache.get(key)
+    if version is None:
+        version_cache.add(key, _new_version(), None)
+        version = version_cache.get(key)
+    return version
+
+
+def bump_lecturer_versions(user_ids):
+    """
+    Invalidate everything cached from the given lecturers' assignments once the current transaction commits.
+
+    Bumping only after the commit means a request that reads the new version also reads the new data, so
+    stale data is never cached under the new version.
+    """
+    user_ids = set(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: version_cache.set_many(
+            {LECTURER_VERSION_KEY.format(user_id): _new_version() for user_id in user_ids}, None
+        ))
+
+
+def get_or_rebuild(key, version, rebuild, timeout, stale_timeout=None, wait=5, lock_timeout=60):
+    """
+    Return the value cached under key for the given version, calling rebuild() to build it on a miss.
+    See get_or_rebuild_versioned, which also returns the version the value was built for.
+    """
+    return get_or_rebuild_versioned(key, version, rebuild, timeout, stale_timeout, wait, lock_timeout)[0]
+
+
+def get_or_rebuild_versioned(key, version, rebuild, timeout, stale_timeout=None, wait=5, lock_timeout=60):
+    """
+    Return (value, value's version) for the value cached under key for the given version, calling rebuild()
+    to build it on a miss.
+
+    Only one caller rebuilds a key at a time. While it does, concurrent callers are served the previous
+    value (an older version, or one past its timeout) if there is one, and otherwise wait up to `wait`
+    seconds for the rebuild to finish before rebuilding themselves. The value and the rebuild lock are held
+    in the default cache, so rebuilds are single-flight across every process sharing that backend; the
+    version comes from the shared version cache, so no process serves a value another has invalidated.
+
+    Args:
+        key: Cache key, without the version. The latest value of every version is stored under it.
+        version: Version the value must have been built for, e.g. from lecturer_version.
+        rebuild: Callable returning the new value.
+        timeout: Seconds the value is fresh for.
+        stale_timeout: Further seconds an expired or outdated value may be served while it is rebuilt.
+            Defaults to timeout.
+        wait: Seconds to wait for another caller's rebuild when there is no value to serve.
+        lock_timeout: Seconds after which the rebuild lock is released if its holder never finishes.
+
+    The returned version is older than the one asked for when the previous value is served, so validators
+    such as ETags must be built from it rather than from the current version.
+    """
+    entry = cache.get(key)
+    if _is_fresh(entry, version):
+        return entry['value'], version
+
+    lock_key = REBUILD_LOCK_KEY.format(key)
+    token = uuid.uuid4().hex
+    if not cache.add(lock_key, token, lock_timeout):
+        if entry is not None:
+            return entry['value'], entry['version']
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            entry = cache.get(key)
+            if _is_fresh(entry, version):
+                return entry['value'], version
+        # The rebuild is taking too long, build the value without the lock
+        return rebuild(), version
+
+    try:
+        value = rebuild()
+        cache.set(key, {'version': version, 'value': value, 'expires': time.time() + timeout},
+                  timeout + (timeout if stale_timeout is None else stale_timeout))
+        return value, version
+    finally:
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+
+def _is_fresh(entry, version):
+    return entry is not None and entry['version'] == version and entry['expires'] > time.time()
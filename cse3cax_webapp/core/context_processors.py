@@ -0,0 +1,21 @@
+#
+# Template Context Processors
+# ===========================
+# This file defines the context processors that add project-wide values to every template.
+#
+# File: context_processors.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial file created. Added the change stream path.
+#   - 17-10-26: Only add the change stream path when the stream is enabled.
+#
+
+from django.conf import settings
+
+
+def event_stream(request):
+    """
+    Add the path of the server-sent change stream the manager and admin pages subscribe to, or None if the
+    stream is disabled.
+    """
+    return {'event_stream_path': settings.EVENT_STREAM_PATH if settings.EVENT_STREAM_ENABLED else None}
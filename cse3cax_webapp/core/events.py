@@ -0,0 +1,180 @@
+#
+# Change Events
+# =============
+# This file defines the change events pushed to open manager and admin pages over server-sent events, so
+# every session sees the others' edits without reloading. Model changes publish compact named events
+# (an instance changed, an instance's lecturers changed, a lecturer-month's overload flag changed, a user
+# changed) once their transaction commits. A broadcaster fans them out to every connected client, and the
+# pages refresh only the rows listening for those event names.
+#
+# The default broadcaster only reaches clients connected to the same process. It is loaded from the
+# CHANGE_BROADCASTER setting, so it can be replaced by one backed by an external message bus that
+# implements the same publish/subscribe interface.
+#
+# File: events.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial file created. Added the change broadcaster and the event stream endpoint.
+#   - 17-10-26: Skip publishing when the change stream is disabled.
+#
+
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import threading
+from importlib import import_module
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Roles whose pages subscribe to the change stream
+EVENT_STREAM_ROLES = ('Manager', 'Administrator', 'Testing')
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_INTERVAL = 15
+# Events buffered for a slow client before newer ones are dropped
+SUBSCRIBER_BUFFER = 1000
+
+
+class ChangeBroadcaster:
+    """
+    In-process fan-out of change events to every connected event stream.
+
+    publish(event, data) may be called from any thread. subscribe() is a context manager used by the event
+    stream; it yields an asyncio.Queue on the running loop that receives (event, data) tuples until the
+    context exits. A replacement broadcaster only needs to provide the same two methods.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()  # (loop, queue) pairs
+
+    def publish(self, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, (event, data))
+            except RuntimeError:
+                # The subscriber's loop has closed, it is removed when its stream ends
+                pass
+
+    @staticmethod
+    def _deliver(queue, item):
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logger.warning('Dropped change event %s for a slow event stream client', item[0])
+
+    @contextlib.contextmanager
+    def subscribe(self):
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(maxsize=SUBSCRIBER_BUFFER))
+        with self._lock:
+            self._subscribers.add(subscriber)
+        try:
+            yield subscriber[1]
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+
+broadcaster = import_string(settings.CHANGE_BROADCASTER)()
+
+
+def publish_change(event, **data):
+    """
+    Publish a change event once the current transaction commits (immediately outside a transaction),
+    so clients never refetch a row before the change is visible. Nothing is published when the change stream
+    is disabled.
+    """
+    if settings.EVENT_STREAM_ENABLED:
+        transaction.on_commit(lambda: broadcaster.publish(event, data))
+
+
+def publish_instance_changes(instance_ids, change):
+    """
+    Publish an instance-<id> event for every given subject instance. change is 'instance', 'assignment'
+    or 'deleted'.
+    """
+    for instance_id in set(instance_ids):
+        publish_change(f'instance-{instance_id}', change=change)
+
+
+def publish_overload_changes(changes):
+    """
+    Publish an overload-<user_id>-<month>-<year> event for every ((user_id, month, year), is_overloaded) pair.
+    """
+    for (user_id, month, year), is_overloaded in changes:
+        publish_change(f'overload-{user_id}-{month}-{year}', overloaded=is_overloaded)
+
+
+def publish_user_change(user_id, change):
+    """
+    Publish a user-<id> event. change is 'user' or 'deleted'.
+    """
+    publish_change(f'user-{user_id}', change=change)
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+
+
+@sync_to_async
+def _get_user(scope):
+    """
+    Load the user of the session cookie sent with an ASGI request, the same way the session and
+    authentication middleware would.
+    """
+    from django.contrib.auth import get_user
+    from django.core.handlers.asgi import ASGIRequest
+    request = ASGIRequest(scope, io.BytesIO())
+    session_store = import_module(settings.SESSION_ENGINE).SessionStore
+    request.session = session_store(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+    return get_user(request)
+
+
+async def event_stream(scope, receive, send):
+    """
+    ASGI application serving the change stream as text/event-stream to signed in managers and admins.
+    It runs directly on the event loop instead of through a Django view, so an open stream never holds
+    a worker thread.
+    """
+    user = await _get_user(scope)
+    if not user.is_authenticated or user.role_id not in EVENT_STREAM_ROLES:
+        await send({'type': 'http.response.start', 'status': 403, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'Forbidden'})
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+
+    async def stream(queue):
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+        while True:
+            try:
+                message = format_event(*await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL))
+            except asyncio.TimeoutError:
+                message = b': keep-alive\n\n'
+            await send({'type': 'http.response.body', 'body': message, 'more_body': True})
+
+    with broadcaster.subscribe() as queue:
+        task = asyncio.ensure_future(stream(queue))
+        try:
+            # The stream runs until the client disconnects
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, OSError):
+                await task
@@ -0,0 +1,153 @@
+"""
+Rebuild LecturerWorkload rows in parallel, sharded by month, with the bulk recompute or the workload matrix
+
+Author: Jacob Paff
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from core.models import LecturerWorkload, SubjectInstance, SubjectInstanceLecturer
+from core.workload_matrix import rebuild_month
+
+
+def _init_worker():
+    """
+    Give every worker process its own database connection instead of one inherited from the parent.
+    """
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cse3cax_webapp.settings')
+    django.setup()
+    connections.close_all()
+
+
+def _recompute_shard(month, year, lecturer_ids, engine='recompute'):
+    """
+    Recompute one month and return the number of rows written and the time taken.
+    """
+    started = time.perf_counter()
+    if engine == 'matrix':
+        workloads = rebuild_month(month, year)
+    else:
+        workloads = LecturerWorkload.objects.recompute(lecturers=lecturer_ids, months=[(month, year)], refresh=False)
+    return len(workloads), time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    """
+    This command rebuilds every LecturerWorkload row, or a subset of them, after bulk imports and rule changes.
+    The work is sharded by month and spread across a process pool, printing the throughput of every shard.
+    Only PostgreSQL takes concurrent writers, so on any other database the shards are recomputed one at a time
+    in this process. A failing shard is reported and the others still run; the command fails at the end.
+
+    Author: Jacob Paff
+    """
+    help = 'Rebuild LecturerWorkload rows in parallel, sharded by month.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, action='append', dest='years',
+                            help='Only recompute months in this year (may be repeated).')
+        parser.add_argument('--lecturer', type=int, action='append', dest='lecturers',
+                            help='Only recompute this lecturer user id (may be repeated).')
+        parser.add_argument('--dirty', action='store_true',
+                            help='Only recompute rows flagged as dirty by the workload queue.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes (PostgreSQL only, other databases run serially).')
+        parser.add_argument('--engine', choices=['recompute', 'matrix'], default='recompute',
+                            help='Recompute each month with WorkloadManager.recompute or rebuild it from the '
+                                 'vectorised workload matrix.')
+
+    def collect_shards(self, years=None, lecturers=None, dirty=False):
+        """
+        Return {(month, year): lecturer ids or None} for every month that needs recomputing.
+        """
+        workloads = LecturerWorkload.objects.all()
+        if years:
+            workloads = workloads.filter(year__in=years)
+        if lecturers:
+            workloads = workloads.filter(user_profile_id__in=lecturers)
+
+        if dirty:
+            shards = {}
+            for user_id, month, year in workloads.filter(is_dirty=True).values_list('user_profile_id', 'month', 'year'):
+                shards.setdefault((month, year), set()).add(user_id)
+            return shards
+
+        instances = SubjectInstance.objects.filter(start_date__isnull=False)
+        if years:
+            instances = instances.filter(start_date__year__in=years)
+        if lecturers:
+            instances = instances.filter(
+                instance_id__in=SubjectInstanceLecturer.objects.filter(user_id__in=lecturers).values('subject_instance_id')
+            )
+        months = set(instances.values_list('start_date__month', 'start_date__year').distinct())
+        months |= set(workloads.values_list('month', 'year').distinct())
+        return {month_key: set(lecturers) if lecturers else None for month_key in months}
+
+    def handle(self, *args, **options):
+        if options['engine'] == 'matrix' and (options['lecturers'] or options['dirty']):
+            raise CommandError('--engine=matrix rebuilds whole months and cannot be combined with --lecturer or --dirty.')
+        shards = self.collect_shards(options['years'], options['lecturers'], options['dirty'])
+        if not shards:
+            self.stdout.write('Nothing to recompute.')
+            return
+
+        workers = max(1, min(options['workers'], len(shards)))
+        if connection.vendor != 'postgresql':
+            workers = 1
+        self.stdout.write(f'Recomputing {len(shards)} month(s) with {workers} worker(s)...')
+        started = time.perf_counter()
+        total_rows = 0
+        failed = []
+        ordered_shards = sorted(shards.items(), key=lambda item: (item[0][1], item[0][0]))
+
+        for (month, year), outcome in self.run_shards(ordered_shards, workers, options['engine']):
+            if isinstance(outcome, Exception):
+                failed.append((month, year))
+                self.stderr.write(self.style.ERROR(f'  {month:02d}/{year}: failed: {outcome!r}'))
+                continue
+            rows, seconds = outcome
+            total_rows += rows
+            rate = rows / seconds if seconds > 0 else 0
+            self.stdout.write(f'  {month:02d}/{year}: {rows} row(s) in {seconds:.3f}s ({rate:.0f} rows/s)')
+
+        # The caches built from workloads are invalidated once for the whole run, for whatever completed
+        if len(failed) < len(shards):
+            LecturerWorkload.objects.workloads_changed()
+
+        elapsed = time.perf_counter() - started
+        rate = total_rows / elapsed if elapsed > 0 else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Recomputed {total_rows} row(s) across {len(shards) - len(failed)} month(s) in {elapsed:.2f}s ({rate:.0f} rows/s).'
+        ))
+        if failed:
+            raise CommandError(
+                f'{len(failed)} month(s) failed: ' + ', '.join(f'{month:02d}/{year}' for month, year in failed)
+                + '. Run the command again for those years to retry them.'
+            )
+
+    def run_shards(self, shards, workers, engine):
+        """
+        Recompute the shards and yield ((month, year), (rows, seconds) or the exception raised) as they finish.
+        """
+        if workers == 1:
+            for (month, year), shard_lecturers in shards:
+                try:
+                    yield (month, year), _recompute_shard(month, year, shard_lecturers, engine)
+                except Exception as error:
+                    yield (month, year), error
+            return
+
+        # Never share the parent's connection with forked workers
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = {
+                pool.submit(_recompute_shard, month, year, shard_lecturers, engine): (month, year)
+                for (month, year), shard_lecturers in shards
+            }
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as error:
+                    yield futures[future], error
@@ -11,12 +11,37 @@
 #   - 17-09-24: Initial models created by Jacob Paff.
 #   - 18-09-24: Added workload calculation methods in WorkloadManager and LecturerWorkload models.
 #   - 07-10-24: Updated methods to manage lecturer workloads when adding/removing users from SubjectInstance.
+#   - 17-10-26: Added set-based bulk workload recomputation (WorkloadManager.recompute).
+#   - 17-10-26: Added delta-based workload maintenance when a lecturer is added to or removed from an instance.
+#   - 17-10-26: Added LecturerWorkloadSnapshot, a per-lecturer read-optimised window of workloads.
+#   - 17-10-26: Added LecturerWeeklyLoad, a weekly load vector per lecturer spanning each full 12-week instance.
+#   - 17-10-26: Added deferred workload recalculation through the background workload queue.
+#   - 17-10-26: Added is_dirty tracking for queued lecturer-months.
+#   - 17-10-26: Added SubjectInstance.search_document, a denormalised search column over subject and lecturer names.
+#   - 17-10-26: Bump the cached workload version whenever workloads are written.
+#   - 17-10-26: Added SubjectInstance.objects.bulk_update_enrollments.
+#   - 17-10-26: Serialise workload writers per lecturer-month with advisory locks and lock instances while changing lecturers.
+#   - 17-10-26: Publish overload flag and enrollment changes to the change stream.
+#   - 17-10-26: Lecturer changes always apply the workload delta instead of queueing a recompute.
+#   - 17-10-26: Removed LecturerWorkloadSnapshot, which no read path used any more.
+#   - 17-10-26: Removed LecturerWeeklyLoad, which no read path used any more.
+#   - 17-10-26: Deferred deletes return the workload queue's ticket, and the queue runs one worker on SQLite.
+#   - 17-10-26: Workload writers bump the versions of instances whose lecturers' overload flags changed.
+#   - 17-10-26: Read the workload queue's worker count at enqueue time and skip deleted lecturers in recompute.
+#   - 17-10-26: Find the instances behind changed overload flags with IN filters instead of one OR term per key.
+#   - 17-10-26: The workload delta checks overloads with UserProfile.calc_max_workload like recompute.
 #
 
+from datetime import timedelta
 from decimal import Decimal
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Q
 from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
+from core.caching import bump_instance_versions, bump_workload_version
+from core.events import publish_instance_changes, publish_overload_changes
+from core.workload_queue import WorkloadRecalculationQueue
 
 class UserProfileManager(BaseUserManager):
     """
@@ -82,17 +107,23 @@ class UserProfile(AbstractBaseUser):
             workload_percent = 0
         return round(workload_percent, 2)
 
-    def delete_user(self):
+    def delete_user(self, defer=False):
         """
         Delete a user profile and update lecturer workloads if necessary.
+        With defer=True the co-lecturers' workloads are recalculated by the background workload queue and the
+        queue's ticket is returned.
         """
         subject_instances = []
         if self.role.role_id == 'Lecturer':
-            subject_instances = SubjectInstance.objects.filter(lecturer=self)
+            subject_instances = list(SubjectInstance.objects.filter(lecturer=self))
         self.delete()
-        if subject_instances:
-            for subject_instance in subject_instances:
-                subject_instance.update_lecturer_workload()
+        if defer:
+            return workload_queue.enqueue(
+                key for subject_instance in subject_instances for key in subject_instance.workload_keys()
+            )
+        for subject_instance in subject_instances:
+            subject_instance.update_lecturer_workload()
+        return None
 
     class Meta:
         db_table = 'user_profile'
@@ -126,32 +157,267 @@ class WorkloadManager(models.Manager):
             return (students_count - self.STUDENT_THRESHOLD) * self.WORKLOAD_PER_STUDENT
         return 0
 
+    def calculate_instance_workload(self, students_count, lecturers_count):
+        """
+        Calculate the workload a single subject instance contributes to each of its lecturers.
+        """
+        base_workload = self.WORKLOAD_PER_SUBJECT
+        additional_workload = self.calculate_additional_workload(students_count)
+        return (base_workload + additional_workload) * self.calculate_effective_workload(lecturers_count)
+
+    def assignment_shares(self, assignments):
+        """
+        Return (user_id, start_date, workload) for each SubjectInstanceLecturer in the queryset,
+        using one aggregated query for the lecturer count of every instance.
+        """
+        assignments = assignments.annotate(
+            lecturers_count=Count('subject_instance__subjectinstancelecturer')
+        ).values_list(
+            'user_id', 'subject_instance__start_date', 'subject_instance__enrollments', 'lecturers_count'
+        )
+        return [
+            (user_id, start_date, self.calculate_instance_workload(enrollments or 0, lecturers_count))
+            for user_id, start_date, enrollments, lecturers_count in assignments
+        ]
+
+    def workloads_changed(self):
+        """
+        Invalidate everything cached from lecturer workloads. Every workload writer ends here.
+        """
+        bump_workload_version()
+
+    def overloads_changed(self, changes):
+        """
+        Publish ((lecturer_id, month, year), is_overloaded) overload flag changes to the change stream and bump
+        the versions of the subject instances those lecturers teach in those months. Bulk writes send no
+        signals, so every workload writer calls this with the flags it changed.
+        """
+        changes = list(changes)
+        if not changes:
+            return
+        publish_overload_changes(changes)
+        # A rule or FTE change can touch many keys, so the query stays a fixed size and exact keys are matched here
+        keys = {key for key, _ in changes}
+        assignments = SubjectInstanceLecturer.objects.filter(
+            user_id__in={user_id for user_id, _, _ in keys},
+            subject_instance__start_date__year__in={year for _, _, year in keys},
+        ).values_list('subject_instance_id', 'user_id', 'subject_instance__start_date')
+        bump_instance_versions(
+            instance_id for instance_id, user_id, start_date in assignments
+            if (user_id, start_date.month, start_date.year) in keys
+        )
+
     def update_workload(self, user_profile: UserProfile, month: int, year: int):
         """
         Update workload for a user based on their subject assignments in a given month and year.
         """
-        subject_instances = SubjectInstance.objects.filter(
-            lecturer=user_profile,
-            start_date__year=year,
-            start_date__month=month
+        return self.recompute(lecturers=[user_profile], months=[(month, year)])[0]
+
+    def lock_workloads(self, keys):
+        """
+        Serialise writers of the given (lecturer_id, month, year) keys until the current transaction ends.
+
+        On Postgres a transaction-scoped advisory lock is taken for every key in one statement, always in
+        sorted order so concurrent writers queue behind each other instead of deadlocking. Other databases
+        (the LOCAL_DB SQLite file) already serialise all writes.
+        """
+        if connection.vendor != 'postgresql' or not keys:
+            return
+        keys = sorted({(user_id, year * 12 + month - 1) for user_id, month, year in keys})
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_xact_lock(k.user_id, k.month_index) '
+                'FROM unnest(%s::integer[], %s::integer[]) AS k(user_id, month_index) '
+                'ORDER BY k.user_id, k.month_index',
+                [[user_id for user_id, _ in keys], [month_index for _, month_index in keys]],
+            )
+
+    def mark_dirty(self, keys):
+        """
+        Flag (lecturer_id, month, year) keys as waiting for recalculation, creating rows where needed.
+        """
+        self.bulk_create(
+            [LecturerWorkload(user_profile_id=user_id, month=month, year=year, workload_value=0, is_dirty=True)
+             for user_id, month, year in sorted(set(keys))],
+            update_conflicts=True,
+            unique_fields=['user_profile', 'month', 'year'],
+            update_fields=['is_dirty'],
         )
-        total_workload = 0
-        for subject_instance in subject_instances:
-            lecturers_count = subject_instance.lecturer.count()
-            students_count = subject_instance.enrollments or 0
-            base_workload = self.WORKLOAD_PER_SUBJECT
-            additional_workload = self.calculate_additional_workload(students_count)
-            effective_workload = (base_workload + additional_workload) * self.calculate_effective_workload(lecturers_count)
-            total_workload += effective_workload
-
-        workload, created = LecturerWorkload.objects.get_or_create(
-            user_profile=user_profile,
-            month=month,
-            year=year,
+
+    def overloaded_keys(self, keys):
+        """
+        Return the (lecturer_id, month, year) keys that are overloaded, looked up in one query.
+        """
+        keys = set(keys)
+        if not keys:
+            return set()
+        rows = self.filter(
+            is_overloaded=True,
+            user_profile_id__in={user_id for user_id, _, _ in keys},
+            year__in={year for _, _, year in keys},
+        ).values_list('user_profile_id', 'month', 'year')
+        return keys & set(rows)
+
+    def recompute(self, lecturers=None, months=None, refresh=True, keys=None):
+        """
+        Recompute workloads for many lecturer-months at once.
+
+        Lecturer counts and enrollments for every affected assignment are gathered in one aggregated
+        query, the workload values and overload flags are calculated in Python and every affected
+        row is written with a single bulk upsert, all while the lecturer-months are locked.
+
+        Args:
+            lecturers: UserProfile instances or user ids to recompute. Defaults to every lecturer
+                with an assignment or an existing workload row in the given months.
+            months: (month, year) pairs to recompute. Defaults to every month the lecturers
+                have an assignment or an existing workload row in.
+            refresh: Whether to invalidate the caches built from workloads afterwards.
+            keys: Exact (lecturer_id, month, year) keys to recompute, instead of lecturers and months.
+
+        Returns:
+            list[LecturerWorkload]: The recomputed workload rows.
+        """
+        if keys is not None:
+            keys = set(keys)
+            lecturers = {user_id for user_id, _, _ in keys}
+            months = {(month, year) for _, month, year in keys}
+        lecturer_ids = None if lecturers is None else {getattr(lecturer, 'pk', lecturer) for lecturer in lecturers}
+        months = None if months is None else set(months)
+        if lecturer_ids == set() or months == set():
+            return []
+
+        assignments = SubjectInstanceLecturer.objects.all()
+        existing = LecturerWorkload.objects.all()
+        if lecturer_ids is not None:
+            assignments = assignments.filter(user_id__in=lecturer_ids)
+            existing = existing.filter(user_profile_id__in=lecturer_ids)
+        if months is not None:
+            month_filter = Q()
+            workload_filter = Q()
+            for month, year in months:
+                month_filter |= Q(subject_instance__start_date__month=month, subject_instance__start_date__year=year)
+                workload_filter |= Q(month=month, year=year)
+            assignments = assignments.filter(month_filter)
+            existing = existing.filter(workload_filter)
+        if keys is None and lecturer_ids is not None and months is not None:
+            keys = {(user_id, month, year) for user_id in lecturer_ids for month, year in months}
+
+        with transaction.atomic():
+            # Assignments are read under the locks, so a concurrent writer can never overwrite a newer total
+            self.lock_workloads(keys)
+            totals = self._assignment_totals(assignments)
+            previous = {
+                (user_id, month, year): is_overloaded
+                for user_id, month, year, is_overloaded in existing.values_list('user_profile_id', 'month', 'year', 'is_overloaded')
+            }
+            if keys is None:
+                # Existing rows with no remaining assignments must be reset to zero
+                keys = set(totals) | set(previous)
+                self.lock_workloads(keys)
+                totals = self._assignment_totals(assignments)
+            if not keys:
+                return []
+
+            users = UserProfile.objects.only('user_id', 'fte_percentage').in_bulk({key[0] for key in keys})
+            workloads = []
+            for user_id, month, year in sorted(keys):
+                if user_id not in users:
+                    continue  # Deleted since the key was queued, its rows went with it
+                total_workload = totals.get((user_id, month, year), 0)
+                workloads.append(LecturerWorkload(
+                    user_profile=users[user_id],
+                    month=month,
+                    year=year,
+                    workload_value=total_workload,
+                    is_overloaded=total_workload > users[user_id].calc_max_workload(),
+                    is_dirty=False,
+                ))
+
+            LecturerWorkload.objects.bulk_create(
+                workloads,
+                update_conflicts=True,
+                unique_fields=['user_profile', 'month', 'year'],
+                update_fields=['workload_value', 'is_overloaded', 'is_dirty'],
+            )
+            self.overloads_changed(
+                ((workload.user_profile_id, workload.month, workload.year), workload.is_overloaded)
+                for workload in workloads
+                if workload.is_overloaded != previous.get((workload.user_profile_id, workload.month, workload.year), False)
+            )
+        if refresh:
+            self.workloads_changed()
+        return workloads
+
+    def _assignment_totals(self, assignments):
+        totals = {}
+        for user_id, start_date, workload in self.assignment_shares(assignments):
+            key = (user_id, start_date.month, start_date.year)
+            totals[key] = totals.get(key, 0) + workload
+        return totals
+
+
+    def apply_lecturer_change(self, subject_instance, user_profile, added=True):
+        """
+        Incrementally update workloads after a lecturer is added to or removed from a subject instance.
+
+        Only this instance's share changes, so the old and new per-lecturer contribution are
+        calculated and the difference is applied to the affected rows with atomic F() updates.
+        The number of queries depends only on the lecturers of this instance, not on how many
+        other instances they teach in the month. Callers must hold the instance's row lock (see
+        SubjectInstance.lock) so its lecturer list cannot change underneath the calculation.
+
+        Returns:
+            bool: True if any affected lecturer is now overloaded.
+        """
+        month = subject_instance.start_date.month
+        year = subject_instance.start_date.year
+        co_lecturer_ids = list(
+            SubjectInstanceLecturer.objects.filter(subject_instance=subject_instance)
+            .exclude(user=user_profile)
+            .values_list('user_id', flat=True)
         )
-        workload.workload_value = total_workload
-        workload.save()
-        return workload
+        students_count = subject_instance.enrollments or 0
+        without_share = self.calculate_instance_workload(students_count, len(co_lecturer_ids))
+        with_share = self.calculate_instance_workload(students_count, len(co_lecturer_ids) + 1)
+        if added:
+            co_lecturer_delta = with_share - without_share
+            lecturer_delta = with_share
+        else:
+            co_lecturer_delta = without_share - with_share
+            lecturer_delta = -with_share
+
+        affected_ids = co_lecturer_ids + [user_profile.pk]
+        with transaction.atomic():
+            self.lock_workloads((user_id, month, year) for user_id in affected_ids)
+            # Make sure every affected lecturer-month has a row to apply the difference to
+            LecturerWorkload.objects.bulk_create(
+                [LecturerWorkload(user_profile_id=user_id, month=month, year=year, workload_value=0) for user_id in affected_ids],
+                ignore_conflicts=True,
+            )
+            workloads = LecturerWorkload.objects.filter(month=month, year=year)
+            if co_lecturer_ids:
+                workloads.filter(user_profile_id__in=co_lecturer_ids).update(
+                    workload_value=F('workload_value') + co_lecturer_delta
+                )
+            workloads.filter(user_profile=user_profile).update(workload_value=F('workload_value') + lecturer_delta)
+
+            # Refresh the overload flags of the affected rows
+            overloaded_ids = set()
+            changed_flags = []
+            for user_id, workload_value, fte_percentage, was_overloaded in workloads.filter(user_profile_id__in=affected_ids).values_list(
+                'user_profile_id', 'workload_value', 'user_profile__fte_percentage', 'is_overloaded'
+            ):
+                # Read with the workload row, so the lecturer is rebuilt here instead of loaded separately
+                if workload_value > UserProfile(user_id=user_id, fte_percentage=fte_percentage).calc_max_workload():
+                    overloaded_ids.add(user_id)
+                if (user_id in overloaded_ids) != was_overloaded:
+                    changed_flags.append(((user_id, month, year), not was_overloaded))
+            workloads.filter(user_profile_id__in=affected_ids).exclude(user_profile_id__in=overloaded_ids).update(is_overloaded=False)
+            if overloaded_ids:
+                workloads.filter(user_profile_id__in=overloaded_ids).update(is_overloaded=True)
+            self.overloads_changed(changed_flags)
+        self.workloads_changed()
+        return bool(overloaded_ids)
 
 
 class LecturerWorkload(models.Model):
@@ -161,8 +427,9 @@ class LecturerWorkload(models.Model):
     user_profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='workloads')
     month = models.IntegerField()  # Month (1-12)
     year = models.IntegerField()   # Year
-    workload_value = models.IntegerField(blank=True, null=True)
+    workload_value = models.FloatField(blank=True, null=True)
     is_overloaded = models.BooleanField(default=False)
+    is_dirty = models.BooleanField(default=False)  # Queued for recalculation but not yet recomputed
 
     objects = WorkloadManager()
 
@@ -216,6 +483,98 @@ class LecturerExpertise(models.Model):
         return f"{self.user.first_name} {self.user.last_name} - {self.subject.subject_name}"
 
 
+class SubjectInstanceManager(models.Manager):
+    """
+    Manager for maintaining the search documents of subject instances and bulk enrollment updates.
+    """
+
+    def lock(self, instance_ids):
+        """
+        Lock the given subject instances until the current transaction ends, in id order so that
+        transactions locking overlapping instances queue up instead of deadlocking.
+
+        SQLite has no row locks, so there a no-op update takes the database write lock up front,
+        making concurrent writers wait for it rather than fail when they upgrade from reading.
+        """
+        instances = self.filter(instance_id__in=instance_ids)
+        if connection.features.has_select_for_update:
+            list(instances.select_for_update().order_by('instance_id').values_list('instance_id', flat=True))
+        else:
+            instances.update(enrollments=F('enrollments'))
+
+    def bulk_update_enrollments(self, enrollments):
+        """
+        Apply many enrollment figures at once and recompute the affected workloads.
+
+        The changed instances are written with one bulk_update. Workloads only depend on enrollments above
+        STUDENT_THRESHOLD, so an instance that stays at or below it on both sides is not recomputed. Every
+        affected lecturer-month is recomputed exactly once, and the read models are refreshed once at the end.
+
+        Args:
+            enrollments: Mapping of instance_id to its new enrollment count.
+
+        Returns:
+            tuple: (number of instances updated, number of lecturer-months recomputed)
+        """
+        threshold = WorkloadManager.STUDENT_THRESHOLD
+        changed = []
+        recompute_ids = []
+        with transaction.atomic():
+            # Lock the instances so their enrollments and lecturers cannot change while the batch is applied
+            self.lock(enrollments)
+            for subject_instance in self.filter(instance_id__in=enrollments).only('instance_id', 'start_date', 'enrollments'):
+                new_enrollments = enrollments[subject_instance.instance_id]
+                current_enrollments = subject_instance.enrollments or 0
+                if new_enrollments == current_enrollments:
+                    continue
+                subject_instance.enrollments = new_enrollments
+                changed.append(subject_instance)
+                if subject_instance.start_date and (current_enrollments > threshold or new_enrollments > threshold):
+                    recompute_ids.append(subject_instance.instance_id)
+
+            # Every lecturer of an instance whose workload changed, in the month the instance starts in
+            keys = {
+                (user_id, start_date.month, start_date.year)
+                for user_id, start_date in SubjectInstanceLecturer.objects.filter(
+                    subject_instance_id__in=recompute_ids
+                ).values_list('user_id', 'subject_instance__start_date')
+            }
+
+            self.bulk_update(changed, ['enrollments'], batch_size=500)
+            LecturerWorkload.objects.recompute(keys=keys)
+
+        # bulk_update sends no signals, so the cached rows of the changed instances are invalidated here
+        bump_instance_versions(subject_instance.instance_id for subject_instance in changed)
+        publish_instance_changes((subject_instance.instance_id for subject_instance in changed), 'instance')
+        return len(changed), len(keys)
+
+    def refresh_search_documents(self, instance_ids=None):
+        """
+        Rebuild the search documents of the given subject instances (all instances when no ids are given).
+
+        A document is the lowercased subject id, subject name and the names of every assigned lecturer, so a
+        search only has to match one indexed column instead of joining subjects and lecturers.
+        """
+        instances = self.all() if instance_ids is None else self.filter(instance_id__in=instance_ids)
+        rows = list(instances.values_list('instance_id', 'subject__subject_id', 'subject__subject_name', 'search_document'))
+        if not rows:
+            return 0
+
+        names = {}
+        for instance_id, first_name, last_name in SubjectInstanceLecturer.objects.filter(
+            subject_instance_id__in=[row[0] for row in rows]
+        ).order_by('id').values_list('subject_instance_id', 'user__first_name', 'user__last_name'):
+            names.setdefault(instance_id, []).extend([first_name, last_name])
+
+        changed = []
+        for instance_id, subject_id, subject_name, document in rows:
+            new_document = ' '.join(part for part in [subject_id, subject_name, *names.get(instance_id, [])] if part).lower()
+            if new_document != document:
+                changed.append(SubjectInstance(instance_id=instance_id, search_document=new_document))
+        self.bulk_update(changed, ['search_document'], batch_size=500)
+        return len(changed)
+
+
 class SubjectInstance(models.Model):
     """
     Represents an instance of a subject in the system, including lecturer assignments and enrollments.
@@ -225,6 +584,13 @@ class SubjectInstance(models.Model):
     lecturer = models.ManyToManyField(UserProfile, related_name='subject_instances', blank=True, through='SubjectInstanceLecturer')
     start_date = models.DateField(blank=True, null=True)
     enrollments = models.IntegerField(blank=True, default=0)
+    # Lowercased subject and lecturer names, kept current by the signal handlers in core/signals.py
+    search_document = models.TextField(blank=True, default='', editable=False)
+
+    objects = SubjectInstanceManager()
+
+    # An instance runs for 12 weeks, finishing on the Friday of its last week
+    DURATION = timedelta(weeks=12) - timedelta(days=2)
 
     class Meta:
         db_table = 'subject_instance'
@@ -232,28 +598,79 @@ class SubjectInstance(models.Model):
     def __str__(self):
         return f"{self.subject.subject_id} - {self.start_date.month}/{self.start_date.year}"
 
+    @property
+    def end_date(self):
+        return self.start_date + self.DURATION
+
+    def active_months(self):
+        """
+        Return the (month, year) pairs this instance runs in, from its start month to its end month.
+        """
+        end_date = self.end_date
+        month, year = self.start_date.month, self.start_date.year
+        months = [(month, year)]
+        while (year, month) < (end_date.year, end_date.month):
+            month, year = (1, year + 1) if month == 12 else (month + 1, year)
+            months.append((month, year))
+        return months
+
+    def workload_keys(self, extra_lecturers=()):
+        """
+        Return the (lecturer_id, month, year) workload keys that depend on this subject instance.
+        """
+        lecturer_ids = set(SubjectInstanceLecturer.objects.filter(subject_instance=self).values_list('user_id', flat=True))
+        lecturer_ids |= {getattr(lecturer, 'pk', lecturer) for lecturer in extra_lecturers}
+        return {(lecturer_id, self.start_date.month, self.start_date.year) for lecturer_id in lecturer_ids}
 
-    def delete_and_update_workload(self):
+    def delete_and_update_workload(self, defer=False):
         """
         Delete this subject instance and update workloads for associated lecturers.
+        With defer=True the workloads are recalculated by the background workload queue and the queue's ticket
+        is returned.
         """
-        self.update_lecturer_workload()
+        keys = self.workload_keys()
         self.delete()
+        if defer:
+            return workload_queue.enqueue(keys)
+        LecturerWorkload.objects.recompute(keys=keys)
+        return None
+
+    def lock(self):
+        """
+        Lock this instance's row until the current transaction ends, so concurrent lecturer changes
+        on the same instance are applied one after another.
+        """
+        SubjectInstance.objects.lock([self.instance_id])
+        # Work from the locked row, not from a copy loaded before another manager changed it
+        self.refresh_from_db(fields=['start_date', 'enrollments'])
 
     def add_lecturer(self, user_profile):
         """
-        Add a lecturer to this subject instance and update workloads.
+        Add a lecturer to this subject instance and incrementally update workloads.
         """
-        SubjectInstanceLecturer.objects.create(subject_instance=self, user=user_profile)
-        exceeded_workload_lecturers = self.update_lecturer_workload()
+        with transaction.atomic():
+            self.lock()
+            _, created = SubjectInstanceLecturer.objects.get_or_create(subject_instance=self, user=user_profile)
+            if not created:
+                return LecturerWorkload.objects.filter(
+                    user_profile__in=self.lecturer.all(),
+                    month=self.start_date.month,
+                    year=self.start_date.year,
+                    is_overloaded=True
+                ).exists()
+            exceeded_workload_lecturers = LecturerWorkload.objects.apply_lecturer_change(self, user_profile, added=True)
         return exceeded_workload_lecturers
 
     def remove_lecturer(self, user_profile):
         """
-        Remove a lecturer from this subject instance and update workloads.
+        Remove a lecturer from this subject instance and incrementally update workloads.
         """
-        SubjectInstanceLecturer.objects.filter(subject_instance=self, user=user_profile).delete()
-        exceeded_workload_lecturers = self.update_lecturer_workload(user_profile)
+        with transaction.atomic():
+            self.lock()
+            deleted, _ = SubjectInstanceLecturer.objects.filter(subject_instance=self, user=user_profile).delete()
+            if not deleted:
+                return False
+            exceeded_workload_lecturers = LecturerWorkload.objects.apply_lecturer_change(self, user_profile, added=False)
         return exceeded_workload_lecturers
 
     def update_enrollments(self, new_enrollment_count):
@@ -273,21 +690,14 @@ class SubjectInstance(models.Model):
         month = self.start_date.month
         year = self.start_date.year
         exceeded_workload_lecturers = False
-        # exceeded_workload_lecturers = set() 
         lecturers = list(self.lecturer.all())
         if removed_lecturer:
             lecturers.append(removed_lecturer)
-        for lecturer in lecturers:
-            workload = LecturerWorkload.objects.update_workload(lecturer, month, year)
-            max_workload = lecturer.calc_max_workload()
-            # Determine if the lecturer is overloaded and update the is_overloaded field
-            is_overloaded = workload.workload_value > max_workload
-            workload.is_overloaded = is_overloaded
-            workload.save()
-
-            if is_overloaded:
+        workloads = LecturerWorkload.objects.recompute(lecturers=lecturers, months=[(month, year)])
+        for workload in workloads:
+            # Determine if the lecturer is overloaded
+            if workload.is_overloaded:
                 exceeded_workload_lecturers = True
-                # exceeded_workload_lecturers.add(lecturer)
         return exceeded_workload_lecturers
 
 
@@ -300,3 +710,24 @@ class SubjectInstanceLecturer(models.Model):
 
     class Meta:
         db_table = 'subject_instance_lecturer'
+        constraints = [
+            # A lecturer is linked to an instance at most once, even when two managers add them at the same time
+            models.UniqueConstraint(fields=['subject_instance', 'user'], name='unique_subject_instance_lecturer'),
+        ]
+
+
+def workload_queue_workers():
+    """
+    Number of workload queue workers, read from settings.WORKLOAD_QUEUE_WORKERS at every enqueue. SQLite
+    (LOCAL_DB) allows one writer at a time, so extra workers there would only fail to get the lock.
+    """
+    workers = getattr(settings, 'WORKLOAD_QUEUE_WORKERS', 2)
+    return workers if connection.vendor == 'postgresql' else min(workers, 1)
+
+
+# Background queue used by views to recalculate workloads without blocking the response
+workload_queue = WorkloadRecalculationQueue(
+    lambda lecturer_ids, months: LecturerWorkload.objects.recompute(lecturers=lecturer_ids, months=months),
+    max_workers=workload_queue_workers,
+    mark_dirty=lambda keys: LecturerWorkload.objects.mark_dirty(keys),
+)
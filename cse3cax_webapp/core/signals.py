@@ -0,0 +1,128 @@
+#
+# Model Signal Handlers
+# =====================
+# This file connects the model signals that keep denormalised data current. Any save or delete that
+# changes what a subject instance displays (its subject, dates, lecturers or their workloads) bumps the
+# cache version of the affected instances, and changes to subject or lecturer names rebuild the search
+# documents of the affected instances. Changes to an instance, its subject or its lecturers also bump the
+# versions of the affected lecturers, behind each lecturer's cached roster. Lecturer renames bump the workload
+# version behind the cached workload reports; workload writes are bulk updates that send no signals, so the
+# workload writers bump the workload and instance versions themselves. The same changes are published to
+# the change stream so open pages refresh the affected rows. After migrations the search index is created
+# on Postgres.
+#
+# File: signals.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial file created. Bump subject instance cache versions.
+#   - 17-10-26: Keep subject instance search documents current and create the trigram search index.
+#   - 17-10-26: Bump the workload version on workload saves and lecturer renames.
+#   - 17-10-26: Publish instance, assignment and user changes to the change stream.
+#   - 17-10-26: Bump the versions of lecturers whose rosters change.
+#   - 17-10-26: Removed the LecturerWorkload receiver, which bulk workload writes never triggered.
+#   - 17-10-26: Only refresh what shows a lecturer's name when the name actually changes.
+#   - 17-10-26: Create the shared version cache table after migrations.
+#   - 17-10-26: Removed the version cache table, the versions moved to Redis.
+#
+
+from django.db import connection
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
+from django.dispatch import receiver
+from core.caching import bump_instance_versions, bump_lecturer_versions, bump_workload_version
+from core.events import publish_instance_changes, publish_user_change
+from core.models import Subject, SubjectInstance, SubjectInstanceLecturer, UserProfile
+
+# UserProfile fields shown in the user list rows, and the name fields shown with subject instances and workloads
+USER_ROW_FIELDS = {'first_name', 'last_name', 'role'}
+NAME_FIELDS = {'first_name', 'last_name'}
+
+
+@receiver([post_save, post_delete], sender=SubjectInstance)
+def subject_instance_changed(sender, instance, **kwargs):
+    bump_instance_versions([instance.instance_id])
+    if kwargs['signal'] is post_save:
+        SubjectInstance.objects.refresh_search_documents([instance.instance_id])
+        publish_instance_changes([instance.instance_id], 'instance')
+        if not kwargs['created']:
+            # Deleting an instance deletes its assignments, which bump their lecturers themselves
+            bump_lecturer_versions(SubjectInstanceLecturer.objects.filter(
+                subject_instance_id=instance.instance_id
+            ).values_list('user_id', flat=True))
+    else:
+        publish_instance_changes([instance.instance_id], 'deleted')
+
+
+@receiver([post_save, post_delete], sender=SubjectInstanceLecturer)
+def subject_instance_lecturer_changed(sender, instance, **kwargs):
+    bump_instance_versions([instance.subject_instance_id])
+    SubjectInstance.objects.refresh_search_documents([instance.subject_instance_id])
+    publish_instance_changes([instance.subject_instance_id], 'assignment')
+    bump_lecturer_versions([instance.user_id])
+
+
+@receiver(pre_save, sender=UserProfile)
+def user_profile_saving(sender, instance, update_fields=None, **kwargs):
+    # Compare the names with the stored ones, so saves that only touch other fields (last_login from login(),
+    # a role change) skip the work done for renamed lecturers
+    instance._names_changed = False
+    if instance._state.adding or (update_fields is not None and not NAME_FIELDS & set(update_fields)):
+        return
+    stored_names = UserProfile.objects.filter(pk=instance.pk).values_list('first_name', 'last_name').first()
+    instance._names_changed = stored_names != (instance.first_name, instance.last_name)
+
+
+@receiver(post_save, sender=UserProfile)
+def user_profile_changed(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is None or USER_ROW_FIELDS & update_fields:
+        publish_user_change(instance.user_id, 'user')
+    if not created and getattr(instance, '_names_changed', False):
+        # Lecturer names are shown in the cached workload reports
+        bump_workload_version()
+        instance_ids = list(SubjectInstanceLecturer.objects.filter(
+            user_id=instance.user_id
+        ).values_list('subject_instance_id', flat=True))
+        bump_instance_versions(instance_ids)
+        if instance_ids:
+            SubjectInstance.objects.refresh_search_documents(instance_ids)
+            publish_instance_changes(instance_ids, 'instance')
+
+
+@receiver(post_delete, sender=UserProfile)
+def user_profile_deleted(sender, instance, **kwargs):
+    publish_user_change(instance.user_id, 'deleted')
+
+
+@receiver(post_save, sender=Subject)
+def subject_changed(sender, instance, created, **kwargs):
+    if not created:
+        instance_ids = list(SubjectInstance.objects.filter(
+            subject_id=instance.subject_id
+        ).values_list('instance_id', flat=True))
+        bump_instance_versions(instance_ids)
+        if instance_ids:
+            SubjectInstance.objects.refresh_search_documents(instance_ids)
+            publish_instance_changes(instance_ids, 'instance')
+            bump_lecturer_versions(SubjectInstanceLecturer.objects.filter(
+                subject_instance_id__in=instance_ids
+            ).values_list('user_id', flat=True))
+
+
+@receiver(post_migrate)
+def create_search_index(sender, app_config=None, **kwargs):
+    """
+    Create the trigram index behind subject instance searches on Postgres and fill in missing search documents.
+    Other databases (the LOCAL_DB SQLite file) search the same column without the index.
+    """
+    if app_config is None or app_config.name != 'core':
+        return
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS subject_instance_search_trgm '
+                'ON subject_instance USING gin (search_document gin_trgm_ops)'
+            )
+    SubjectInstance.objects.refresh_search_documents(
+        SubjectInstance.objects.filter(search_document='').values_list('instance_id', flat=True)
+    )
+
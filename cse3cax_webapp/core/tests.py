@@ -1,3 +1,568 @@
-from django.test import TestCase
+#
+# Tests for the Core Models
+# =========================
+# This file tests the workload calculations kept in LecturerWorkload. WorkloadTestCase sets up a small roster
+# of lecturers, subjects and subject instances shared by the manager and lecturer tests.
+#
+# File: tests.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial tests for the bulk workload recompute.
+#   - 17-10-26: Added tests for the workload delta applied when a lecturer is added or removed.
+#   - 17-10-26: Added tests for the workload matrix and the matrix rebuild.
+#   - 17-10-26: Added tests for the workload recalculation queue and the workload status endpoint.
+#   - 17-10-26: Added tests for the recompute_workloads command.
+#   - 17-10-26: Added tests for the cache versions bumped by workload writers.
+#   - 17-10-26: Added tests for the user profile save signals.
+#   - 17-10-26: Added tests for the shared cache versions.
+#   - 17-10-26: Check the version cache keeps every version.
+#   - 17-10-26: Added tests for single-flight cache rebuilds.
+#   - 17-10-26: Run the workload queue synchronously in tests and check keys are only queued on commit.
+#   - 17-10-26: Clear the in-memory version cache between tests, and test starting missing instance versions.
+#   - 17-10-26: Check the version returned with a previous value served during a rebuild.
+#   - 17-10-26: Check the workload version is only bumped once the workload write commits.
+#   - 17-10-26: Check overload flag changes over many lecturer-months bump only the matching instances.
+#   - 17-10-26: Check the workload delta and recompute share the overload threshold.
+#
 
-# Create your tests here.
+import random
+import threading
+from datetime import date
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.core.cache import cache, caches
+from core.caching import (
+    REBUILD_LOCK_KEY, bump_lecturer_versions, get_or_rebuild, get_or_rebuild_versioned, instance_version, instance_versions,
+    lecturer_version, workload_version,
+)
+from core.workload_queue import TicketStatus, WorkloadRecalculationQueue
+from core.workload_matrix import build_workload_matrix, rebuild_workloads
+from core.models import (
+    LecturerExpertise, LecturerWorkload, Role, Subject, SubjectInstance, SubjectInstanceLecturer, UserProfile,
+)
+
+
+# Queue workers use their own connections, which never see the data of a test's transaction
+@override_settings(WORKLOAD_QUEUE_WORKERS=0)
+class WorkloadTestCase(TestCase):
+    """
+    Three lecturers at 100%, 50% and 20% FTE with expertise in CS1 (only the first in CS2), a manager and
+    three subject instances, two in November 2024 and one in February 2025. The workload queue runs
+    synchronously.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lecturer_role = Role.objects.create(role_id='Lecturer')
+        cls.manager_role = Role.objects.create(role_id='Manager')
+        cls.intro = Subject.objects.create(subject_id='CS1', subject_name='Intro')
+        cls.algorithms = Subject.objects.create(subject_id='CS2', subject_name='Algorithms')
+        cls.ann = UserProfile.objects.create_user('ann@test.edu', cls.lecturer_role, first_name='Ann', last_name='Archer', fte_percentage=1.0)
+        cls.bob = UserProfile.objects.create_user('bob@test.edu', cls.lecturer_role, first_name='Bob', last_name='Baker', fte_percentage=0.5)
+        cls.cat = UserProfile.objects.create_user('cat@test.edu', cls.lecturer_role, first_name='Cat', last_name='Carter', fte_percentage=0.2)
+        cls.manager = UserProfile.objects.create_user('man@test.edu', cls.manager_role, first_name='Mia', last_name='Manager', fte_percentage=1.0)
+        for lecturer in (cls.ann, cls.bob, cls.cat):
+            LecturerExpertise.objects.create(subject=cls.intro, user=lecturer)
+        LecturerExpertise.objects.create(subject=cls.algorithms, user=cls.ann)
+        cls.november = SubjectInstance.objects.create(subject=cls.intro, start_date=date(2024, 11, 4), enrollments=30)
+        cls.november_small = SubjectInstance.objects.create(subject=cls.algorithms, start_date=date(2024, 11, 18), enrollments=5)
+        cls.february = SubjectInstance.objects.create(subject=cls.intro, start_date=date(2025, 2, 3), enrollments=50)
+        cls.lecturers = (cls.ann, cls.bob, cls.cat)
+        cls.months = [(11, 2024), (2, 2025)]
+
+    def setUp(self):
+        # Cached values and versions outlive the rolled back data of the previous test, whose ids are reused
+        cache.clear()
+        caches['versions'].clear()
+
+    def expected_workload(self, user, month, year):
+        """
+        Workload of a lecturer-month calculated from scratch, one instance at a time.
+        """
+        workload_manager = LecturerWorkload.objects
+        total = 0
+        for subject_instance in SubjectInstance.objects.filter(lecturer=user, start_date__month=month, start_date__year=year):
+            total += workload_manager.calculate_instance_workload(subject_instance.enrollments or 0, subject_instance.lecturer.count())
+        return total
+
+    def assertWorkloadsCorrect(self):
+        """
+        Check every stored workload row of the test lecturers against a calculation from scratch.
+        """
+        for lecturer in self.lecturers:
+            for month, year in self.months:
+                workload = LecturerWorkload.objects.filter(user_profile=lecturer, month=month, year=year).first()
+                expected = self.expected_workload(lecturer, month, year)
+                if workload is None:
+                    self.assertEqual(expected, 0)
+                    continue
+                self.assertAlmostEqual(workload.workload_value, expected, places=6)
+                self.assertEqual(workload.is_overloaded, expected > lecturer.calc_max_workload())
+
+
+class RecomputeTests(WorkloadTestCase):
+
+    def assign(self, *pairs):
+        for subject_instance, lecturer in pairs:
+            SubjectInstanceLecturer.objects.create(subject_instance=subject_instance, user=lecturer)
+
+    def test_recompute_matches_calculation_from_scratch(self):
+        self.assign((self.november, self.ann), (self.november, self.bob), (self.november_small, self.ann), (self.february, self.cat))
+        workloads = LecturerWorkload.objects.recompute(lecturers=self.lecturers, months=self.months)
+        self.assertEqual(len(workloads), 6)
+        self.assertWorkloadsCorrect()
+        self.assertTrue(LecturerWorkload.objects.get(user_profile=self.cat, month=2, year=2025).is_overloaded)
+
+    def test_recompute_reads_every_assignment_in_one_query(self):
+        self.assign((self.november, self.ann), (self.november, self.bob), (self.february, self.cat))
+        with self.assertNumQueries(7):  # savepoint, assignments, existing rows, lecturers, upsert, newly overloaded instances, release
+            LecturerWorkload.objects.recompute(lecturers=self.lecturers, months=self.months, refresh=False)
+
+    def test_recompute_everything_resets_rows_without_assignments(self):
+        self.assign((self.february, self.cat))
+        LecturerWorkload.objects.recompute()
+        SubjectInstanceLecturer.objects.filter(user=self.cat).delete()
+        LecturerWorkload.objects.recompute()
+        workload = LecturerWorkload.objects.get(user_profile=self.cat, month=2, year=2025)
+        self.assertEqual(workload.workload_value, 0)
+        self.assertFalse(workload.is_overloaded)
+
+    def test_recompute_skips_lecturers_deleted_since_their_keys_were_queued(self):
+        self.assign((self.november, self.ann))
+        workloads = LecturerWorkload.objects.recompute(keys={(self.ann.user_id, 11, 2024), (0, 11, 2024)})
+        self.assertEqual([workload.user_profile_id for workload in workloads], [self.ann.user_id])
+
+    def test_recompute_exact_keys_only_writes_those_keys(self):
+        self.assign((self.november, self.ann), (self.november, self.bob))
+        LecturerWorkload.objects.recompute(keys={(self.ann.user_id, 11, 2024)})
+        self.assertEqual(
+            list(LecturerWorkload.objects.values_list('user_profile_id', 'month', 'year')),
+            [(self.ann.user_id, 11, 2024)],
+        )
+
+
+class LecturerChangeDeltaTests(WorkloadTestCase):
+
+    def test_delta_matches_calculation_from_scratch(self):
+        rng = random.Random(1)
+        for _ in range(60):
+            subject_instance = rng.choice([self.november, self.november_small, self.february])
+            lecturer = rng.choice(self.lecturers)
+            if rng.random() < 0.6:
+                subject_instance.add_lecturer(lecturer)
+            else:
+                subject_instance.remove_lecturer(lecturer)
+            self.assertWorkloadsCorrect()
+
+    def test_delta_reports_overloaded_lecturers(self):
+        self.assertFalse(self.november.add_lecturer(self.ann))
+        self.assertTrue(self.february.add_lecturer(self.cat))
+        self.assertFalse(self.february.remove_lecturer(self.cat))
+        self.assertEqual(LecturerWorkload.objects.get(user_profile=self.cat, month=2, year=2025).workload_value, 0)
+
+    def test_delta_and_recompute_share_the_overload_threshold(self):
+        with mock.patch.object(UserProfile, 'calc_max_workload', return_value=50):
+            self.assertTrue(self.november.add_lecturer(self.ann))
+            self.assertTrue(LecturerWorkload.objects.get(user_profile=self.ann, month=11, year=2024).is_overloaded)
+            self.assertTrue(LecturerWorkload.objects.update_workload(self.ann, 11, 2024).is_overloaded)
+
+    def test_delta_queries_do_not_grow_with_the_month(self):
+        self.november.add_lecturer(self.ann)
+        self.november_small.add_lecturer(self.ann)
+        with CaptureQueriesContext(connection) as few_instances:
+            self.november.add_lecturer(self.bob)
+        self.november.remove_lecturer(self.bob)
+        for _ in range(3):
+            SubjectInstance.objects.create(subject=self.intro, start_date=date(2024, 11, 11), enrollments=0).add_lecturer(self.ann)
+        with CaptureQueriesContext(connection) as many_instances:
+            self.november.add_lecturer(self.bob)
+        self.assertEqual(len(many_instances), len(few_instances))
+
+
+class WorkloadMatrixTests(WorkloadTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.november.add_lecturer(self.ann)
+        self.november.add_lecturer(self.bob)
+        self.november_small.add_lecturer(self.ann)
+        self.february.add_lecturer(self.cat)
+        self.february.add_lecturer(self.ann)
+
+    def test_matrix_matches_calculation_from_scratch(self):
+        matrix = build_workload_matrix()
+        for row, user_id in enumerate(matrix.lecturer_ids.tolist()):
+            lecturer = UserProfile.objects.get(pk=user_id)
+            for month, year in matrix.months():
+                self.assertAlmostEqual(matrix.values[row, matrix.column(month, year)], self.expected_workload(lecturer, month, year))
+        self.assertEqual(build_workload_matrix(years=[2025]).values.shape[1], 12)
+        self.assertEqual(build_workload_matrix(years=[2030]).values.shape[1], 0)
+
+    def test_rebuild_restores_corrupted_workloads(self):
+        LecturerWorkload.objects.update(workload_value=999, is_overloaded=True)
+        LecturerWorkload.objects.create(user_profile=self.bob, month=3, year=2025, workload_value=50)
+        rebuild_workloads()
+        self.assertWorkloadsCorrect()
+        self.assertEqual(LecturerWorkload.objects.get(user_profile=self.bob, month=3, year=2025).workload_value, 0)
+
+
+class WorkloadQueueTests(SimpleTestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.failures = 0
+        self.release = threading.Event()
+        self.release.set()
+        self.overloaded_ids = set()
+
+    def handler(self, lecturer_ids, months):
+        self.release.wait(5)
+        self.calls.append((set(lecturer_ids), list(months)))
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('database is locked')
+        (month, year), = months
+        return [
+            SimpleNamespace(user_profile_id=lecturer_id, month=month, year=year, is_overloaded=lecturer_id in self.overloaded_ids)
+            for lecturer_id in lecturer_ids
+        ]
+
+    def wait_for(self, queue, *tickets):
+        for _ in range(500):
+            if all(queue.status(ticket).done for ticket in tickets):
+                return
+            threading.Event().wait(0.01)
+        self.fail('Workload queue did not settle')
+
+    def test_keys_queued_while_a_month_runs_are_coalesced(self):
+        queue = WorkloadRecalculationQueue(self.handler, max_workers=2)
+        self.release.clear()
+        first = queue.enqueue({(1, 11, 2024)})
+        second = queue.enqueue({(2, 11, 2024)})
+        third = queue.enqueue({(3, 11, 2024)})
+        self.assertFalse(queue.status(second).done)
+        self.release.set()
+        self.wait_for(queue, first, second, third)
+        self.assertEqual(self.calls, [({1}, [(11, 2024)]), ({2, 3}, [(11, 2024)])])
+
+    def test_failed_recalculations_are_retried(self):
+        queue = WorkloadRecalculationQueue(self.handler, max_workers=1, retry_delay=0)
+        self.failures = 2
+        with self.assertLogs('core.workload_queue', 'WARNING'):
+            ticket = queue.enqueue({(1, 11, 2024)})
+            self.wait_for(queue, ticket)
+        self.assertEqual(len(self.calls), 3)
+        self.assertFalse(queue.status(ticket).failed)
+
+    def test_recalculations_failing_every_attempt_are_reported_and_stay_dirty(self):
+        dirty = set()
+        queue = WorkloadRecalculationQueue(self.handler, max_workers=1, mark_dirty=dirty.update, retry_delay=0)
+        self.failures = 3
+        with self.assertLogs('core.workload_queue', 'ERROR'):
+            ticket = queue.enqueue({(1, 11, 2024)})
+            self.wait_for(queue, ticket)
+        self.assertTrue(queue.status(ticket).failed)
+        self.assertEqual(dirty, {(1, 11, 2024)})
+
+    def test_overloads_are_reported_to_the_ticket_that_queued_them(self):
+        queue = WorkloadRecalculationQueue(self.handler, max_workers=1)
+        self.overloaded_ids = {2}
+        self.release.clear()
+        quiet = queue.enqueue({(1, 11, 2024)})
+        overloading = queue.enqueue({(2, 11, 2024)})
+        also_quiet = queue.enqueue({(3, 11, 2024)})
+        self.release.set()
+        self.wait_for(queue, quiet, overloading, also_quiet)
+        self.assertEqual([queue.status(ticket).overloaded for ticket in (quiet, overloading, also_quiet)], [False, True, False])
+
+    def test_worker_count_is_read_at_every_enqueue(self):
+        workers = mock.Mock(return_value=0)
+        queue = WorkloadRecalculationQueue(self.handler, max_workers=workers)
+        queue.enqueue({(1, 11, 2024)})
+        self.assertEqual(len(self.calls), 1)
+        workers.return_value = 1
+        self.release.clear()
+        ticket = queue.enqueue({(2, 11, 2024)})
+        self.assertFalse(queue.status(ticket).done)
+        self.release.set()
+        self.wait_for(queue, ticket)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_without_workers_keys_are_recalculated_immediately(self):
+        queue = WorkloadRecalculationQueue(self.handler, max_workers=0)
+        self.overloaded_ids = {1}
+        self.assertIsNone(queue.enqueue(set()))
+        ticket = queue.enqueue({(1, 11, 2024), (1, 2, 2025)})
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(queue.status(ticket), TicketStatus(done=True, overloaded=True, failed=False))
+        self.assertIsNone(queue.status('unknown'))
+
+
+class WorkloadQueueCommitTests(TestCase):
+
+    def test_keys_reach_the_workers_only_once_the_transaction_commits(self):
+        calls = []
+        dirty = set()
+        queue = WorkloadRecalculationQueue(lambda lecturer_ids, months: calls.append(lecturer_ids) or [], max_workers=1,
+                                           mark_dirty=dirty.update)
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                ticket = queue.enqueue({(1, 11, 2024)})
+        self.assertEqual(dirty, {(1, 11, 2024)})
+        self.assertEqual(calls, [])
+        self.assertFalse(queue.status(ticket).done)
+        for callback in callbacks:
+            callback()
+        for _ in range(500):
+            if queue.status(ticket).done:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(calls, [{1}])
+
+
+class WorkloadStatusViewTests(WorkloadTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.manager)
+
+    def get_status(self, ticket):
+        return self.client.get(reverse('workload_status'), {'ticket': ticket})
+
+    def test_pending_ticket_answers_at_once_and_polls_again(self):
+        with mock.patch('core.views.workload_queue.status', return_value=TicketStatus(False, False, False)):
+            response = self.get_status('abc')
+        self.assertContains(response, 'ticket=abc')
+        self.assertContains(response, 'hx-trigger="load delay:1s"')
+
+    def test_settled_ticket_opens_the_overloaded_lecturers_modal_only_if_it_overloaded_a_lecturer(self):
+        with mock.patch('core.views.workload_queue.status', return_value=TicketStatus(True, True, False)):
+            response = self.get_status('abc')
+        self.assertContains(response, reverse('overloaded_lecturers'))
+        self.assertNotContains(response, 'ticket=')
+        response = self.get_status('unknown')
+        self.assertNotContains(response, 'hx-get')
+
+
+class RecomputeWorkloadsCommandTests(WorkloadTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.november.add_lecturer(self.ann)
+        self.november.add_lecturer(self.bob)
+        self.february.add_lecturer(self.cat)
+        LecturerWorkload.objects.update(workload_value=999, is_overloaded=True)
+
+    def test_runs_serially_outside_postgresql(self):
+        for engine in ('recompute', 'matrix'):
+            with self.subTest(engine=engine):
+                stdout = StringIO()
+                call_command('recompute_workloads', workers=8, engine=engine, stdout=stdout)
+                self.assertIn('with 1 worker(s)', stdout.getvalue())
+                self.assertWorkloadsCorrect()
+
+    def test_failed_shards_are_reported_and_the_others_still_recomputed(self):
+        recompute = LecturerWorkload.objects.recompute
+
+        def fail_november(lecturers=None, months=None, **kwargs):
+            if (11, 2024) in months:
+                raise RuntimeError('database is locked')
+            return recompute(lecturers=lecturers, months=months, **kwargs)
+
+        stderr = StringIO()
+        with mock.patch.object(LecturerWorkload.objects, 'recompute', side_effect=fail_november):
+            with self.assertRaisesMessage(CommandError, '1 month(s) failed: 11/2024'):
+                call_command('recompute_workloads', stdout=StringIO(), stderr=stderr)
+        self.assertIn('11/2024: failed', stderr.getvalue())
+        self.assertNotEqual(LecturerWorkload.objects.get(user_profile=self.cat, month=2, year=2025).workload_value, 999)
+        self.assertEqual(LecturerWorkload.objects.get(user_profile=self.ann, month=11, year=2024).workload_value, 999)
+
+
+class WorkloadCacheVersionTests(WorkloadTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.february.add_lecturer(self.ann)
+
+    def assertBumped(self, change, instances, unchanged=()):
+        ids = [subject_instance.instance_id for subject_instance in (*instances, *unchanged)]
+        before_versions, before_workload = instance_versions(ids), workload_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        after_versions = instance_versions(ids)
+        self.assertNotEqual(workload_version(), before_workload)
+        for subject_instance in instances:
+            self.assertNotEqual(after_versions[subject_instance.instance_id], before_versions[subject_instance.instance_id])
+        for subject_instance in unchanged:
+            self.assertEqual(after_versions[subject_instance.instance_id], before_versions[subject_instance.instance_id])
+
+    def test_overloading_a_lecturer_bumps_the_instances_of_that_month(self):
+        self.assertBumped(lambda: self.february.add_lecturer(self.cat), [self.february])
+
+    def test_workload_version_is_bumped_once_an_outer_transaction_commits(self):
+        version = workload_version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                SubjectInstance.objects.bulk_update_enrollments({self.february.instance_id: 80})
+                # A report rebuilt before the commit reads the old workloads, so it must not get a new version
+                self.assertEqual(workload_version(), version)
+        self.assertEqual(workload_version(), version)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(workload_version(), version)
+
+    def test_many_overload_flag_changes_bump_only_the_matching_instances(self):
+        self.november.add_lecturer(self.ann)
+        # Thousands of keys, which one OR term per key would turn into an expression too deep for SQLite
+        changes = [((self.ann.user_id, month, year), True) for year in range(1000, 2024) for month in range(1, 13)]
+        changes.append(((self.ann.user_id, 11, 2024), True))
+        ids = [self.november.instance_id, self.february.instance_id]
+        before = instance_versions(ids)
+        with self.captureOnCommitCallbacks(execute=True):
+            LecturerWorkload.objects.overloads_changed(changes)
+        after = instance_versions(ids)
+        self.assertNotEqual(after[self.november.instance_id], before[self.november.instance_id])
+        self.assertEqual(after[self.february.instance_id], before[self.february.instance_id])
+
+    def test_recompute_bumps_instances_whose_lecturers_overload_flag_changed(self):
+        self.november.add_lecturer(self.cat)
+        SubjectInstanceLecturer.objects.create(subject_instance=self.february, user=self.cat)
+        self.assertBumped(
+            lambda: LecturerWorkload.objects.recompute(lecturers=[self.cat], months=self.months),
+            [self.february], unchanged=[self.november],
+        )
+
+
+class UserProfileSignalTests(WorkloadTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.november.add_lecturer(self.ann)
+
+    def save_bumps(self, save):
+        before_instance, before_workload = instance_versions([self.november.instance_id]), workload_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            save()
+        return (
+            instance_versions([self.november.instance_id]) != before_instance,
+            workload_version() != before_workload,
+        )
+
+    def test_saves_that_keep_the_name_bump_nothing(self):
+        def log_in():
+            self.ann.last_login = timezone.now()
+            self.ann.save(update_fields=['last_login'])
+
+        def change_role():
+            self.ann.role = self.manager_role
+            self.ann.save()
+
+        for save in (log_in, change_role):
+            with self.subTest(save=save.__name__):
+                self.assertEqual(self.save_bumps(save), (False, False))
+
+    def test_renaming_a_lecturer_refreshes_their_instances_and_workload_reports(self):
+        def rename():
+            self.ann.last_name = 'Atkins'
+            self.ann.save()
+
+        self.assertEqual(self.save_bumps(rename), (True, True))
+        self.assertIn('atkins', SubjectInstance.objects.get(pk=self.november.pk).search_document.lower())
+
+
+class CacheVersionTests(TestCase):
+
+    def test_version_cache_is_not_culled_before_every_instance_has_a_version(self):
+        self.assertGreaterEqual(caches['versions']._max_entries, 100000)
+
+    def test_missing_instance_versions_are_started_in_one_write(self):
+        with mock.patch.object(caches['versions'], 'set_many', wraps=caches['versions'].set_many) as set_many:
+            versions = instance_versions([101, 102, 103])
+        set_many.assert_called_once()
+        self.assertEqual(instance_versions([101, 102, 103]), versions)
+
+    def test_versions_are_only_started_where_asked(self):
+        self.assertIsNone(instance_version(104, start=False))
+        self.assertIsNone(instance_version(104, start=False))
+        version = instance_version(104)
+        self.assertEqual(instance_version(104, start=False), version)
+
+    def test_versions_survive_the_local_cache_of_another_process(self):
+        version = lecturer_version(1)
+        cache.clear()
+        self.assertEqual(lecturer_version(1), version)
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_lecturer_versions([1])
+        self.assertNotEqual(lecturer_version(1), version)
+
+    def test_get_or_rebuild_rebuilds_once_the_version_changes(self):
+        builds = []
+
+        def rebuild():
+            builds.append(len(builds))
+            return len(builds)
+
+        version = lecturer_version(2)
+        self.assertEqual(get_or_rebuild('test_value', version, rebuild, 60), 1)
+        self.assertEqual(get_or_rebuild('test_value', version, rebuild, 60), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_lecturer_versions([2])
+        self.assertEqual(get_or_rebuild('test_value', lecturer_version(2), rebuild, 60), 2)
+        self.assertEqual(len(builds), 2)
+
+
+class SingleFlightRebuildTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.builds = 0
+
+    def rebuild(self):
+        self.builds += 1
+        return f'built {self.builds}'
+
+    def hold_lock(self, key):
+        cache.add(REBUILD_LOCK_KEY.format(key), 'other caller', 60)
+
+    def test_previous_value_is_served_while_another_caller_rebuilds(self):
+        self.assertEqual(get_or_rebuild('report', 1, self.rebuild, 60), 'built 1')
+        self.hold_lock('report')
+        self.assertEqual(get_or_rebuild('report', 2, self.rebuild, 60), 'built 1')
+        self.assertEqual(self.builds, 1)
+
+    def test_previous_value_is_returned_with_its_own_version(self):
+        self.assertEqual(get_or_rebuild_versioned('report', 1, self.rebuild, 60), ('built 1', 1))
+        self.hold_lock('report')
+        self.assertEqual(get_or_rebuild_versioned('report', 2, self.rebuild, 60), ('built 1', 1))
+        cache.delete(REBUILD_LOCK_KEY.format('report'))
+        self.assertEqual(get_or_rebuild_versioned('report', 2, self.rebuild, 60), ('built 2', 2))
+
+    def test_callers_without_a_value_wait_for_the_rebuild(self):
+        self.hold_lock('report')
+        finished = threading.Timer(0.1, lambda: cache.set('report', {'version': 1, 'value': 'shared', 'expires': float('inf')}))
+        finished.start()
+        self.addCleanup(finished.cancel)
+        self.assertEqual(get_or_rebuild('report', 1, self.rebuild, 60), 'shared')
+        self.assertEqual(self.builds, 0)
+
+    def test_callers_rebuild_themselves_once_the_wait_is_over(self):
+        self.hold_lock('report')
+        self.assertEqual(get_or_rebuild('report', 1, self.rebuild, 60, wait=0.1), 'built 1')
+        # The other caller still holds the lock, so nothing is stored
+        self.assertIsNone(cache.get('report'))
+
+    def test_lock_is_released_when_the_rebuild_fails(self):
+        def fail():
+            raise RuntimeError('rebuild failed')
+
+        with self.assertRaises(RuntimeError):
+            get_or_rebuild('report', 1, fail, 60)
+        self.assertIsNone(cache.get(REBUILD_LOCK_KEY.format('report')))
+        self.assertEqual(get_or_rebuild('report', 1, self.rebuild, 60), 'built 1')
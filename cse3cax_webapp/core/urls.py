@@ -9,6 +9,7 @@
 # Revisions:
 #   - 17-09-24: Initial file created by Jacob Paff. Added routes for home, login redirect, and Cognito callback.
 #   - 19-09-24: Added set_testing_role and health_check routes for testing and system monitoring.
+#   - 17-10-26: Added workload_status route for background workload recalculation.
 #
 
 from django.urls import path
@@ -23,4 +24,5 @@ urlpatterns = [
     path('logout/', views.logout_view, name='logout'),  # Logout functionality
     path('set_testing_role/', views.set_testing_role, name='set_testing_role'),  # Assign testing role to specific users
     path('health/', views.health_check, name='health_check'),  # System health check endpoint
+    path('workload_status/', views.workload_status, name='workload_status'),  # Settles background workload recalculation
 ]
@@ -11,6 +11,8 @@
 #   - 19-09-24: Implemented Cognito callback handling and role assignment for testing users.
 #   - 08-10-24: Fixed bug in role_redirect where unauthenticated users were redirected incorrectly.
 #     19-09-24: Added health check endpoint
+#   - 17-10-26: Added workload status endpoint that reports when background workload recalculation settles.
+#   - 17-10-26: The workload status endpoint answers at once for one request's ticket and the page polls it.
 
 from django.contrib.auth import logout
 from django.shortcuts import redirect, render
@@ -19,7 +21,7 @@ from django.contrib.auth import login
 from django.conf import settings
 import jwt
 from django.conf import settings
-from .models import Role
+from .models import Role, workload_queue
 from jwt.algorithms import RSAAlgorithm
 import json
 from django.contrib.auth import authenticate
@@ -33,6 +35,18 @@ def home(request):
 def health_check(request):
     return HttpResponse("OK", status=200)
 
+# Report whether the workload recalculation queued by one request has settled, without waiting for it. While it
+# is running the status placeholder is rendered again to poll once more, and once it has settled the placeholder
+# opens the overloaded lecturers modal if that request overloaded a lecturer
+def workload_status(request):
+    if not request.user.is_authenticated:
+        return HttpResponse(status=403)
+    ticket = request.GET.get('ticket', '')
+    status = workload_queue.status(ticket)
+    if status is not None and not status.done:
+        return render(request, 'workload_status.html', {'workload_ticket': ticket})
+    return render(request, 'workload_status.html', {'overloaded': status is not None and status.overloaded})
+
 # Redirect to Cognito login page
 def login_redirect(request):
     login_url = (
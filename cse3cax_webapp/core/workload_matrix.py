@@ -0,0 +1,219 @@
+#
+# Vectorised Workload Matrix
+# ==========================
+# This file computes the full lecturer x month workload matrix in one vectorised NumPy pass.
+# Subject instances, lecturer links and enrollments are loaded as flat arrays and the WorkloadManager
+# rules (base workload per subject, student surcharge and the diminishing factor for additional
+# lecturers) are applied to all of them at once. It is used for annual planning and to rebuild
+# LecturerWorkload after the workload rules change (recompute_workloads --engine=matrix).
+#
+# File: workload_matrix.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial file created. Added the workload matrix and the LecturerWorkload rebuild.
+#   - 17-10-26: Refresh lecturer workload snapshots and weekly load vectors after a rebuild.
+#   - 17-10-26: Rebuild one month per transaction under the workload locks, and take the share and maximum
+#     workload rules from WorkloadManager and UserProfile.
+#   - 17-10-26: Report changed overload flags through WorkloadManager.overloads_changed.
+#
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Q
+from core.models import LecturerWorkload, SubjectInstance, SubjectInstanceLecturer, UserProfile
+
+
+class WorkloadMatrix:
+    """
+    Lecturer x month workload matrix.
+
+    Rows follow lecturer_ids and columns are consecutive months starting at January of first_year.
+    """
+
+    def __init__(self, lecturer_ids, first_year, values, max_workloads):
+        self.lecturer_ids = lecturer_ids
+        self.first_year = first_year
+        self.values = values
+        self.max_workloads = max_workloads
+
+    @property
+    def overloaded(self):
+        """
+        Boolean matrix of lecturer-months whose workload exceeds the lecturer's maximum workload.
+        """
+        return self.values > self.max_workloads[:, np.newaxis]
+
+    @property
+    def percentages(self):
+        """
+        Workload percentage of each lecturer-month, rounded like workload_percentage_for_month.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentages = np.where(
+                self.max_workloads[:, np.newaxis] > 0,
+                self.values / self.max_workloads[:, np.newaxis] * 100,
+                0,
+            )
+        return np.round(percentages, 2)
+
+    def months(self):
+        """
+        List the (month, year) pair of every column.
+        """
+        return [(index % 12 + 1, self.first_year + index // 12) for index in range(self.values.shape[1])]
+
+    def column(self, month, year):
+        """
+        Return the column index of a month, or None if it is outside the matrix.
+        """
+        index = (year - self.first_year) * 12 + month - 1
+        if 0 <= index < self.values.shape[1]:
+            return index
+        return None
+
+
+def build_workload_matrix(years=None, months=None):
+    """
+    Build the workload matrix for every subject instance, optionally restricted to instances starting in the
+    given years or in the given (month, year) pairs.
+    """
+    years = None if years is None else sorted(set(years))
+    subject_instances = SubjectInstance.objects.filter(start_date__isnull=False)
+    links = SubjectInstanceLecturer.objects.filter(subject_instance__start_date__isnull=False)
+    if years is not None:
+        subject_instances = subject_instances.filter(start_date__year__in=years)
+        links = links.filter(subject_instance__start_date__year__in=years)
+    if months is not None:
+        months = set(months)
+        years = sorted({year for _, year in months})
+        instance_filter = Q()
+        link_filter = Q()
+        for month, year in months:
+            instance_filter |= Q(start_date__month=month, start_date__year=year)
+            link_filter |= Q(subject_instance__start_date__month=month, subject_instance__start_date__year=year)
+        subject_instances = subject_instances.filter(instance_filter)
+        links = links.filter(link_filter)
+
+    instances = np.array(
+        list(subject_instances.values_list('instance_id', 'start_date__year', 'start_date__month', 'enrollments')),
+        dtype=np.int64,
+    ).reshape(-1, 4)
+    link_rows = np.array(list(links.values_list('subject_instance_id', 'user_id')), dtype=np.int64).reshape(-1, 2)
+
+    # Maximum workloads and per-instance shares come from the WorkloadManager and UserProfile rules themselves,
+    # so the matrix can never disagree with LecturerWorkload.objects.recompute
+    lecturer_ids = np.unique(link_rows[:, 1])
+    users = UserProfile.objects.only('user_id', 'fte_percentage').in_bulk(lecturer_ids.tolist())
+    max_workloads = np.array(
+        [users[user_id].calc_max_workload() for user_id in lecturer_ids.tolist()],
+        dtype=np.float64,
+    )
+
+    if not len(instances):
+        return WorkloadMatrix(lecturer_ids, years[0] if years else 0, np.zeros((len(lecturer_ids), 0)), max_workloads)
+
+    order = np.argsort(instances[:, 0])
+    instance_ids = instances[order, 0]
+    start_years = instances[order, 1]
+    start_months = instances[order, 2]
+    enrollments = instances[order, 3]
+
+    first_year = int(start_years.min()) if years is None else years[0]
+    last_year = int(start_years.max()) if years is None else years[-1]
+    month_index = (start_years - first_year) * 12 + start_months - 1
+
+    link_instance = np.searchsorted(instance_ids, link_rows[:, 0])
+    link_lecturer = np.searchsorted(lecturer_ids, link_rows[:, 1])
+
+    # Per-instance share for each of its lecturers, calculated once for every distinct (enrollments, lecturers) pair
+    lecturers_count = np.bincount(link_instance, minlength=len(instance_ids))
+    pairs, pair_index = np.unique(np.stack([enrollments, lecturers_count]), axis=1, return_inverse=True)
+    workload_manager = LecturerWorkload.objects
+    pair_shares = np.array(
+        [workload_manager.calculate_instance_workload(students_count, count) for students_count, count in pairs.T.tolist()],
+        dtype=np.float64,
+    )
+    share = pair_shares[pair_index.reshape(-1)]
+
+    values = np.zeros((len(lecturer_ids), (last_year - first_year + 1) * 12))
+    np.add.at(values, (link_lecturer, month_index[link_instance]), share[link_instance])
+    return WorkloadMatrix(lecturer_ids, first_year, values, max_workloads)
+
+
+def workload_months(years=None):
+    """
+    Return every (month, year) with a subject instance starting in it or an existing workload row,
+    optionally restricted to the given years.
+    """
+    subject_instances = SubjectInstance.objects.filter(start_date__isnull=False)
+    workloads = LecturerWorkload.objects.all()
+    if years is not None:
+        subject_instances = subject_instances.filter(start_date__year__in=years)
+        workloads = workloads.filter(year__in=years)
+    months = set(subject_instances.values_list('start_date__month', 'start_date__year').distinct())
+    return months | set(workloads.values_list('month', 'year').distinct())
+
+
+def rebuild_month(month, year):
+    """
+    Rebuild the LecturerWorkload rows of one month from the workload matrix.
+
+    The month's lecturer keys are locked with the same advisory locks as every other workload writer before the
+    matrix is built, so a concurrent lecturer change is either fully included or applied after the rebuild.
+    Only locked keys are written; a lecturer assigned after the keys were read is left to that change's writer.
+    Returns the rebuilt workload rows.
+    """
+    existing = LecturerWorkload.objects.filter(month=month, year=year)
+    with transaction.atomic():
+        keys = {
+            (user_id, month, year)
+            for user_id in SubjectInstanceLecturer.objects.filter(
+                subject_instance__start_date__month=month, subject_instance__start_date__year=year
+            ).values_list('user_id', flat=True)
+        }
+        keys |= {(user_id, month, year) for user_id in existing.values_list('user_profile_id', flat=True)}
+        LecturerWorkload.objects.lock_workloads(keys)
+
+        previous = dict(existing.values_list('user_profile_id', 'is_overloaded'))
+        matrix = build_workload_matrix(months=[(month, year)])
+        column = matrix.column(month, year)
+        rows = {int(user_id): row for row, user_id in enumerate(matrix.lecturer_ids.tolist())}
+        overloaded = matrix.overloaded
+        workloads = []
+        for user_id, _, _ in sorted(keys):
+            row = rows.get(user_id)
+            in_matrix = row is not None and column is not None
+            workloads.append(LecturerWorkload(
+                user_profile_id=user_id,
+                month=month,
+                year=year,
+                workload_value=float(matrix.values[row, column]) if in_matrix else 0,
+                is_overloaded=bool(overloaded[row, column]) if in_matrix else False,
+                is_dirty=False,
+            ))
+        LecturerWorkload.objects.bulk_create(
+            workloads,
+            update_conflicts=True,
+            unique_fields=['user_profile', 'month', 'year'],
+            update_fields=['workload_value', 'is_overloaded', 'is_dirty'],
+        )
+        LecturerWorkload.objects.overloads_changed(
+            ((workload.user_profile_id, month, year), workload.is_overloaded)
+            for workload in workloads
+            if workload.is_overloaded != previous.get(workload.user_profile_id, False)
+        )
+    return workloads
+
+
+def rebuild_workloads(years=None):
+    """
+    Rebuild LecturerWorkload from the workload matrix, optionally restricted to the given years.
+
+    Every month is rebuilt in its own transaction (see rebuild_month), so a rebuild never holds the locks of
+    more than one month at a time. Returns the rebuilt workload rows.
+    """
+    workloads = []
+    for month, year in sorted(workload_months(years), key=lambda month_key: (month_key[1], month_key[0])):
+        workloads.extend(rebuild_month(month, year))
+    LecturerWorkload.objects.workloads_changed()
+    return workloads
@@ -0,0 +1,172 @@
+#
+# Workload Recalculation Queue
+# ============================
+# This file defines an in-process worker pool that recalculates lecturer workloads in the background.
+# Views queue (lecturer, month, year) keys and return immediately. Keys queued for the same month are
+# coalesced, so repeated edits to the same lecturer-month collapse into a single recompute, and a month
+# is never recalculated by two workers at once.
+#
+# File: workload_queue.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial file created. Added WorkloadRecalculationQueue.
+#   - 17-10-26: Mark queued keys dirty so they can be recovered by the recompute_workloads command.
+#   - 17-10-26: Retry failed recalculations and report the outcome per enqueue through tickets.
+#   - 17-10-26: Queue keys only once the caller's transaction commits, and read the worker count at enqueue time.
+#
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# Outcome of the keys queued under one ticket
+TicketStatus = namedtuple('TicketStatus', ['done', 'overloaded', 'failed'])
+
+
+class WorkloadRecalculationQueue:
+    """
+    Coalescing queue of workload recalculation keys processed by a pool of worker threads.
+
+    The handler is called as handler(lecturer_ids, months) with a single (month, year) pair and must
+    return the recomputed LecturerWorkload rows. If given, mark_dirty is called with the keys before they
+    are queued, so work lost with the process can be found again. A failed recalculation is retried up to
+    max_attempts times, waiting retry_delay seconds longer after every attempt; if it still fails its rows
+    stay dirty for recompute_workloads --dirty.
+
+    Workers use their own database connections, so keys are only handed to them once the caller's
+    transaction commits and the changes they depend on are visible. max_workers may be a callable, read at
+    every enqueue; when it is 0 keys are recalculated immediately in the calling thread and transaction.
+
+    Every enqueue returns a ticket, and status(ticket) reports whether that enqueue's keys have been
+    recalculated and whether any of them left a lecturer overloaded, independently of other requests'
+    keys coalesced with them.
+    """
+    # Finished tickets remembered for status() before the oldest are forgotten
+    TICKET_HISTORY = 1000
+
+    def __init__(self, handler, max_workers=2, mark_dirty=None, max_attempts=3, retry_delay=0.5):
+        self.handler = handler
+        self._max_workers = max_workers
+        self.mark_dirty = mark_dirty
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = {}   # (month, year) -> (set of lecturer ids, set of tickets) waiting to be recalculated
+        self._running = set()  # (month, year) currently being recalculated
+        self._tickets = OrderedDict()  # ticket -> {'keys', 'months' still outstanding, 'overloaded', 'failed'}
+
+    @property
+    def max_workers(self):
+        return self._max_workers() if callable(self._max_workers) else self._max_workers
+
+    def enqueue(self, keys):
+        """
+        Queue (lecturer_id, month, year) keys for recalculation and return a ticket for status(),
+        or None if there were no keys.
+        """
+        keys = set(keys)
+        if not keys:
+            return None
+        months = {}
+        for lecturer_id, month, year in keys:
+            months.setdefault((month, year), set()).add(lecturer_id)
+        ticket = uuid.uuid4().hex
+        state = {'keys': keys, 'months': set(months), 'overloaded': False, 'failed': False}
+
+        if not self.max_workers:
+            for month_key, lecturer_ids in months.items():
+                self._settle([ticket], month_key, self.handler(lecturer_ids, [month_key]), state)
+            with self._lock:
+                self._remember(ticket, state)
+            return ticket
+
+        # Marked in the caller's transaction, so the dirty flags are committed together with the change
+        if self.mark_dirty is not None:
+            self.mark_dirty(keys)
+        with self._lock:
+            self._remember(ticket, state)
+        transaction.on_commit(lambda: self._submit(ticket, months))
+        return ticket
+
+    def status(self, ticket):
+        """
+        Return the TicketStatus of a ticket, or None if it is unknown or has been forgotten. Never blocks.
+        """
+        with self._lock:
+            state = self._tickets.get(ticket)
+            if state is None:
+                return None
+            return TicketStatus(not state['months'], state['overloaded'], state['failed'])
+
+    def _submit(self, ticket, months):
+        with self._lock:
+            for month_key, lecturer_ids in months.items():
+                pending_ids, pending_tickets = self._pending.setdefault(month_key, (set(), set()))
+                pending_ids.update(lecturer_ids)
+                pending_tickets.add(ticket)
+            self._dispatch()
+
+    def _remember(self, ticket, state):
+        # Must be called with the lock held
+        self._tickets[ticket] = state
+        while len(self._tickets) > self.TICKET_HISTORY:
+            oldest, oldest_state = next(iter(self._tickets.items()))
+            if oldest_state['months']:
+                break
+            del self._tickets[oldest]
+
+    def _dispatch(self):
+        # Must be called with the lock held
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max(self.max_workers, 1), thread_name_prefix='workload')
+        for month_key in list(self._pending):
+            if month_key not in self._running:
+                self._running.add(month_key)
+                self._executor.submit(self._run, month_key, *self._pending.pop(month_key))
+
+    def _run(self, month_key, lecturer_ids, tickets):
+        workloads = None
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    workloads = self.handler(lecturer_ids, [month_key])
+                    break
+                except Exception:
+                    # A failed attempt may leave the worker's connection unusable
+                    connections.close_all()
+                    if attempt == self.max_attempts:
+                        logger.exception(
+                            'Workload recalculation failed for %s/%s after %s attempts, its rows stay dirty',
+                            *month_key, attempt,
+                        )
+                    else:
+                        logger.warning('Workload recalculation failed for %s/%s, retrying', *month_key, exc_info=True)
+                        time.sleep(self.retry_delay * attempt)
+        finally:
+            # Worker threads own their database connections
+            connections.close_all()
+            with self._lock:
+                self._settle(tickets, month_key, workloads)
+                self._running.discard(month_key)
+                self._dispatch()
+
+    def _settle(self, tickets, month_key, workloads, state=None):
+        # Must be called with the lock held, unless the single ticket's state is passed in
+        overloaded_keys = {
+            (workload.user_profile_id, workload.month, workload.year)
+            for workload in workloads or () if workload.is_overloaded
+        }
+        for ticket in tickets:
+            ticket_state = state if state is not None else self._tickets.get(ticket)
+            if ticket_state is None:
+                continue
+            ticket_state['months'].discard(month_key)
+            ticket_state['overloaded'] = ticket_state['overloaded'] or bool(ticket_state['keys'] & overloaded_keys)
+            ticket_state['failed'] = ticket_state['failed'] or workloads is None
@@ -2,6 +2,9 @@
 ASGI config for cse3cax_webapp project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+When settings.EVENT_STREAM_ENABLED is set, requests for the server-sent change stream
+(settings.EVENT_STREAM_PATH) are answered by core.events.event_stream directly on the event loop,
+everything else is handled by Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
@@ -13,4 +16,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cse3cax_webapp.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up
+from django.conf import settings  # noqa: E402
+from core.events import event_stream  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if settings.EVENT_STREAM_ENABLED and scope['type'] == 'http' and scope['path'] == settings.EVENT_STREAM_PATH:
+        await event_stream(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
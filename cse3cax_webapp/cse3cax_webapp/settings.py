@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 
 
 
@@ -56,6 +57,35 @@ INSTALLED_APPS = [
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
+# The default cache holds data cached per process. The versions that invalidate it are kept in Redis, shared
+# by every process. A local database and the tests run in a single process, so they keep the versions in memory
+VERSION_CACHE_URL = os.environ.get('VERSION_CACHE_URL', 'redis://127.0.0.1:6379/1')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'versions': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': VERSION_CACHE_URL,
+    },
+}
+if LOCAL_DB or sys.argv[1:2] == ['test']:
+    CACHES['versions'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'versions',
+        # One entry per subject instance and lecturer. Culling would restart versions and drop cached data
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    }
+
+# Worker threads recalculating workloads in the background (0 recalculates synchronously)
+WORKLOAD_QUEUE_WORKERS = 2
+# Whether pages subscribe to the server-sent change stream. It is served by asgi.py only, so leave this off
+# when running under WSGI or runserver, where the stream does not exist
+EVENT_STREAM_ENABLED = False
+# Path of the change stream, and the broadcaster fanning events out to it
+EVENT_STREAM_PATH = '/events/'
+CHANGE_BROADCASTER = 'core.events.ChangeBroadcaster'
+
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -79,6 +109,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'core.context_processors.event_stream',
             ],
         },
     },
@@ -1,3 +1,198 @@
-from django.test import TestCase
+#
+# Tests for the Lecturer Views
+# ============================
+# This file tests the lecturer views, using the roster set up by core.tests.WorkloadTestCase.
+#
+# File: tests.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial tests for the iCalendar roster feed.
+#   - 17-10-26: Added tests for the cached subject instance info modal.
+#   - 17-10-26: Added tests for the lecturer workload timeline.
+#   - 17-10-26: An unchanged roster feed is answered without any query.
+#   - 17-10-26: Check the info modal's ETag matches the content served and unknown ids start no version.
+#   - 17-10-26: Check the roster feed's validators match the roster served.
+#
 
-# Create your tests here.
+from datetime import date
+from django.core.cache import cache
+from core.caching import REBUILD_LOCK_KEY, instance_version
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from core.models import LecturerWorkload, SubjectInstance
+from core.tests import WorkloadTestCase
+from lecturer.views import roster_feed_path
+
+
+class LecturerViewTestCase(WorkloadTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.november.add_lecturer(self.ann)
+        self.february.add_lecturer(self.ann)
+        self.november_small.add_lecturer(self.bob)
+
+
+class RosterFeedTests(LecturerViewTestCase):
+
+    def get_feed(self, user, **headers):
+        return self.client.get(roster_feed_path(user.user_id), **headers)
+
+    def test_feed_lists_the_lecturers_instances(self):
+        response = self.get_feed(self.ann)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        content = b''.join(response.streaming_content).decode()
+        self.assertTrue(content.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertEqual(content.count('BEGIN:VEVENT'), 2)
+        self.assertIn(f'UID:subject-instance-{self.november.instance_id}@cse3cax_webapp', content)
+        self.assertIn('DTSTART;VALUE=DATE:20241104', content)
+        self.assertNotIn(f'subject-instance-{self.november_small.instance_id}@', content)
+
+    def test_unchanged_feed_is_answered_with_a_304_from_the_version_cache(self):
+        etag = self.get_feed(self.ann)['ETag']
+        with self.assertNumQueries(0):
+            response = self.get_feed(self.ann, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_changed_roster_is_served_again(self):
+        etag = self.get_feed(self.ann)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.november_small.add_lecturer(self.ann)
+        response = self.get_feed(self.ann, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(b''.join(response.streaming_content).decode().count('BEGIN:VEVENT'), 3)
+        # Other lecturers' feeds are unaffected
+        bob_etag = self.get_feed(self.bob)['ETag']
+        self.assertEqual(self.get_feed(self.bob, HTTP_IF_NONE_MATCH=bob_etag).status_code, 304)
+
+    def test_roster_served_during_a_rebuild_keeps_its_own_validators(self):
+        response = self.get_feed(self.ann)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.november_small.add_lecturer(self.ann)
+        # While another request rebuilds the roster the previous one is served, under its previous validators
+        cache.add(REBUILD_LOCK_KEY.format(f'lect_inst_info_{self.ann.user_id}'), 'other request', 60)
+        response = self.get_feed(self.ann)
+        self.assertEqual((response['ETag'], response['Last-Modified']), (etag, last_modified))
+        self.assertEqual(b''.join(response.streaming_content).decode().count('BEGIN:VEVENT'), 2)
+        cache.delete(REBUILD_LOCK_KEY.format(f'lect_inst_info_{self.ann.user_id}'))
+        response = self.get_feed(self.ann, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(b''.join(response.streaming_content).decode().count('BEGIN:VEVENT'), 3)
+
+    def test_tampered_tokens_are_rejected(self):
+        path = roster_feed_path(self.ann.user_id)
+        tampered = path.replace(f'/{self.ann.user_id}:', f'/{self.bob.user_id}:')
+        self.assertNotEqual(tampered, path)
+        self.assertEqual(self.client.get(tampered).status_code, 404)
+        self.assertEqual(self.client.get(reverse('roster_feed', kwargs={'token': 'nonsense'})).status_code, 404)
+
+
+class SubjectInstanceInfoTests(LecturerViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Saved instances have a version once their change is committed
+        instance_version(self.november.instance_id)
+        self.client.force_login(self.ann)
+
+    def get_info(self, subject_instance, **headers):
+        return self.client.get(reverse('subject_instance_info'), {'instance_id': subject_instance.instance_id}, **headers)
+
+    def test_info_lists_the_instance_and_its_lecturers_in_two_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_info(self.november)
+        roster_queries = [query for query in queries.captured_queries if 'subject_instance' in query['sql']]
+        self.assertEqual(len(roster_queries), 2)
+        self.assertContains(response, 'Intro')
+        self.assertContains(response, 'Ann Archer')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+    def test_unchanged_instance_is_answered_with_a_304(self):
+        etag = self.get_info(self.november)['ETag']
+        # The ETag comes from the shared version cache, so another process answers with a 304 as well
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_info(self.november, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([query for query in queries.captured_queries if 'subject_instance' in query['sql']])
+
+    def test_changed_instance_is_served_again(self):
+        etag = self.get_info(self.november)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.november.add_lecturer(self.bob)
+        response = self.get_info(self.november, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, 'Bob Baker')
+
+    def test_content_served_during_a_rebuild_keeps_its_own_etag(self):
+        etag = self.get_info(self.november)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.november.add_lecturer(self.bob)
+        # While another request rebuilds the modal the previous content is served, under its previous ETag
+        cache.add(REBUILD_LOCK_KEY.format(f'subject_instance_info_{self.november.instance_id}'), 'other request', 60)
+        response = self.get_info(self.november)
+        self.assertEqual(response['ETag'], etag)
+        self.assertNotContains(response, 'Bob Baker')
+        cache.delete(REBUILD_LOCK_KEY.format(f'subject_instance_info_{self.november.instance_id}'))
+        response = self.get_info(self.november, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Bob Baker')
+
+    def test_unknown_instances_start_no_version(self):
+        response = self.client.get(reverse('subject_instance_info'), {'instance_id': 999999})
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(instance_version(999999, start=False))
+
+    def test_instances_without_a_version_start_one_when_opened(self):
+        self.assertIsNone(instance_version(self.february.instance_id, start=False))
+        etag = self.get_info(self.february)['ETag']
+        self.assertEqual(etag, f'"{self.february.instance_id}-{instance_version(self.february.instance_id, start=False)}"')
+        self.assertEqual(self.get_info(self.february, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_only_lecturers_can_open_the_modal(self):
+        self.assertEqual(self.client.get(reverse('subject_instance_info'), {'instance_id': 'x'}).status_code, 404)
+        self.client.force_login(self.manager)
+        self.assertEqual(self.get_info(self.november).status_code, 302)
+
+
+class LecturerWorkloadTimelineTests(LecturerViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.this_year = date.today().year
+        SubjectInstance.objects.create(subject=self.intro, start_date=date(self.this_year, 3, 2), enrollments=50).add_lecturer(self.cat)
+        SubjectInstance.objects.create(subject=self.intro, start_date=date(self.this_year + 1, 7, 6), enrollments=10).add_lecturer(self.cat)
+        self.client.force_login(self.cat)
+
+    def test_timeline_shows_every_month_of_this_year_and_next(self):
+        with self.assertNumQueries(4):  # session, user, role check, workload rows
+            response = self.client.get(reverse('lecturer_workload'))
+        timeline = response.context['timeline']
+        self.assertEqual(list(timeline), [self.this_year, self.this_year + 1])
+        self.assertEqual([len(entries) for entries in timeline.values()], [12, 12])
+
+        max_workload = self.cat.calc_max_workload()
+        march = timeline[self.this_year][2]
+        workload = LecturerWorkload.objects.get(user_profile=self.cat, month=3, year=self.this_year)
+        self.assertEqual(march['month_name'], 'Mar')
+        self.assertAlmostEqual(march['workload_percentage'], round(workload.workload_value / max_workload * 100, 2))
+        self.assertTrue(march['is_overloaded'])
+        # The busiest month sets the scale once it is over a full workload
+        self.assertEqual(march['bar_height'], 100)
+        self.assertEqual(response.context['full_load_height'], round(100 / march['workload_percentage'] * 100))
+        self.assertFalse(timeline[self.this_year + 1][6]['is_overloaded'])
+        self.assertEqual(timeline[self.this_year][0]['workload_percentage'], 0)
+        self.assertContains(response, 'table-danger', count=1)
+
+    def test_timeline_only_shows_the_signed_in_lecturers_workload(self):
+        self.client.force_login(self.ann)
+        response = self.client.get(reverse('lecturer_workload'))
+        self.assertFalse(any(entry['workload_percentage'] for entries in response.context['timeline'].values() for entry in entries))
+        self.client.force_login(self.manager)
+        self.assertEqual(self.client.get(reverse('lecturer_workload')).status_code, 302)
@@ -14,4 +14,6 @@ urlpatterns = [
     path('lecturer_roster', views.lecturer_roster, name='lecturer_roster'),
     path('lecturer_instance_list', views.lecturer_instance_list, name='lecturer_instance_list'),
     path('subject_instance_info/', views.subject_instance_info, name='subject_instance_info'),
+    path('roster_feed/<str:token>.ics', views.roster_feed, name='roster_feed'),
+    path('lecturer_workload', views.lecturer_workload, name='lecturer_workload'),
 ]
@@ -11,13 +11,39 @@
 #   - 19-09-24: Initial file created by Jacob Paff. Added caching for lecturer instance data and basic views for lecturer roster and subject instance info.
 #   - 23-09-24: Added caching to the lecturer instance list for performance improvement.
 #   - 05-10-24: Added user-based filtering for the subject instance list to ensure correct data display based on authentication.
+#   - 17-10-26: Rows are laid out with the shared calendar grid builder, including spans that run into the next year.
+#   - 17-10-26: Key the cached lecturer instance data by lecturer version and keep it for hours.
+#   - 17-10-26: Rebuild the cached lecturer instance data single-flight.
+#   - 17-10-26: Added a per-lecturer iCalendar roster feed with conditional GET support.
+#   - 17-10-26: Restricted subject_instance_info to lecturers and cached it per instance version with an ETag.
+#   - 17-10-26: Added lecturer_workload, a lecturer's own monthly workload for the current and next year.
+#   - 17-10-26: The info modal's ETag is built from the version of the content served, and unknown ids start no version.
+#   - 17-10-26: The roster feed's ETag and Last-Modified are built from the version of the roster served.
 #
 
+import calendar
+from datetime import date, datetime, timedelta, timezone
 from django.shortcuts import get_object_or_404, render
-from datetime import timedelta
-from core.models import SubjectInstanceLecturer, SubjectInstance
+from core.models import LecturerWorkload, SubjectInstanceLecturer, SubjectInstance, UserProfile
+from manager.views import build_calendar_cells
 from django.contrib.auth.decorators import user_passes_test
-from django.core.cache import cache
+from django.core import signing
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.http import http_date
+from django.views.decorators.http import condition
+from core.caching import get_or_rebuild_versioned, instance_version, lecturer_version
+
+# Salt of the signed tokens in roster feed urls
+ROSTER_FEED_SALT = 'lecturer.roster_feed'
+
+# Seconds a lecturer's instance data stays cached. Any change to their assignments bumps their version,
+# so this only bounds how long unused entries are kept.
+LECTURER_INSTANCES_TIMEOUT = 6 * 60 * 60
+# Seconds a rendered subject instance info modal stays cached. It is keyed by the instance version, which is
+# bumped whenever the instance, its subject or its lecturers change.
+SUBJECT_INSTANCE_INFO_TIMEOUT = 6 * 60 * 60
 
 # Helper function to check if the user is a lecturer
 def is_lecturer(user):
@@ -25,14 +51,21 @@ def is_lecturer(user):
 
 # Helper function to retrieve and cache lecturer instance information
 def lecturer_instances_info(user):
-    # Generate a unique cache key for this user
-    cache_key = f'lect_inst_info_{user.user_id}'
-    
-    # Check if the data is already cached for this user
-    cached_data = cache.get(cache_key)
-    if cached_data:
-        return cached_data
-    
+    return lecturer_instances_info_versioned(user)[0]
+
+# Helper function to retrieve the cached lecturer instance information along with the version it was built for
+def lecturer_instances_info_versioned(user):
+    # The data is cached per user under the current version of their assignments. When many lecturers
+    # log in at once only one request per lecturer rebuilds it, the others get the previous data.
+    return get_or_rebuild_versioned(
+        f'lect_inst_info_{user.user_id}',
+        lecturer_version(user.user_id),
+        lambda: build_lecturer_instances_info(user),
+        LECTURER_INSTANCES_TIMEOUT,
+    )
+
+# Helper function to build the lecturer instance information
+def build_lecturer_instances_info(user):
     # Initialize years and months
     years = set()
     months = {
@@ -51,8 +84,9 @@ def lecturer_instances_info(user):
         subject_instance = subject_instances_object.subject_instance
         subject = subject_instance.subject
         start_date = subject_instance.start_date
-        end_month = (start_date + timedelta(weeks=12) + timedelta(days=-2)).month
+        end_date = subject_instance.end_date
         years.add(start_date.year)
+        years.add(end_date.year)
 
         # Add the subject instance to the list
         subject_instances_list.append({
@@ -61,13 +95,16 @@ def lecturer_instances_info(user):
             'start_year': start_date.year,
             'start_month': start_date.month,
             'instance_id': subject_instance.instance_id,
-            'end_month': end_month,  # 3-month range for the subject
+            'start_date': start_date,
+            'end_date': end_date,
         })
 
-    years = sorted(list(years))
+    # The calendar covers every year from the first start to the last end
+    years = list(range(min(years), max(years) + 1)) if years else []
 
-    # Cache the result for this user for 10 minutes
-    cache.set(cache_key, (years, months, subject_instances_list), 600)
+    # Lay out every row once the calendar's years are known
+    for subject_instance in subject_instances_list:
+        subject_instance['cells'] = build_calendar_cells(subject_instance['start_date'], subject_instance['end_date'], years)
 
     return years, months, subject_instances_list
 
@@ -91,17 +128,171 @@ def lecturer_roster(request):
     context = {
         'years': years,
         'months': months,
+        'roster_feed_url': request.build_absolute_uri(roster_feed_path(current_user.user_id)),
     }
     return render(request, 'lecturer_roster.html', context)
 
-# View to display detailed information about a specific subject instance
-def subject_instance_info(request):
-    instance_id = request.GET.get('instance_id')
-    subject_instance = get_object_or_404(SubjectInstance, instance_id=instance_id)
+# Helper function to build the secret url of a lecturer's roster feed. Calendar clients cannot sign in,
+# so the url carries the lecturer's user id signed with the site's secret key.
+def roster_feed_path(user_id):
+    token = signing.Signer(salt=ROSTER_FEED_SALT).sign(str(user_id))
+    return reverse('roster_feed', kwargs={'token': token})
+
+# Helper function to read the lecturer's user id from a roster feed token, or None if the token is invalid
+def roster_feed_user_id(token):
+    try:
+        return int(signing.Signer(salt=ROSTER_FEED_SALT).unsign(token))
+    except (signing.BadSignature, ValueError):
+        return None
+
+# Helper functions to build the feed's ETag and Last-Modified from a lecturer version, which is the time of
+# the last change to their assignments
+def roster_feed_etag_value(user_id, version):
+    return f'"{user_id}-{version}"'
+
+def roster_feed_modified(version):
+    return datetime.fromtimestamp(version / 1e9, tz=timezone.utc)
+
+# The validators of the current version are read from the shared version cache only, so an unchanged feed is
+# answered with a 304 without any database query
+def roster_feed_etag(request, token):
+    user_id = roster_feed_user_id(token)
+    return None if user_id is None else roster_feed_etag_value(user_id, lecturer_version(user_id))
+
+def roster_feed_last_modified(request, token):
+    user_id = roster_feed_user_id(token)
+    return None if user_id is None else roster_feed_modified(lecturer_version(user_id))
+
+# Helper function to escape text values in iCalendar content lines
+def ics_escape(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+# Generator of the iCalendar lines of a lecturer's roster, one all-day event per subject instance
+def roster_feed_lines(subject_instances_list, stamp):
+    yield 'BEGIN:VCALENDAR\r\n'
+    yield 'VERSION:2.0\r\n'
+    yield 'PRODID:-//cse3cax_webapp//Lecturer Roster//EN\r\n'
+    yield 'CALSCALE:GREGORIAN\r\n'
+    yield 'X-WR-CALNAME:Teaching Roster\r\n'
+    for subject_instance in subject_instances_list:
+        yield 'BEGIN:VEVENT\r\n'
+        yield f"UID:subject-instance-{subject_instance['instance_id']}@cse3cax_webapp\r\n"
+        yield f'DTSTAMP:{stamp:%Y%m%dT%H%M%SZ}\r\n'
+        yield f"DTSTART;VALUE=DATE:{subject_instance['start_date']:%Y%m%d}\r\n"
+        # All-day events end on the day after the last teaching day
+        yield f"DTEND;VALUE=DATE:{subject_instance['end_date'] + timedelta(days=1):%Y%m%d}\r\n"
+        yield f"SUMMARY:{ics_escape(subject_instance['subject_id'])} - {ics_escape(subject_instance['subject_name'])}\r\n"
+        yield 'TRANSP:TRANSPARENT\r\n'
+        yield 'END:VEVENT\r\n'
+    yield 'END:VCALENDAR\r\n'
+
+# View to serve a lecturer's roster as an iCalendar feed for calendar clients
+@condition(etag_func=roster_feed_etag, last_modified_func=roster_feed_last_modified)
+def roster_feed(request, token):
+    user_id = roster_feed_user_id(token)
+    if user_id is None:
+        raise Http404('Unknown roster feed')
+    (years, months, subject_instances_list), version = lecturer_instances_info_versioned(UserProfile(user_id=user_id))
+    # The previous roster may be served while it is rebuilt, so the validators come from its own version
+    stamp = roster_feed_modified(version)
+    response = StreamingHttpResponse(roster_feed_lines(subject_instances_list, stamp), content_type='text/calendar; charset=utf-8')
+    response['ETag'] = roster_feed_etag_value(user_id, version)
+    response['Last-Modified'] = http_date(stamp.timestamp())
+    response['Content-Disposition'] = 'inline; filename="roster.ics"'
+    # Clients must revalidate, which is answered with a 304 until the roster changes
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Helper function to read the instance id of a subject_instance_info request
+def subject_instance_info_id(request):
+    instance_id = request.GET.get('instance_id', '')
+    if not instance_id.isdigit():
+        raise Http404('Unknown subject instance')
+    return int(instance_id)
+
+# Helper function to build the modal's ETag from the instance version its content was rendered for
+def subject_instance_info_etag_value(instance_id, version):
+    return f'"{instance_id}-{version}"'
+
+# The modal's ETag is read from the version cache only, so reopening an unchanged instance is answered with a
+# 304. An instance without a version has no ETag yet; reading it does not start one, so unknown ids never do.
+def subject_instance_info_etag(request):
+    instance_id = subject_instance_info_id(request)
+    version = instance_version(instance_id, start=False)
+    return None if version is None else subject_instance_info_etag_value(instance_id, version)
+
+# Helper function to render the subject instance info modal with two queries, one for the instance and its
+# subject and one for its lecturers
+def render_subject_instance_info(instance_id):
+    subject_instance = get_object_or_404(
+        SubjectInstance.objects.select_related('subject').prefetch_related('lecturer'), instance_id=instance_id
+    )
     context = {
         'subject_instance': subject_instance,
-        'end_date': subject_instance.start_date + timedelta(weeks=12) + timedelta(days=-2),
+        'end_date': subject_instance.end_date,
         'lecturers': subject_instance.lecturer.all(),
         'subject_name': subject_instance.subject.subject_name
     }
-    return render(request, 'subject_instance_info.html', context)
+    return render_to_string('subject_instance_info.html', context)
+
+# View to display detailed information about a specific subject instance
+@user_passes_test(is_lecturer, login_url='login_redirect')
+@condition(etag_func=subject_instance_info_etag)
+def subject_instance_info(request):
+    instance_id = subject_instance_info_id(request)
+    version = instance_version(instance_id, start=False)
+    if version is None:
+        # Only start a version for an instance that exists
+        if not SubjectInstance.objects.filter(instance_id=instance_id).exists():
+            raise Http404('Unknown subject instance')
+        version = instance_version(instance_id)
+    content, content_version = get_or_rebuild_versioned(
+        f'subject_instance_info_{instance_id}',
+        version,
+        lambda: render_subject_instance_info(instance_id),
+        SUBJECT_INSTANCE_INFO_TIMEOUT,
+    )
+    response = HttpResponse(content)
+    # The previous content may be served while it is rebuilt, so its own version is the ETag
+    response['ETag'] = subject_instance_info_etag_value(instance_id, content_version)
+    # Browsers revalidate every open, which is answered with a 304 until the instance changes
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+# View to display the lecturer's own workload percentage and overload flag for every month of the current and
+# next year, read from the lecturer's workload rows in one range query
+@user_passes_test(is_lecturer, login_url='login_redirect')
+def lecturer_workload(request):
+    current_user = request.user
+    this_year = date.today().year
+    years = [this_year, this_year + 1]
+    workloads = {
+        (month, year): (workload_value or 0, is_overloaded)
+        for month, year, workload_value, is_overloaded in LecturerWorkload.objects.filter(
+            user_profile_id=current_user.user_id, year__in=years
+        ).values_list('month', 'year', 'workload_value', 'is_overloaded')
+    }
+
+    max_workload = current_user.calc_max_workload()
+    timeline = {year: [] for year in years}
+    for year in years:
+        for month in range(1, 13):
+            workload_value, is_overloaded = workloads.get((month, year), (0, False))
+            timeline[year].append({
+                'month_name': calendar.month_abbr[month],
+                'workload_percentage': round(workload_value / max_workload * 100, 2) if max_workload > 0 else 0,
+                'is_overloaded': is_overloaded,
+            })
+
+    # Bars are scaled to the busiest month, or to a full workload if no month reaches it
+    scale = max([100] + [entry['workload_percentage'] for entries in timeline.values() for entry in entries])
+    for entries in timeline.values():
+        for entry in entries:
+            entry['bar_height'] = round(entry['workload_percentage'] / scale * 100)
+
+    context = {
+        'month_names': calendar.month_abbr[1:],
+        'timeline': timeline,
+        'full_load_height': round(100 / scale * 100),
+    }
+    return render(request, 'lecturer_workload.html', context)
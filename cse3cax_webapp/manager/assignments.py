@@ -0,0 +1,157 @@
+#
+# Batch Lecturer Assignments
+# ==========================
+# This file applies a batch of lecturer add/remove operations on subject instances as one transaction.
+# All operations are validated up front with a fixed number of queries (including one expertise lookup),
+# applied with a single bulk insert and a single delete, and followed by one workload recompute over the
+# union of affected lecturer-months.
+#
+# File: assignments.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial file created. Added apply_assignment_batch.
+#   - 17-10-26: Lock the batch's instances before reading their current lecturers.
+#   - 17-10-26: Publish the added assignments to the change stream.
+#   - 17-10-26: Bump the versions of lecturers with added assignments.
+#
+
+from django.db import transaction
+from django.db.models import Q
+from core.caching import bump_instance_versions, bump_lecturer_versions
+from core.events import publish_instance_changes
+from core.models import LecturerExpertise, LecturerWorkload, SubjectInstance, SubjectInstanceLecturer, UserProfile
+
+ADD = 'add'
+REMOVE = 'remove'
+
+
+class AssignmentBatchError(Exception):
+    """
+    Raised when a batch contains invalid operations. Nothing in the batch is applied.
+    """
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def parse_operations(operations):
+    """
+    Validate the shape of the operations and return them as (op, instance_id, user_id) tuples.
+    Later operations on the same (instance, lecturer) pair replace earlier ones.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise AssignmentBatchError(['operations must be a non-empty list.'])
+    errors = []
+    parsed = {}
+    for index, operation in enumerate(operations):
+        try:
+            op = operation['op']
+            instance_id = int(operation['instance_id'])
+            user_id = int(operation['user_id'])
+        except (KeyError, TypeError, ValueError):
+            errors.append(f'Operation {index}: expected op, instance_id and user_id.')
+            continue
+        if op not in (ADD, REMOVE):
+            errors.append(f'Operation {index}: op must be "{ADD}" or "{REMOVE}".')
+            continue
+        parsed[(instance_id, user_id)] = op
+    if errors:
+        raise AssignmentBatchError(errors)
+    return [(op, instance_id, user_id) for (instance_id, user_id), op in parsed.items()]
+
+
+def apply_assignment_batch(operations):
+    """
+    Apply a batch of {'op': 'add' | 'remove', 'instance_id': ..., 'user_id': ...} operations.
+
+    Raises:
+        AssignmentBatchError: If any operation is invalid, for example a lecturer without expertise in the
+            instance's subject. Nothing is applied in that case.
+
+    Returns:
+        dict: {'added': count, 'removed': count, 'lecturers': {user_id: {'overloaded': bool, 'months': {...}}}}
+            where months maps 'month/year' to the recomputed workload percentage and overload flag.
+    """
+    operations = parse_operations(operations)
+    instance_ids = {instance_id for _, instance_id, _ in operations}
+    user_ids = {user_id for _, _, user_id in operations}
+
+    instances = {
+        instance_id: (subject_id, start_date)
+        for instance_id, subject_id, start_date in SubjectInstance.objects.filter(
+            instance_id__in=instance_ids
+        ).values_list('instance_id', 'subject_id', 'start_date')
+    }
+    users = UserProfile.objects.only('user_id', 'fte_percentage').in_bulk(user_ids)
+
+    # Every lecturer being added needs expertise in the instance's subject, checked in one query
+    expertise = set(LecturerExpertise.objects.filter(
+        user_id__in={user_id for op, _, user_id in operations if op == ADD},
+        subject_id__in={subject_id for subject_id, _ in instances.values()},
+    ).values_list('user_id', 'subject_id'))
+
+    errors = []
+    for op, instance_id, user_id in operations:
+        if instance_id not in instances:
+            errors.append(f'Subject instance {instance_id} does not exist.')
+        elif user_id not in users:
+            errors.append(f'Lecturer {user_id} does not exist.')
+        elif op == ADD and (user_id, instances[instance_id][0]) not in expertise:
+            errors.append(f'Lecturer {user_id} does not have expertise in the subject of instance {instance_id}.')
+    if errors:
+        raise AssignmentBatchError(errors)
+
+    with transaction.atomic():
+        # Lock the instances in id order so concurrent batches touching the same instances queue up without deadlocking
+        SubjectInstance.objects.lock(instance_ids)
+        existing = set(SubjectInstanceLecturer.objects.filter(
+            subject_instance_id__in=instance_ids, user_id__in=user_ids
+        ).values_list('subject_instance_id', 'user_id'))
+        to_add = [(instance_id, user_id) for op, instance_id, user_id in operations
+                  if op == ADD and (instance_id, user_id) not in existing]
+        to_remove = [(instance_id, user_id) for op, instance_id, user_id in operations
+                     if op == REMOVE and (instance_id, user_id) in existing]
+
+        SubjectInstanceLecturer.objects.bulk_create([
+            SubjectInstanceLecturer(subject_instance_id=instance_id, user_id=user_id) for instance_id, user_id in to_add
+        ])
+        if to_remove:
+            remove_filter = Q()
+            for instance_id, user_id in to_remove:
+                remove_filter |= Q(subject_instance_id=instance_id, user_id=user_id)
+            SubjectInstanceLecturer.objects.filter(remove_filter).delete()
+
+        # Every lecturer on a changed instance has a new share of its workload, as do the removed lecturers
+        changed_ids = {instance_id for instance_id, _ in to_add + to_remove if instances[instance_id][1]}
+        keys = {
+            (user_id, start_date.month, start_date.year)
+            for user_id, start_date in SubjectInstanceLecturer.objects.filter(
+                subject_instance_id__in=changed_ids
+            ).values_list('user_id', 'subject_instance__start_date')
+        }
+        keys |= {
+            (user_id, instances[instance_id][1].month, instances[instance_id][1].year)
+            for instance_id, user_id in to_remove if instances[instance_id][1]
+        }
+        workloads = LecturerWorkload.objects.recompute(keys=keys)
+
+    # bulk_create sends no signals, so the new assignments' cached rows, search documents and change events are handled here
+    added_ids = {instance_id for instance_id, _ in to_add}
+    if added_ids:
+        bump_instance_versions(added_ids)
+        SubjectInstance.objects.refresh_search_documents(added_ids)
+        publish_instance_changes(added_ids, 'assignment')
+        bump_lecturer_versions(user_id for _, user_id in to_add)
+
+    lecturers = {}
+    for workload in workloads:
+        max_workload = workload.user_profile.calc_max_workload()
+        result = lecturers.setdefault(workload.user_profile_id, {'overloaded': False, 'months': {}})
+        result['months'][f'{workload.month}/{workload.year}'] = {
+            'workload_percentage': round(workload.workload_value / max_workload * 100, 2) if max_workload > 0 else 0,
+            'is_overloaded': workload.is_overloaded,
+        }
+        result['overloaded'] = result['overloaded'] or workload.is_overloaded
+
+    return {'added': len(to_add), 'removed': len(to_remove), 'lecturers': lecturers}
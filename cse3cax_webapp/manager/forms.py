@@ -9,8 +9,11 @@
 # Revisions:
 #   - 17-09-24: Initial file created by Jacob Paff. Defined forms for subject instance management and lecturer assignments.
 #   - 25-09-24: Added validation for lecturer expertise when assigning lecturers to a subject instance.
+#   - 17-10-26: Added BulkEnrollmentForm for pasting or uploading enrollment figures for many instances.
 #
 
+import csv
+import io
 from django import forms
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Fieldset, Submit, Div
@@ -52,6 +55,78 @@ class SubjectInstanceForm(forms.ModelForm):
             instance.save()
         return instance
 
+# Form to update the enrollments of many subject instances at once
+class BulkEnrollmentForm(forms.Form):
+    enrollments = forms.CharField(
+        label="Enrollments",
+        widget=forms.Textarea(attrs={'rows': 8, 'placeholder': 'instance_id,enrollments'}),
+        required=False,
+        help_text="One instance per line as instance_id,enrollments. A header line is ignored."
+    )
+    file = forms.FileField(label="Or upload a CSV file", required=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_method = 'post'
+        self.helper.layout = Layout(
+            Fieldset(
+                'Bulk Enrollment Update',
+                'enrollments',
+                'file'
+            ),
+            Div(
+                Submit('submit', 'Update Enrollments', css_class='btn btn-primary'),
+                css_class='text-right'
+            )
+        )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        text = cleaned_data.get('enrollments') or ''
+        upload = cleaned_data.get('file')
+        if upload:
+            try:
+                text += '\n' + upload.read().decode('utf-8-sig')
+            except UnicodeDecodeError:
+                self.add_error('file', "The file must be a UTF-8 CSV file.")
+                return cleaned_data
+
+        # Parse the instance_id,enrollments pairs
+        pairs = {}
+        for line_number, row in enumerate(csv.reader(io.StringIO(text)), start=1):
+            row = [value.strip() for value in row if value.strip()]
+            if not row:
+                continue
+            if len(row) != 2:
+                self.add_error(None, f"Line {line_number}: expected instance_id,enrollments.")
+                continue
+            try:
+                instance_id, enrollments = int(row[0]), int(row[1])
+            except ValueError:
+                if not pairs and line_number == 1:
+                    continue  # Header line
+                self.add_error(None, f"Line {line_number}: instance id and enrollments must be whole numbers.")
+                continue
+            if enrollments < 0:
+                self.add_error(None, f"Line {line_number}: enrollments cannot be negative.")
+            elif instance_id in pairs:
+                self.add_error(None, f"Line {line_number}: instance {instance_id} is listed more than once.")
+            else:
+                pairs[instance_id] = enrollments
+
+        if not pairs and not self.errors:
+            self.add_error('enrollments', "Paste or upload at least one instance_id,enrollments line.")
+
+        # Check every instance exists in one query
+        unknown = set(pairs) - set(SubjectInstance.objects.filter(instance_id__in=pairs).values_list('instance_id', flat=True))
+        if unknown:
+            self.add_error(None, f"Unknown subject instance(s): {', '.join(str(instance_id) for instance_id in sorted(unknown))}.")
+
+        cleaned_data['pairs'] = pairs
+        return cleaned_data
+
+
 # Form to manage lecturers assigned to a subject instance
 class AssignedLecturersForm(forms.Form):
     assigned_lecturers = forms.ModelMultipleChoiceField(
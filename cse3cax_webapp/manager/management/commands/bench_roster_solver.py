@@ -0,0 +1,67 @@
+"""
+Benchmark the automatic roster solver on a synthetic dataset
+
+Author: Jacob Paff
+"""
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from core.models import WorkloadManager
+from manager.roster_solver import solve_roster
+
+
+class Command(BaseCommand):
+    """
+    This command generates a synthetic term (subjects, lecturers with expertise and FTE, and unstaffed
+    instances) entirely in memory and times solve_roster on it. No database access is needed.
+
+    Author: Jacob Paff
+    """
+    help = 'Benchmark the roster solver on a synthetic dataset.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--instances', type=int, default=5000)
+        parser.add_argument('--lecturers', type=int, default=500)
+        parser.add_argument('--subjects', type=int, default=300)
+        parser.add_argument('--months', type=int, default=12)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        workload_manager = WorkloadManager()
+        lecturers = list(range(1, options['lecturers'] + 1))
+        capacities = {
+            lecturer_id: rng.choice([0.4, 0.5, 0.8, 1.0]) * WorkloadManager.FULL_TIME_UNITS for lecturer_id in lecturers
+        }
+        experts = {subject_id: rng.sample(lecturers, rng.randint(2, 8)) for subject_id in range(options['subjects'])}
+
+        instances = []
+        candidates = {}
+        for instance_id in range(options['instances']):
+            subject_id = rng.randrange(options['subjects'])
+            month_key = (rng.randint(1, options['months']), 2025)
+            workload = workload_manager.calculate_instance_workload(rng.randint(0, 120), 1)
+            instances.append((instance_id, month_key, workload))
+            candidates[instance_id] = experts[subject_id]
+
+        started = time.perf_counter()
+        assignments, unassigned = solve_roster(instances, candidates, capacities)
+        elapsed = time.perf_counter() - started
+
+        loads = {}
+        for instance_id, month_key, workload in instances:
+            lecturer_id = assignments.get(instance_id)
+            if lecturer_id is not None:
+                loads[(lecturer_id, month_key)] = loads.get((lecturer_id, month_key), 0) + workload
+        ratios = [load / capacities[lecturer_id] for (lecturer_id, _), load in loads.items()]
+        overloaded = sum(1 for value in ratios if value > 1 + 1e-9)
+
+        self.stdout.write(f'Instances: {len(instances)}, lecturers: {len(lecturers)}, subjects: {options["subjects"]}')
+        self.stdout.write(f'Assigned: {len(assignments)}, unstaffed: {len(unassigned)}, overloaded lecturer-months: {overloaded}')
+        if ratios:
+            self.stdout.write(
+                f'Load ratio per lecturer-month: max {max(ratios):.2f}, mean {statistics.mean(ratios):.2f}, '
+                f'stdev {statistics.pstdev(ratios):.2f}'
+            )
+        self.stdout.write(self.style.SUCCESS(f'Solved in {elapsed:.3f}s'))
@@ -0,0 +1,179 @@
+"""
+Benchmark concurrent lecturer assignment changes and check the resulting workloads
+
+Author: Jacob Paff
+"""
+import random
+import threading
+import time
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.urls import reverse
+from core.models import LecturerExpertise, LecturerWorkload, Role, Subject, SubjectInstance, UserProfile
+from core.workload_matrix import build_workload_matrix
+
+
+class Command(BaseCommand):
+    """
+    This command runs many add/remove lecturer requests in parallel threads through the manager views, the
+    way several managers editing the same term at once would. It runs against a throwaway test database
+    filled with a synthetic term, so the configured database is never touched. Afterwards every
+    LecturerWorkload row is checked against the workload matrix rebuilt from scratch. Only PostgreSQL takes
+    concurrent writers, so on any other database the requests run in a single thread.
+
+    Author: Jacob Paff
+    """
+    help = 'Run parallel lecturer add/remove requests on a throwaway database and verify the resulting workloads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--operations', type=int, default=400, help='Total number of operations.')
+        parser.add_argument('--instances', type=int, default=20,
+                            help='Number of subject instances to contend on (fewer means more contention).')
+        parser.add_argument('--lecturers', type=int, default=30)
+        parser.add_argument('--subjects', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.run_benchmark(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+    def create_term(self, rng, options):
+        """
+        Fill the test database with subjects, lecturers with expertise, subject instances and a manager.
+        Returns the manager and the (instance_id, lecturer_id) pairs the benchmark changes.
+        """
+        lecturer_role = Role.objects.create(role_id='Lecturer')
+        manager = UserProfile.objects.create_user(
+            'manager@bench.test', Role.objects.create(role_id='Manager'), first_name='Bench', last_name='Manager'
+        )
+        subjects = Subject.objects.bulk_create([
+            Subject(subject_id=f'B{index:04d}', subject_name=f'Benchmark {index}') for index in range(options['subjects'])
+        ])
+        lecturers = [
+            UserProfile.objects.create_user(
+                f'lecturer{index}@bench.test', lecturer_role, first_name='Lecturer', last_name=str(index),
+                fte_percentage=rng.choice([0.4, 0.5, 0.8, 1.0]),
+            )
+            for index in range(options['lecturers'])
+        ]
+        experts = {subject.subject_id: rng.sample(lecturers, min(len(lecturers), rng.randint(2, 6))) for subject in subjects}
+        LecturerExpertise.objects.bulk_create([
+            LecturerExpertise(subject=subject, user=lecturer) for subject in subjects for lecturer in experts[subject.subject_id]
+        ])
+        SubjectInstance.objects.bulk_create([
+            SubjectInstance(
+                subject=rng.choice(subjects), start_date=date(2025, rng.randint(1, 3), 1), enrollments=rng.randint(0, 120)
+            )
+            for _ in range(options['instances'])
+        ])
+        pairs = [
+            (subject_instance.instance_id, lecturer.user_id)
+            for subject_instance in SubjectInstance.objects.all() for lecturer in experts[subject_instance.subject_id]
+        ]
+        return manager, pairs
+
+    def run_benchmark(self, options):
+        rng = random.Random(options['seed'])
+        manager, pairs = self.create_term(rng, options)
+        if not pairs:
+            raise CommandError('No subject instances with expert lecturers to run the benchmark on.')
+
+        threads = options['threads'] if connection.vendor == 'postgresql' else 1
+        plans = [[] for _ in range(threads)]
+        for index in range(options['operations']):
+            plans[index % len(plans)].append((rng.random() < 0.5, *rng.choice(pairs)))
+
+        errors = []
+        latencies = []
+        lock = threading.Lock()
+        start_barrier = threading.Barrier(len(plans))
+        add_url = reverse('add_lecturer_instance')
+        remove_url = reverse('remove_lecturer_instance')
+
+        def run(plan):
+            # Requests go through the same views, locks and workload delta as a manager's browser
+            client = Client()
+            client.force_login(manager)
+            start_barrier.wait()
+            try:
+                for add, instance_id, user_id in plan:
+                    started = time.perf_counter()
+                    try:
+                        response = client.get(add_url if add else remove_url, {'instance_id': instance_id, 'lecturer_id': user_id})
+                        if response.status_code != 200:
+                            raise CommandError(f'HTTP {response.status_code}')
+                    except Exception as error:
+                        with lock:
+                            errors.append(f'{type(error).__name__}: {error}')
+                    else:
+                        with lock:
+                            latencies.append(time.perf_counter() - started)
+            finally:
+                # Every thread has its own connection
+                connection.close()
+
+        self.stdout.write(
+            f'Running {options["operations"]} request(s) on {options["instances"]} instance(s) '
+            f'with {len(plans)} thread(s) against a test database...'
+        )
+        started = time.perf_counter()
+        workers = [threading.Thread(target=run, args=(plan,)) for plan in plans]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        rate = len(latencies) / elapsed if elapsed > 0 else 0
+        self.stdout.write(f'Completed {len(latencies)} request(s) in {elapsed:.2f}s ({rate:.0f} req/s), {len(errors)} error(s).')
+        if latencies:
+            latencies.sort()
+            self.stdout.write(
+                f'Latency: median {latencies[len(latencies) // 2] * 1000:.1f}ms, '
+                f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms'
+            )
+        for error in sorted(set(errors))[:10]:
+            self.stdout.write(f'  {error}')
+
+        mismatches = self.verify()
+        if mismatches or errors:
+            raise CommandError(f'{len(mismatches)} workload mismatch(es) and {len(errors)} error(s).')
+        self.stdout.write(self.style.SUCCESS('Every workload matches a full rebuild.'))
+
+    def verify(self):
+        """
+        Compare every LecturerWorkload row with the workload matrix and return the mismatching keys.
+        """
+        matrix = build_workload_matrix()
+        overloaded = matrix.overloaded
+        expected = {}
+        for row, user_id in enumerate(matrix.lecturer_ids.tolist()):
+            for column, (month, year) in enumerate(matrix.months()):
+                if matrix.values[row, column]:
+                    expected[(user_id, month, year)] = (float(matrix.values[row, column]), bool(overloaded[row, column]))
+
+        mismatches = []
+        stored = {}
+        for user_id, month, year, workload_value, is_overloaded in LecturerWorkload.objects.values_list(
+            'user_profile_id', 'month', 'year', 'workload_value', 'is_overloaded'
+        ):
+            stored[(user_id, month, year)] = (workload_value or 0, is_overloaded)
+        for key in set(expected) | set(stored):
+            expected_value, expected_overloaded = expected.get(key, (0, False))
+            stored_value, stored_overloaded = stored.get(key, (0, False))
+            if abs(expected_value - stored_value) > 1e-6 or expected_overloaded != stored_overloaded:
+                mismatches.append((key, stored_value, expected_value))
+
+        for (user_id, month, year), stored_value, expected_value in sorted(mismatches)[:10]:
+            self.stdout.write(f'  Lecturer {user_id} {month}/{year}: stored {stored_value:.4f}, expected {expected_value:.4f}')
+        self.stdout.write(f'Checked {len(set(expected) | set(stored))} lecturer-month(s), {len(mismatches)} mismatch(es).')
+        return mismatches
@@ -0,0 +1,165 @@
+#
+# Automatic Roster Solver
+# =======================
+# This file assigns lecturers to unstaffed subject instances. Only lecturers with expertise in an
+# instance's subject are considered, every lecturer is kept under their maximum workload and the load
+# is balanced across lecturers. The solver runs greedily on in-memory indexes (most constrained
+# instance first, least loaded candidate first) and then improves the balance with a local search that
+# moves instances to less loaded candidates. The result is written in one transaction followed by a
+# single bulk workload recompute.
+#
+# File: roster_solver.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial file created. Added solve_roster and assign_unstaffed_instances.
+#   - 17-10-26: Bump the cache versions of newly staffed instances.
+#   - 17-10-26: Refresh the search documents of newly staffed instances.
+#   - 17-10-26: Lock the instances being staffed so concurrent runs cannot staff an instance twice.
+#   - 17-10-26: Publish the new assignments to the change stream.
+#   - 17-10-26: Bump the versions of newly assigned lecturers.
+#   - 17-10-26: Recompute only the (lecturer, month, year) keys that gained an assignment.
+#
+
+from django.db import transaction
+from core.caching import bump_instance_versions, bump_lecturer_versions
+from core.events import publish_instance_changes
+from core.models import LecturerExpertise, LecturerWorkload, SubjectInstance, SubjectInstanceLecturer, UserProfile, WorkloadManager
+
+
+def solve_roster(instances, candidates, capacities, base_loads=None, max_passes=5):
+    """
+    Assign one lecturer to each instance without exceeding any lecturer's capacity, balancing the load.
+
+    Args:
+        instances: (instance_id, month_key, workload) tuples, where month_key identifies the workload month
+            and workload is what the instance adds to a single lecturer's load.
+        candidates: Mapping of instance_id to the lecturer ids allowed to teach it.
+        capacities: Mapping of lecturer id to maximum workload.
+        base_loads: Mapping of (lecturer_id, month_key) to workload the lecturer already carries.
+        max_passes: Maximum number of local search passes.
+
+    Returns:
+        tuple: ({instance_id: lecturer_id}, [instance ids that could not be staffed])
+    """
+    loads = dict(base_loads or {})
+    assignments = {}
+
+    def ratio(lecturer_id, month_key, extra=0):
+        capacity = capacities.get(lecturer_id, 0)
+        if capacity <= 0:
+            return float('inf')
+        return (loads.get((lecturer_id, month_key), 0) + extra) / capacity
+
+    def fits(lecturer_id, month_key, workload):
+        return loads.get((lecturer_id, month_key), 0) + workload <= capacities.get(lecturer_id, 0)
+
+    def place(instance_id, month_key, workload):
+        best = None
+        for lecturer_id in candidates.get(instance_id, ()):
+            if fits(lecturer_id, month_key, workload):
+                score = (ratio(lecturer_id, month_key, workload), lecturer_id)
+                if best is None or score < best:
+                    best = score
+        if best is None:
+            return False
+        lecturer_id = best[1]
+        loads[(lecturer_id, month_key)] = loads.get((lecturer_id, month_key), 0) + workload
+        assignments[instance_id] = lecturer_id
+        return True
+
+    # Greedy: most constrained instances first, heaviest first among equals
+    ordered = sorted(instances, key=lambda instance: (len(candidates.get(instance[0], ())), -instance[2], instance[0]))
+    unassigned = [instance for instance in ordered if not place(*instance)]
+
+    # Local search: move an instance to another candidate when that lowers the busier of the two loads
+    for _ in range(max_passes):
+        improved = False
+        for instance_id, month_key, workload in ordered:
+            current = assignments.get(instance_id)
+            if current is None:
+                continue
+            current_ratio = ratio(current, month_key)
+            for lecturer_id in candidates.get(instance_id, ()):
+                if lecturer_id == current or not fits(lecturer_id, month_key, workload):
+                    continue
+                if ratio(lecturer_id, month_key, workload) < current_ratio:
+                    loads[(current, month_key)] -= workload
+                    loads[(lecturer_id, month_key)] = loads.get((lecturer_id, month_key), 0) + workload
+                    assignments[instance_id] = lecturer_id
+                    current, current_ratio = lecturer_id, ratio(lecturer_id, month_key)
+                    improved = True
+        # Capacity freed by the moves may now fit instances the greedy pass could not place
+        unassigned = [instance for instance in unassigned if not place(*instance)]
+        if not improved:
+            break
+
+    return assignments, [instance_id for instance_id, _, _ in unassigned]
+
+
+def assign_unstaffed_instances(subject_instances=None):
+    """
+    Assign lecturers to every unstaffed subject instance in the queryset (all instances by default).
+
+    The solver works on in-memory indexes loaded with a fixed number of queries. The assignments are
+    written with one bulk insert and one bulk workload recompute inside a single transaction.
+
+    Returns:
+        tuple: ({instance_id: lecturer_id}, [instance ids that could not be staffed])
+    """
+    if subject_instances is None:
+        subject_instances = SubjectInstance.objects.all()
+    rows = list(
+        subject_instances.filter(start_date__isnull=False, subjectinstancelecturer__isnull=True)
+        .values_list('instance_id', 'subject_id', 'start_date', 'enrollments')
+    )
+    if not rows:
+        return {}, []
+
+    workload_manager = LecturerWorkload.objects
+    instances = []
+    months = set()
+    for instance_id, subject_id, start_date, enrollments in rows:
+        month_key = (start_date.month, start_date.year)
+        months.add(month_key)
+        instances.append((instance_id, month_key, workload_manager.calculate_instance_workload(enrollments or 0, 1)))
+
+    experts = {}
+    for subject_id, user_id in LecturerExpertise.objects.filter(
+        subject_id__in={subject_id for _, subject_id, _, _ in rows}
+    ).values_list('subject_id', 'user_id'):
+        experts.setdefault(subject_id, []).append(user_id)
+    candidates = {instance_id: experts.get(subject_id, []) for instance_id, subject_id, _, _ in rows}
+    lecturer_ids = {user_id for users in experts.values() for user_id in users}
+
+    capacities = {
+        user_id: (fte_percentage or 0) * WorkloadManager.FULL_TIME_UNITS
+        for user_id, fte_percentage in UserProfile.objects.filter(user_id__in=lecturer_ids).values_list('user_id', 'fte_percentage')
+    }
+    base_loads = {}
+    for user_id, month, year, workload_value in LecturerWorkload.objects.filter(
+        user_profile_id__in=lecturer_ids, year__in={year for _, year in months}
+    ).values_list('user_profile_id', 'month', 'year', 'workload_value'):
+        base_loads[(user_id, (month, year))] = workload_value or 0
+
+    assignments, unassigned = solve_roster(instances, candidates, capacities, base_loads)
+    if assignments:
+        with transaction.atomic():
+            # Lock the chosen instances and drop any another manager staffed while the solver ran
+            SubjectInstance.objects.lock(assignments)
+            for instance_id in SubjectInstanceLecturer.objects.filter(subject_instance_id__in=assignments).values_list('subject_instance_id', flat=True):
+                assignments.pop(instance_id, None)
+            SubjectInstanceLecturer.objects.bulk_create([
+                SubjectInstanceLecturer(subject_instance_id=instance_id, user_id=lecturer_id)
+                for instance_id, lecturer_id in assignments.items()
+            ])
+            # Only the lecturer-months that gained an instance change
+            workload_manager.recompute(keys={
+                (assignments[instance_id], month, year)
+                for instance_id, (month, year), _ in instances if instance_id in assignments
+            })
+        # bulk_create sends no signals, so the cached calendar rows, search documents and change events are handled here
+        bump_instance_versions(assignments)
+        SubjectInstance.objects.refresh_search_documents(assignments)
+        publish_instance_changes(assignments, 'assignment')
+        bump_lecturer_versions(assignments.values())
+    return assignments, unassigned
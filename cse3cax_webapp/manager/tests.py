@@ -1,3 +1,426 @@
-from django.test import TestCase
+#
+# Tests for the Manager Views
+# ===========================
+# This file tests the manager views for subject instances and lecturer assignments, using the roster set up by
+# core.tests.WorkloadTestCase.
+#
+# File: tests.py
+# Author: Jacob Paff
+# Revisions:
+#   - 17-10-26: Initial tests for adding and removing lecturers.
+#   - 17-10-26: Added tests for the workload status poller returned by deletes.
+#   - 17-10-26: Added tests for the roster solver.
+#   - 17-10-26: Added tests for the calendar rows removed and refreshed after instance changes.
+#   - 17-10-26: Added tests for the change stream setting.
+#   - 17-10-26: Added tests for keyset pagination boundaries.
+#   - 17-10-26: Added tests for batch lecturer assignment validation.
+#   - 17-10-26: Added tests for the annotated lecturer list.
+#   - 17-10-26: Added tests for the instance calendar's query count.
+#   - 17-10-26: Added tests for the calendar cell layout.
+#   - 17-10-26: Added tests for searching subject instances.
+#   - 17-10-26: Added tests for bulk enrollment updates.
+#
 
-# Create your tests here.
+from unittest import mock
+import json
+from datetime import date
+from urllib.parse import parse_qs, urlparse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from core.models import LecturerWorkload, SubjectInstance, SubjectInstanceLecturer
+from core.tests import WorkloadTestCase
+from manager.roster_solver import assign_unstaffed_instances, solve_roster
+from manager.views import BLANK_CELL, CalendarCell, build_calendar_cells, paginate_subject_instances
+
+
+class ManagerViewTestCase(WorkloadTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.manager)
+
+
+class LecturerAssignmentViewTests(ManagerViewTestCase):
+
+    def change_lecturer(self, url_name, subject_instance, lecturer):
+        return self.client.get(reverse(url_name), {'instance_id': subject_instance.instance_id, 'lecturer_id': lecturer.user_id})
+
+    def test_adding_a_lecturer_applies_the_workload_before_responding(self):
+        response = self.change_lecturer('add_lecturer_instance', self.november, self.ann)
+        self.assertEqual(response['Hx-Trigger'], 'closeModal')
+        self.assertAlmostEqual(
+            LecturerWorkload.objects.get(user_profile=self.ann, month=11, year=2024).workload_value,
+            self.expected_workload(self.ann, 11, 2024),
+        )
+        self.assertContains(response, f'id="instance-{self.november.instance_id}"')
+
+    def test_overloading_a_lecturer_opens_the_overloaded_lecturers_modal(self):
+        response = self.change_lecturer('add_lecturer_instance', self.february, self.cat)
+        self.assertEqual(response['Hx-Trigger'], 'closeModal, overloadedLecturers')
+        self.assertContains(response, 'table-danger')
+        response = self.change_lecturer('remove_lecturer_instance', self.february, self.cat)
+        self.assertEqual(response['Hx-Trigger'], 'closeModal')
+        self.assertContains(response, 'table-success')
+
+
+class DeleteInstanceViewTests(ManagerViewTestCase):
+
+    def test_deleting_an_assigned_instance_polls_for_its_workload_recalculation(self):
+        self.february.add_lecturer(self.cat)
+        response = self.client.post(reverse('delete_instance', kwargs={'instance_id': self.february.instance_id}))
+        self.assertEqual(response['Hx-Trigger'], 'closeModal')
+        self.assertContains(response, 'id="workload-status"')
+        self.assertContains(response, 'hx-swap-oob="true"')
+        self.assertContains(response, f'<tr id="instance-{self.february.instance_id}" hx-swap-oob="delete">')
+        self.assertContains(response, f'<tr id="calendar-instance-{self.february.instance_id}" hx-swap-oob="delete">')
+        self.assertFalse(SubjectInstance.objects.filter(pk=self.february.pk).exists())
+        workload = LecturerWorkload.objects.get(user_profile=self.cat, month=2, year=2025)
+        self.assertEqual(workload.workload_value, 0)
+        self.assertFalse(workload.is_overloaded)
+
+    def test_deleting_an_unassigned_instance_queues_nothing(self):
+        response = self.client.post(reverse('delete_instance', kwargs={'instance_id': self.november.instance_id}))
+        self.assertNotContains(response, 'workload-status')
+
+
+class RosterSolverTests(WorkloadTestCase):
+
+    def test_solver_never_exceeds_a_lecturers_capacity(self):
+        instances = [(1, (11, 2024), 6), (2, (11, 2024), 6), (3, (11, 2024), 6), (4, (2, 2025), 6)]
+        candidates = {1: [10, 20], 2: [10, 20], 3: [10, 20], 4: [20]}
+        assignments, unassigned = solve_roster(instances, candidates, {10: 10, 20: 7}, base_loads={(20, (2, 2025)): 2})
+        self.assertEqual(len(assignments), 2)
+        self.assertEqual(sorted(assignments.values()), [10, 20])
+        self.assertEqual(len(unassigned), 2)
+        self.assertIn(4, unassigned)
+
+    def test_solver_balances_load_across_candidates(self):
+        instances = [(instance_id, (11, 2024), 2) for instance_id in range(4)]
+        assignments, unassigned = solve_roster(instances, dict.fromkeys(range(4), [10, 20]), {10: 10, 20: 10})
+        self.assertEqual(unassigned, [])
+        self.assertEqual(sorted(assignments.values()), [10, 10, 20, 20])
+
+    def test_assigning_unstaffed_instances_writes_only_the_assigned_workloads(self):
+        assignments, unassigned = assign_unstaffed_instances()
+        self.assertEqual(unassigned, [])
+        self.assertEqual(assignments[self.november_small.instance_id], self.ann.user_id)
+        self.assertEqual(
+            set(LecturerWorkload.objects.values_list('user_profile_id', 'month', 'year')),
+            {(lecturer_id, instance.start_date.month, instance.start_date.year) for instance in SubjectInstance.objects.all()
+             for lecturer_id in instance.lecturer.values_list('user_id', flat=True)},
+        )
+        self.assertWorkloadsCorrect()
+        self.assertFalse(LecturerWorkload.objects.filter(is_overloaded=True).exists())
+        self.assertEqual(assign_unstaffed_instances(), ({}, []))
+
+
+class CalendarRowRefreshTests(ManagerViewTestCase):
+
+    def test_recompute_after_an_edit_refreshes_the_calendar_row(self):
+        self.february.add_lecturer(self.ann)
+        response = self.client.get(reverse('instance_calendar_row', args=[self.february.instance_id]))
+        self.assertContains(response, 'table-success')
+        self.assertContains(response, f'sse:overload-{self.ann.user_id}-2-2025')
+
+        # The row listens for the overload event published once the queued recompute has run
+        with mock.patch('core.models.publish_overload_changes') as publish:
+            self.client.post(
+                reverse('edit_subject_instance', args=[self.february.instance_id]),
+                {'subject': self.intro.subject_id, 'start_date': '2025-02-03', 'enrollments': 500},
+            )
+        publish.assert_called_once_with([((self.ann.user_id, 2, 2025), True)])
+        response = self.client.get(reverse('instance_calendar_row', args=[self.february.instance_id]))
+        self.assertContains(response, 'table-danger')
+
+    def test_deleted_instance_calendar_row_is_removed(self):
+        instance_id = self.november.instance_id
+        self.november.delete()
+        response = self.client.get(reverse('instance_calendar_row', args=[instance_id]))
+        self.assertEqual(response.content, b'')
+
+
+class EventStreamSettingTests(ManagerViewTestCase):
+
+    def test_pages_only_subscribe_to_the_change_stream_when_it_is_enabled(self):
+        with override_settings(EVENT_STREAM_ENABLED=False):
+            response = self.client.get(reverse('subject_instances'))
+        self.assertNotContains(response, 'sse-connect')
+        self.assertNotContains(response, 'sse.js')
+        with override_settings(EVENT_STREAM_ENABLED=True, EVENT_STREAM_PATH='/events/'):
+            response = self.client.get(reverse('subject_instances'))
+        self.assertContains(response, 'sse-connect="/events/"')
+        self.assertContains(response, 'sse.js')
+
+    def test_changes_are_only_published_when_the_stream_is_enabled(self):
+        with mock.patch('core.events.broadcaster.publish') as publish:
+            with override_settings(EVENT_STREAM_ENABLED=False), self.captureOnCommitCallbacks(execute=True):
+                self.november.add_lecturer(self.ann)
+            publish.assert_not_called()
+            with override_settings(EVENT_STREAM_ENABLED=True), self.captureOnCommitCallbacks(execute=True):
+                self.november.add_lecturer(self.bob)
+        publish.assert_any_call(f'instance-{self.november.instance_id}', {'change': 'assignment'})
+
+
+class KeysetPaginationTests(WorkloadTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # Ties on the start date and instances without one, which are listed last
+        SubjectInstance.objects.create(subject=cls.intro, start_date=date(2024, 11, 4), enrollments=10)
+        SubjectInstance.objects.create(subject=cls.intro, start_date=None)
+        SubjectInstance.objects.create(subject=cls.algorithms, start_date=None)
+
+    def page(self, params, page_size=2):
+        request = RequestFactory().get(reverse('instance_list'), params)
+        return paginate_subject_instances(SubjectInstance.objects.all(), request, 'instance_list', page_size)
+
+    def walk(self, page_size, **params):
+        seen = []
+        page, next_url = self.page(params, page_size)
+        seen.extend(page)
+        while next_url:
+            next_params = {key: values[0] for key, values in parse_qs(urlparse(next_url).query).items()}
+            self.assertEqual({key: next_params[key] for key in params}, params)
+            page, next_url = self.page(next_params, page_size)
+            self.assertLessEqual(len(page), page_size)
+            seen.extend(page)
+        return seen
+
+    def test_every_instance_is_listed_once_in_order_whatever_the_page_size(self):
+        expected = sorted(
+            SubjectInstance.objects.all(),
+            key=lambda subject_instance: (subject_instance.start_date is None, subject_instance.start_date or date.min, subject_instance.instance_id),
+        )
+        for page_size in (1, 2, 3, 5, 6, 10):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self.walk(page_size, search='CS'), expected)
+
+    def test_a_full_last_page_has_no_next_page(self):
+        page, next_url = self.page({}, page_size=SubjectInstance.objects.count())
+        self.assertEqual(len(page), 6)
+        self.assertIsNone(next_url)
+
+    def test_malformed_cursors_start_from_the_beginning(self):
+        first_page, _ = self.page({})
+        for after in ('garbage', '2024-13-01.5', '2024-11-04.x', '.'):
+            with self.subTest(after=after):
+                self.assertEqual(self.page({'after': after})[0], first_page)
+
+
+class BatchAssignmentViewTests(ManagerViewTestCase):
+
+    def post_batch(self, body):
+        return self.client.post(reverse('batch_assign_lecturers'), json.dumps(body), content_type='application/json')
+
+    def operation(self, op, subject_instance, lecturer):
+        return {'op': op, 'instance_id': subject_instance.instance_id, 'user_id': lecturer.user_id}
+
+    def assertRejected(self, body, *errors):
+        response = self.post_batch(body)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'], list(errors))
+        self.assertFalse(SubjectInstanceLecturer.objects.exists())
+        self.assertFalse(LecturerWorkload.objects.exists())
+
+    def test_malformed_batches_are_rejected(self):
+        response = self.client.post(reverse('batch_assign_lecturers'), 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertRejected({'operations': []}, 'operations must be a non-empty list.')
+        self.assertRejected({'operations': {'op': 'add'}}, 'operations must be a non-empty list.')
+        self.assertRejected(
+            {'operations': [{'op': 'add', 'instance_id': 'x', 'user_id': 1}, {'op': 'swap', 'instance_id': 1, 'user_id': 1}]},
+            'Operation 0: expected op, instance_id and user_id.',
+            'Operation 1: op must be "add" or "remove".',
+        )
+
+    def test_one_invalid_operation_rejects_the_whole_batch(self):
+        self.assertRejected(
+            {'operations': [
+                self.operation('add', self.november, self.ann),
+                self.operation('add', self.november_small, self.bob),
+                {'op': 'add', 'instance_id': 9999, 'user_id': self.ann.user_id},
+                {'op': 'remove', 'instance_id': self.november.instance_id, 'user_id': 9999},
+            ]},
+            f'Lecturer {self.bob.user_id} does not have expertise in the subject of instance {self.november_small.instance_id}.',
+            'Subject instance 9999 does not exist.',
+            'Lecturer 9999 does not exist.',
+        )
+
+    def test_valid_batch_is_applied_and_its_workloads_recomputed(self):
+        response = self.post_batch({'operations': [
+            self.operation('add', self.november, self.ann),
+            self.operation('add', self.november, self.bob),
+            self.operation('add', self.february, self.cat),
+            # Later operations on the same pair replace earlier ones
+            self.operation('add', self.november_small, self.ann),
+            self.operation('remove', self.november_small, self.ann),
+        ]})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual((result['added'], result['removed']), (3, 0))
+        self.assertTrue(result['lecturers'][str(self.cat.user_id)]['overloaded'])
+        self.assertFalse(result['lecturers'][str(self.ann.user_id)]['months']['11/2024']['is_overloaded'])
+        self.assertFalse(SubjectInstanceLecturer.objects.filter(subject_instance=self.november_small).exists())
+        self.assertWorkloadsCorrect()
+
+        response = self.post_batch({'operations': [self.operation('remove', self.february, self.cat)]})
+        self.assertEqual((response.json()['added'], response.json()['removed']), (0, 1))
+        self.assertWorkloadsCorrect()
+
+
+class LecturerListViewTests(ManagerViewTestCase):
+
+    def test_candidates_are_ranked_from_one_annotated_query(self):
+        self.november.add_lecturer(self.bob)
+        self.november_small.add_lecturer(self.ann)
+        # February is outside the November instance's window, so Cat's overload there is not counted
+        self.february.add_lecturer(self.cat)
+        with self.assertNumQueries(5):  # session, user, role check, instance, lecturer list
+            response = self.client.get(reverse('lecturer_list'), {'instance_id': self.november.instance_id})
+        lecturers = list(response.context['lecturer_list'])
+        self.assertEqual([lecturer.user_id for lecturer in lecturers], [self.bob.user_id, self.ann.user_id, self.cat.user_id])
+        self.assertEqual([lecturer.is_assigned for lecturer in lecturers], [True, False, False])
+        bob_workload = LecturerWorkload.objects.get(user_profile=self.bob, month=11, year=2024).workload_value
+        self.assertAlmostEqual(lecturers[0].max_workload_percent, bob_workload * 100 / self.bob.calc_max_workload())
+        self.assertEqual(lecturers[2].max_workload_percent, 0)
+        self.assertEqual(lecturers[1].expertise_count, 2)
+
+    def test_search_filters_candidates_by_name(self):
+        response = self.client.get(reverse('lecturer_list'), {'instance_id': self.november.instance_id, 'search': 'cart'})
+        self.assertEqual([lecturer.user_id for lecturer in response.context['lecturer_list']], [self.cat.user_id])
+
+
+class InstanceCalendarViewTests(ManagerViewTestCase):
+
+    def get_calendar(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('instance_calendar'))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_calendar_queries_do_not_grow_with_the_instances(self):
+        self.november.add_lecturer(self.ann)
+        self.february.add_lecturer(self.cat)
+        self.get_calendar()
+        response, few_instances = self.get_calendar()
+        self.assertEqual(response.context['years'], [2024, 2025])
+        for index in range(10):
+            subject_instance = SubjectInstance.objects.create(subject=self.intro, start_date=date(2025, 3 + index % 6, 1), enrollments=20)
+            subject_instance.add_lecturer(self.lecturers[index % 3])
+        # New instances start their cache versions when their change is committed, or on their first render
+        self.get_calendar()
+        response, many_instances = self.get_calendar()
+        self.assertEqual(len(response.context['subject_instances_list']), 13)
+        self.assertEqual(many_instances, few_instances)
+        self.assertContains(response, 'table-danger')
+
+
+class CalendarCellTests(SimpleTestCase):
+
+    def test_span_covers_the_months_the_instance_runs_for(self):
+        cells = build_calendar_cells(date(2024, 3, 4), date(2024, 5, 25), [2024])
+        self.assertEqual(cells, [BLANK_CELL] * 2 + [CalendarCell(3, True)] + [BLANK_CELL] * 7)
+
+    def test_span_runs_into_the_next_year(self):
+        cells = build_calendar_cells(date(2024, 11, 4), date(2025, 1, 25), [2024, 2025])
+        self.assertEqual(cells, [BLANK_CELL] * 10 + [CalendarCell(3, True)] + [BLANK_CELL] * 11)
+        self.assertEqual(sum(cell.colspan for cell in cells), 24)
+
+    def test_months_outside_the_calendar_are_clipped(self):
+        self.assertEqual(
+            build_calendar_cells(date(2024, 11, 4), date(2025, 1, 25), [2024]),
+            [BLANK_CELL] * 10 + [CalendarCell(2, True)],
+        )
+        self.assertEqual(
+            build_calendar_cells(date(2023, 11, 6), date(2024, 1, 27), [2024, 2025]),
+            [CalendarCell(1, True)] + [BLANK_CELL] * 23,
+        )
+
+    def test_instances_outside_the_calendar_only_get_blank_cells(self):
+        self.assertEqual(build_calendar_cells(date(2026, 2, 2), date(2026, 4, 25), [2024, 2025]), [BLANK_CELL] * 24)
+        self.assertEqual(build_calendar_cells(date(2024, 2, 5), date(2024, 4, 27), []), [])
+
+
+class InstanceSearchTests(ManagerViewTestCase):
+
+    def search(self, query):
+        response = self.client.get(reverse('instance_list'), {'search': query})
+        return {subject_instance.instance_id for subject_instance in response.context['subject_instances']}
+
+    def test_search_matches_subjects_and_lecturers_case_insensitively(self):
+        self.november.add_lecturer(self.ann)
+        self.assertEqual(self.search('cs2'), {self.november_small.instance_id})
+        self.assertEqual(self.search('INTRO'), {self.november.instance_id, self.february.instance_id})
+        self.assertEqual(self.search('archer'), {self.november.instance_id})
+        # Every word has to match
+        self.assertEqual(self.search('intro ann'), {self.november.instance_id})
+        self.assertEqual(self.search('algorithms ann'), set())
+
+    def test_search_documents_follow_assignment_and_name_changes(self):
+        self.november.add_lecturer(self.bob)
+        self.assertEqual(self.search('baker'), {self.november.instance_id})
+        self.bob.last_name = 'Brewer'
+        self.bob.save()
+        self.assertEqual(self.search('baker'), set())
+        self.assertEqual(self.search('brewer'), {self.november.instance_id})
+        self.november.remove_lecturer(self.bob)
+        self.assertEqual(self.search('brewer'), set())
+        self.algorithms.subject_name = 'Data Structures'
+        self.algorithms.save()
+        self.assertEqual(self.search('structures'), {self.november_small.instance_id})
+
+
+class BulkEnrollmentViewTests(ManagerViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.november.add_lecturer(self.ann)
+        self.november_small.add_lecturer(self.bob)
+        self.february.add_lecturer(self.cat)
+
+    def post(self, text='', **files):
+        return self.client.post(reverse('bulk_update_enrollments'), {'enrollments': text, **files})
+
+    def enrollments(self):
+        return dict(SubjectInstance.objects.values_list('instance_id', 'enrollments'))
+
+    def test_only_changed_instances_above_the_threshold_are_recomputed(self):
+        with mock.patch.object(LecturerWorkload.objects, 'recompute', wraps=LecturerWorkload.objects.recompute) as recompute:
+            response = self.post(
+                f'instance_id,enrollments\n{self.november.instance_id},60\n'
+                f'{self.november_small.instance_id},8\n{self.february.instance_id},50'
+            )
+        self.assertEqual(response['Hx-Trigger'], 'instanceListChanged')
+        self.assertContains(response, 'Updated enrollments for 2 subject instance(s) and recalculated 1 lecturer workload(s).')
+        recompute.assert_called_once_with(keys={(self.ann.user_id, 11, 2024)})
+        enrollments = self.enrollments()
+        self.assertEqual(enrollments[self.november.instance_id], 60)
+        self.assertEqual(enrollments[self.november_small.instance_id], 8)
+        self.assertWorkloadsCorrect()
+
+    def test_uploaded_csv_files_are_read(self):
+        upload = SimpleUploadedFile('enrollments.csv', f'\ufeff{self.february.instance_id},120\n'.encode('utf-8'))
+        response = self.post(file=upload)
+        self.assertContains(response, 'recalculated 1 lecturer workload(s)')
+        self.assertEqual(self.enrollments()[self.february.instance_id], 120)
+        self.assertWorkloadsCorrect()
+
+    def test_invalid_lines_reject_the_whole_batch(self):
+        before = self.enrollments()
+        for text, error in [
+            (f'{self.november.instance_id},-1', 'Line 1: enrollments cannot be negative.'),
+            (f'{self.november.instance_id},40\n{self.november.instance_id},50', f'Line 2: instance {self.november.instance_id} is listed more than once.'),
+            (f'{self.november.instance_id},40\n0,50', 'Unknown subject instance(s): 0.'),
+            (f'{self.november.instance_id},40\n{self.february.instance_id},lots', 'Line 2: instance id and enrollments must be whole numbers.'),
+            (f'{self.november.instance_id},40,1', 'Line 1: expected instance_id,enrollments.'),
+            ('', 'Paste or upload at least one instance_id,enrollments line.'),
+        ]:
+            with self.subTest(text=text):
+                response = self.post(text)
+                self.assertNotIn('Hx-Trigger', response)
+                self.assertIn(error, str(response.context['form'].errors))
+        self.assertEqual(self.enrollments(), before)
@@ -14,8 +14,11 @@ from . import views
 urlpatterns = [
     path('subject_instances/', views.subject_instances, name='subject_instances'),
     path('instance_list/', views.instance_list, name='instance_list'),
+    path('instance_row/<int:instance_id>/', views.instance_row, name='instance_row'),
     path('add_subject_instance/', views.add_subject_instance,
          name='add_subject_instance'),
+    path('bulk_update_enrollments/', views.bulk_update_enrollments,
+         name='bulk_update_enrollments'),
     path('edit_subject_instance/<int:instance_id>',
          views.edit_subject_instance, name='edit_subject_instance'),
     path('assign_lecturer_instance/', views.assign_lecturer_instance,
@@ -31,6 +34,10 @@ urlpatterns = [
          name='remove_lecturer_instance'),
     path('instance_calendar/', views.instance_calendar,
          name='instance_calendar'),
+    path('instance_calendar_row/<int:instance_id>/', views.instance_calendar_row,
+         name='instance_calendar_row'),
+    path('batch_assign_lecturers/', views.batch_assign_lecturers,
+         name='batch_assign_lecturers'),
     path('assign_roster/', views.assign_roster, name='assign_roster'),
     path('overloaded_lecturers/', views.overloaded_lecturers, name='overloaded_lecturers'),  
 ]
@@ -8,17 +8,25 @@
 # File: views.py
 # Author: Jacob Paff
 
+from collections import namedtuple
 from datetime import timedelta
 from django.shortcuts import render, get_object_or_404
-from core.models import LecturerWorkload, SubjectInstance, Subject, SubjectInstanceLecturer, UserProfile, WorkloadManager, LecturerExpertise
-from .forms import SubjectInstanceForm
-from django.http import HttpResponse
+from core.caching import get_or_rebuild, instance_versions, workload_version
+from core.models import LecturerWorkload, SubjectInstance, Subject, SubjectInstanceLecturer, UserProfile, WorkloadManager, LecturerExpertise, workload_queue
+from .forms import BulkEnrollmentForm, SubjectInstanceForm
+from .assignments import AssignmentBatchError, apply_assignment_batch
+from .roster_solver import assign_unstaffed_instances
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import require_POST
 from django.urls import reverse
-from django.db.models import Q
+from django.utils.http import urlencode
+from django.db.models import Case, Count, Exists, F, FloatField, Max, Min, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
 from django.contrib.auth.decorators import user_passes_test
 from django.core.cache import cache
 from datetime import timedelta
 import datetime
+import json
 
 # Utility function to check if the user is a Manager or Testing role
 
@@ -40,7 +48,7 @@ def filter_subject_instances_by_month(subject_instances, selected_month=''):
     # Apply the month filter if provided
     year, month = map(int, selected_month.split('-'))
     start_date = datetime.date(year, month, 1)
-    end_date = start_date + timedelta(weeks=12) - timedelta(days=2)
+    end_date = start_date + SubjectInstance.DURATION
 
     subject_instances = subject_instances.filter(
         start_date__gte=start_date,
@@ -50,17 +58,131 @@ def filter_subject_instances_by_month(subject_instances, selected_month=''):
 
 def filter_subject_instances_by_search(subject_instances, query=''):
     """
-    Helper function to filter subject instances by search query
+    Helper function to filter subject instances by search query.
+    Every word of the query must appear in the instance's search document (subject id, subject name and
+    lecturer names), which on Postgres is served by a trigram index instead of joining subjects and lecturers.
     """
-    subject_instances = subject_instances.filter(
-        Q(subject__subject_name__icontains=query) |
-        Q(subject__subject_id__icontains=query) |
-        Q(subjectinstancelecturer__user__first_name__icontains=query) |
-        Q(subjectinstancelecturer__user__last_name__icontains=query)
-    ).distinct()
+    for term in query.lower().split():
+        subject_instances = subject_instances.filter(search_document__contains=term)
     return subject_instances
 
 
+# Number of subject instances rendered per page of the instance list and calendar
+INSTANCE_PAGE_SIZE = 50
+
+
+def paginate_subject_instances(subject_instances, request, url_name, page_size=INSTANCE_PAGE_SIZE):
+    """
+    Helper function to return one page of subject instances using keyset pagination on (start_date, instance_id).
+
+    The position is read from the 'after' GET parameter, written as '<start_date>.<instance_id>' (with '-' for a
+    missing start date). Instances without a start date are listed last.
+
+    Returns:
+        tuple: (list of subject instances on this page, url of the next page or None)
+    """
+    after = request.GET.get('after', '')
+    if after:
+        after_date, _, after_id = after.partition('.')
+        try:
+            after_id = int(after_id)
+            after_date = None if after_date == '-' else datetime.date.fromisoformat(after_date)
+        except ValueError:
+            after_id = None
+        if after_id is not None and after_date is None:
+            subject_instances = subject_instances.filter(start_date__isnull=True, instance_id__gt=after_id)
+        elif after_id is not None:
+            subject_instances = subject_instances.filter(
+                Q(start_date__gt=after_date) |
+                Q(start_date=after_date, instance_id__gt=after_id) |
+                Q(start_date__isnull=True)
+            )
+
+    subject_instances = subject_instances.order_by(F('start_date').asc(nulls_last=True), 'instance_id')
+    page = list(subject_instances[:page_size + 1])
+    if len(page) <= page_size:
+        return page, None
+
+    page = page[:page_size]
+    last = page[-1]
+    cursor = f"{last.start_date.isoformat() if last.start_date else '-'}.{last.instance_id}"
+    params = {key: request.GET[key] for key in ('search', 'month') if request.GET.get(key)}
+    params['after'] = cursor
+    return page, f'{reverse(url_name)}?{urlencode(params)}'
+
+
+# A single cell of a calendar row, either a blank month or the span of months an instance runs for
+CalendarCell = namedtuple('CalendarCell', ['colspan', 'is_span'])
+BLANK_CELL = CalendarCell(1, False)
+
+
+def build_calendar_cells(start_date, end_date, years):
+    """
+    Helper function to lay out one calendar row covering 12 months for each of the consecutive years in years.
+
+    The row is returned as ready-made cells: a blank cell for every month before the instance starts, one span
+    cell whose colspan covers every month from start_date to end_date (including spans that run into the next
+    year), and a blank cell for every month after it ends. Months outside the calendar are clipped.
+    """
+    columns = 12 * len(years)
+    if not columns:
+        return []
+    first_year = years[0]
+    start = max((start_date.year - first_year) * 12 + start_date.month - 1, 0)
+    end = min((end_date.year - first_year) * 12 + end_date.month - 1, columns - 1)
+    if start > end:
+        return [BLANK_CELL] * columns
+    return [BLANK_CELL] * start + [CalendarCell(end - start + 1, True)] + [BLANK_CELL] * (columns - end - 1)
+
+
+def prepare_calendar_rows(subject_instances, years):
+    """
+    Helper function to set the cache version, calendar cells and overload flag on every subject instance of a
+    calendar page. The instances need a start date and their lecturers prefetched.
+    """
+    # Look up the overload flag of every (lecturer, month, year) shown in one query
+    overloaded_keys = LecturerWorkload.objects.overloaded_keys(
+        (lecturer.user_id, subject_instance.start_date.month, subject_instance.start_date.year)
+        for subject_instance in subject_instances
+        for lecturer in subject_instance.lecturer.all()
+    )
+    versions = instance_versions(subject_instance.instance_id for subject_instance in subject_instances)
+    for subject_instance in subject_instances:
+        subject_instance.cache_version = versions[subject_instance.instance_id]
+        subject_instance.cells = build_calendar_cells(subject_instance.start_date, subject_instance.end_date, years)
+        subject_instance.is_lecturer_overloaded = any(
+            (lecturer.user_id, subject_instance.start_date.month, subject_instance.start_date.year) in overloaded_keys
+            for lecturer in subject_instance.lecturer.all()
+        )
+
+
+def instance_rows_response(request, subject_instance=None, deleted_id=None, created=False, calendar_row=False, triggers='',
+                           workload_ticket=None):
+    """
+    Helper function to answer a mutation with just the rows it changed instead of making the page refetch the
+    whole list. The changed instance's list row (and its calendar row if calendar_row is set), a new row for a
+    created instance or delete markers for a removed instance's list and calendar rows are returned as
+    hx-swap-oob fragments, and the modal that sent the request is closed without swapping anything into it. If
+    the mutation queued a workload recalculation, the workload status placeholder is swapped in to poll for its
+    ticket.
+    """
+    context = {'deleted_id': deleted_id, 'created': created, 'workload_ticket': workload_ticket}
+    if subject_instance is not None:
+        subject_instance = SubjectInstance.objects.select_related('subject').prefetch_related('lecturer').get(
+            pk=subject_instance.pk
+        )
+        if calendar_row and subject_instance.start_date:
+            years, _ = all_instances_info()
+            prepare_calendar_rows([subject_instance], years)
+            context['years'] = years
+            context['calendar_row'] = True
+        context['subject_instance'] = subject_instance
+    response = render(request, 'instance_rows_oob.html', context)
+    response['HX-Reswap'] = 'none'
+    response['Hx-Trigger'] = ', '.join(filter(None, ['closeModal', triggers]))
+    return response
+
+
 
 @user_passes_test(is_manager, login_url='login_redirect')
 def instance_list(request):
@@ -76,7 +198,28 @@ def instance_list(request):
     if selected_month:
         subject_instances = filter_subject_instances_by_month(subject_instances, selected_month)
 
-    return render(request, 'instance_list.html', {'subject_instances': subject_instances})
+    # Only render one page, the last row loads the next page when it is scrolled into view
+    subject_instances, next_page_url = paginate_subject_instances(
+        subject_instances.select_related('subject').prefetch_related('lecturer'), request, 'instance_list'
+    )
+
+    return render(request, 'instance_list.html', {
+        'subject_instances': subject_instances,
+        'next_page_url': next_page_url,
+    })
+
+
+# View to render a single subject instance row, fetched by the row when the change stream reports a change to it
+
+
+@user_passes_test(is_manager, login_url='login_redirect')
+def instance_row(request, instance_id):
+    subject_instance = SubjectInstance.objects.select_related('subject').prefetch_related('lecturer').filter(
+        instance_id=instance_id).first()
+    if subject_instance is None:
+        # The instance was deleted, swapping in an empty response removes the row
+        return HttpResponse()
+    return render(request, 'instance_row.html', {'instance': subject_instance})
 
 
 # View to add a new subject instance
@@ -87,9 +230,9 @@ def add_subject_instance(request):
     if request.method == "POST":
         form = SubjectInstanceForm(request.POST)
         if form.is_valid():
-            form.save()
-            # no content
-            return HttpResponse(status=204, headers={'Hx-Trigger': 'instanceListChanged'})
+            subject_instance = form.save()
+            # Add the new row to the top of the list
+            return instance_rows_response(request, subject_instance, created=True)
     else:
         form = SubjectInstanceForm()
     form_string = 'Create Subject Instance'
@@ -103,7 +246,7 @@ def edit_subject_instance(request, instance_id):
     """
     View to edit an existing subject instance. This view handles the request to edit a subject instance.
     If the request is a POST, it will validate the form data and save the subject instance. If the enrollments
-    have changed, it will call the update_lecturer_workload method to update the workloads for associated lecturers.
+    or start date have changed, the workloads for associated lecturers are queued for background recalculation.
     If the request is not a POST, it will render a form with the current subject instance data.
 
     Args:
@@ -111,35 +254,60 @@ def edit_subject_instance(request, instance_id):
         instance_id (int): The id of the subject instance to edit
 
     Returns:
-        HttpResponse: A response with the updated html or a 204 status code with headers to trigger the
-            hx-socket to update the subject instance list and/or the overloaded lecturers list.
+        HttpResponse: The form with errors, or the updated row as an out-of-band swap together with a poller
+            for the workload recalculation if one was queued.
     """
     subject_instance = get_object_or_404(
         SubjectInstance, instance_id=instance_id)
     if request.method == "POST":
+        # Get the current enrollment count and workload keys before the form updates the instance
+        current_enrollments = subject_instance.enrollments or 0  # Default to 0 if None
+        current_start_date = subject_instance.start_date
+        current_workload_keys = subject_instance.workload_keys()
         form = SubjectInstanceForm(request.POST, instance=subject_instance)
         if form.is_valid():
-            # ensure html is updated
-            triggers = 'instanceListChanged'
+            workload_ticket = None
             # Get the student threshold
             student_threshold = WorkloadManager.STUDENT_THRESHOLD
-            # Get the current enrollment count before saving the form
-            current_enrollments = subject_instance.enrollments or 0  # Default to 0 if None
             # Save the form to update the SubjectInstance
             form.save()
             # Get the updated enrollment count from the form data
-            new_enrollments = form.cleaned_data.get('enrollments', 0)
-            # Check if enrollments have changed and call update workload
-            if current_enrollments > student_threshold or new_enrollments > student_threshold:
-                if subject_instance.update_lecturer_workload():
-                    triggers += ', overloadedLecturers'
-            return HttpResponse(status=204, headers={'Hx-Trigger': triggers})
+            new_enrollments = form.cleaned_data.get('enrollments', 0) or 0
+            # Queue a workload recalculation if the enrollments or the start date changed the workload
+            if (current_enrollments > student_threshold or new_enrollments > student_threshold
+                    or current_start_date != subject_instance.start_date):
+                workload_ticket = workload_queue.enqueue(current_workload_keys | subject_instance.workload_keys())
+            # Swap in the updated row
+            return instance_rows_response(request, subject_instance, workload_ticket=workload_ticket)
     else:
         form = SubjectInstanceForm(instance=subject_instance)
     form_string = 'Edit Subject Instance'
     return render(request, 'modals/form_modal.html', {'form': form, 'form_string': form_string})
 
 
+# View to update the enrollments of many subject instances at once
+
+
+@user_passes_test(is_manager, login_url='login_redirect')
+def bulk_update_enrollments(request):
+    """
+    View to paste or upload enrollment figures for many subject instances. The changes are applied with one
+    bulk update and every affected lecturer-month is recomputed once.
+    """
+    if request.method == "POST":
+        form = BulkEnrollmentForm(request.POST, request.FILES)
+        if form.is_valid():
+            updated, recomputed = SubjectInstance.objects.bulk_update_enrollments(form.cleaned_data['pairs'])
+            message = f'Updated enrollments for {updated} subject instance(s) and recalculated {recomputed} lecturer workload(s).'
+            response = render(request, 'modals/message_modal.html', {'title': 'Enrollments Updated', 'message': message})
+            response['Hx-Trigger'] = 'instanceListChanged'
+            return response
+    else:
+        form = BulkEnrollmentForm()
+    form_string = 'Bulk Update Enrollments'
+    return render(request, 'modals/form_modal.html', {'form': form, 'form_string': form_string})
+
+
 # View to confirm the deletion of a subject instance
 @user_passes_test(is_manager, login_url='login_redirect')
 def confirm_delete_instance(request, instance_id):
@@ -162,9 +330,9 @@ def delete_instance(request, instance_id):
     subject_instance = get_object_or_404(
         SubjectInstance, instance_id=instance_id)
     # ensure workload is recalculated on delete
-    subject_instance.delete_and_update_workload()
-    # No content response
-    return HttpResponse(status=204, headers={'Hx-Trigger': 'instanceListChanged'})
+    workload_ticket = subject_instance.delete_and_update_workload(defer=True)
+    # Remove the row from the list
+    return instance_rows_response(request, deleted_id=instance_id, workload_ticket=workload_ticket)
 
 # View to render the modal for assigning lecturers to a subject instance
 
@@ -183,69 +351,41 @@ def lecturer_list(request):
     instance_id = request.GET.get('instance_id')
 
     # Get the subject instance
-    subject_instance = SubjectInstance.objects.get(pk=instance_id)
-    start_month = subject_instance.start_date.month
-    year = subject_instance.start_date.year
-
-    # Get lecturers assigned to the subject instance
-    assigned_lecturers = UserProfile.objects.filter(
-        subjectinstancelecturer__subject_instance=instance_id
-    )
-
-    # Get lecturers who have expertise in the subject of this instance
-    expertised_lecturers = UserProfile.objects.filter(
-        lecturerexpertise__subject=subject_instance.subject
+    subject_instance = get_object_or_404(SubjectInstance, pk=instance_id)
+
+    # Workload rows for the months the instance is active, wrapping into the next year if needed
+    window_filter = Q()
+    for month, year in subject_instance.active_months():
+        window_filter |= Q(workloads__month=month, workloads__year=year)
+
+    # Get lecturers who have expertise in the subject of this instance, annotated with their
+    # highest workload over the instance window, whether they are assigned and their expertise count
+    lecturer_list = UserProfile.objects.filter(
+        lecturerexpertise__subject_id=subject_instance.subject_id
+    ).annotate(
+        max_workload_value=Coalesce(Max('workloads__workload_value', filter=window_filter), Value(0.0)),
+        max_workload_percent=Case(
+            When(fte_percentage__gt=0, then=F('max_workload_value') * 100 / (F('fte_percentage') * WorkloadManager.FULL_TIME_UNITS)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        ),
+        is_assigned=Exists(SubjectInstanceLecturer.objects.filter(subject_instance=subject_instance, user=OuterRef('pk'))),
+        expertise_count=Subquery(
+            LecturerExpertise.objects.filter(user=OuterRef('pk')).order_by().values('user').annotate(count=Count('pk')).values('count')
+        ),
     )
 
-    # Combine both filters: lecturers with expertise and assigned to the subject instance
-    lecturer_list = expertised_lecturers
-
     # Apply the search query to filter by first or last name
     if query:
         lecturer_list = lecturer_list.filter(
             Q(first_name__icontains=query) | Q(last_name__icontains=query)
         )
 
-    # Create a list to store lecturers with their metadata for sorting
-    lecturer_data = []
-
-    # For each lecturer, find the maximum workload for the 3 months the instance is active
-    for lecturer in lecturer_list:
-        workload_percentages = [
-            lecturer.workload_percentage_for_month(start_month, year),
-            lecturer.workload_percentage_for_month(start_month + 1, year),
-            lecturer.workload_percentage_for_month(start_month + 2, year)
-        ]
-
-        # Add max workload percentage to the lecturer object
-        lecturer.max_workload_percent = max(workload_percentages)
-
-        # Check if the lecturer is assigned to the instance
-        is_assigned = assigned_lecturers.filter(pk=lecturer.pk).exists()
-
-        # Count how many subjects this lecturer has expertise in
-        expertise_count = LecturerExpertise.objects.filter(
-            user=lecturer).count()
-
-        # Store the lecturer and sorting info
-        lecturer_data.append({
-            'lecturer': lecturer,
-            'is_assigned': is_assigned,
-            'max_workload_percent': lecturer.max_workload_percent,
-            'expertise_count': expertise_count,
-        })
-
     # Sort the lecturers first by assigned (True first), then by max_workload_percent, then by expertise_count
-    sorted_lecturers = sorted(
-        lecturer_data,
-        key=lambda x: (not x['is_assigned'], -
-                       x['max_workload_percent'], -x['expertise_count'])
-    )
+    lecturer_list = lecturer_list.order_by('-is_assigned', '-max_workload_percent', '-expertise_count', 'user_id')
 
-    # Pass only the sorted lecturers back to the template
     return render(request, 'lecturer_list.html', {
-        'lecturer_list': [item['lecturer'] for item in sorted_lecturers],
-        'assigned_lecturers': assigned_lecturers,
+        'lecturer_list': lecturer_list,
         'instance_id': instance_id,
     })
 
@@ -259,12 +399,12 @@ def add_lecturer_instance(request):
         SubjectInstance, instance_id=instance_id)
     lecturer_id = request.GET.get('lecturer_id')
     lecturer = get_object_or_404(UserProfile, user_id=lecturer_id)
-    # ensure html is updated
-    triggers = 'instanceListChanged'
-    # Add the lecturer to the subject instance lecturer and upates workload
+    # Add the lecturer to the subject instance lecturer, which applies the workload delta
+    triggers = ''
     if subject_instance.add_lecturer(lecturer):
-        triggers += ', overloadedLecturers'
-    return HttpResponse(status=204, headers={'Hx-Trigger': triggers})
+        triggers = 'overloadedLecturers'
+    # Swap in the instance's updated list or calendar row, whichever page the modal was opened from
+    return instance_rows_response(request, subject_instance, calendar_row=True, triggers=triggers)
 
 # View to remove a lecturer from a subject instance
 
@@ -276,28 +416,84 @@ def remove_lecturer_instance(request):
         SubjectInstance, instance_id=instance_id)
     lecturer_id = request.GET.get('lecturer_id')
     lecturer = get_object_or_404(UserProfile, user_id=lecturer_id)
-    # ensure html is updated
-    triggers = 'instanceListChanged'
-    # Remove the lecturer from the subject instance lecturer
+    # Remove the lecturer from the subject instance lecturer, which applies the workload delta
+    triggers = ''
     if subject_instance.remove_lecturer(lecturer):
-        triggers += ', overloadedLecturers'
-    return HttpResponse(status=204, headers={'Hx-Trigger': triggers})
+        triggers = 'overloadedLecturers'
+    # Swap in the instance's updated list or calendar row, whichever page the modal was opened from
+    return instance_rows_response(request, subject_instance, calendar_row=True, triggers=triggers)
 
 
-# View to assign a roster to subject instances
+# View to apply a batch of lecturer assignment changes in one transaction
+
+
+@user_passes_test(is_manager, login_url='login_redirect')
+@require_POST
+def batch_assign_lecturers(request):
+    """
+    JSON endpoint that applies many lecturer add/remove operations at once.
+
+    Expects a body of {"operations": [{"op": "add" | "remove", "instance_id": ..., "user_id": ...}, ...]}.
+    Either every operation is applied, followed by one workload recompute, or none are.
+
+    Returns:
+        JsonResponse: The number of assignments added and removed and the recomputed workloads and overload
+            flag of each affected lecturer, or a 400 response listing the errors.
+    """
+    try:
+        operations = json.loads(request.body).get('operations')
+    except (ValueError, AttributeError):
+        return JsonResponse({'errors': ['The request body must be a JSON object.']}, status=400)
+    try:
+        result = apply_assignment_batch(operations)
+    except AssignmentBatchError as error:
+        return JsonResponse({'errors': error.errors}, status=400)
+    response = JsonResponse(result)
+    response['Hx-Trigger'] = 'instanceListChanged'
+    return response
+
+
+# View to assign a roster to subject instances, automatically staffing unassigned instances on POST
 
 
 @user_passes_test(is_manager, login_url='login_redirect')
 def assign_roster(request):
+    if request.method == "POST":
+        selected_month = request.POST.get('month', '')  # Restrict to the term starting in this month (YYYY-MM)
+        subject_instances = SubjectInstance.objects.all()
+        if selected_month:
+            subject_instances = filter_subject_instances_by_month(subject_instances, selected_month)
+        assignments, unassigned = assign_unstaffed_instances(subject_instances)
+        message = f'Assigned lecturers to {len(assignments)} unstaffed subject instance(s).'
+        if unassigned:
+            message += f' {len(unassigned)} instance(s) could not be staffed without overloading a lecturer with matching expertise.'
+        response = render(request, 'modals/message_modal.html', {'title': 'Roster Assigned', 'message': message})
+        response['Hx-Trigger'] = 'instanceListChanged'
+        return response
     return render(request, 'assign_roster.html')
 
 
+# View to render a single calendar row, fetched by the row when the change stream reports a change to the instance
+# or to the overload flag of one of its lecturers
+
+
+@user_passes_test(is_manager, login_url='login_redirect')
+def instance_calendar_row(request, instance_id):
+    subject_instance = SubjectInstance.objects.select_related('subject').prefetch_related('lecturer').filter(
+        instance_id=instance_id, start_date__isnull=False).first()
+    if subject_instance is None:
+        return HttpResponse()
+    years, _ = all_instances_info()
+    prepare_calendar_rows([subject_instance], years)
+    return render(request, 'instance_calendar_row.html', {'subject_instance': subject_instance, 'years': years})
+
+
 @user_passes_test(is_manager, login_url='login_redirect')
 def instance_calendar(request):
-    print('calendar', request.GET.get) 
     query = request.GET.get('search', '')
     selected_month = request.GET.get('month', '')  # Get the selected month (YYYY-MM format)
-    subject_instances = SubjectInstance.objects.all()
+    subject_instances = SubjectInstance.objects.filter(
+        start_date__isnull=False).select_related('subject').prefetch_related('lecturer')
     # Filter by query if provided
     if query:
         subject_instances = filter_subject_instances_by_search(subject_instances, query)
@@ -305,25 +501,25 @@ def instance_calendar(request):
     # Filter by the selected month and the next two months
     if selected_month:
         subject_instances = filter_subject_instances_by_month(subject_instances, selected_month)
-    
-    years, months, _ = all_instances_info()
 
-    # Check if any lecturer in the filtered instances is overloaded
-    for subject_instance in subject_instances:
-        subject_instance.is_lecturer_overloaded = LecturerWorkload.objects.filter(
-            user_profile__in=subject_instance.lecturer.all(),
-            month=subject_instance.start_date.month,
-            year=subject_instance.start_date.year,
-            is_overloaded=True
-        ).exists()
-    
+    years, months = all_instances_info()
+
+    # Only render one page, the last row loads the next page when it is scrolled into view
+    subject_instances, next_page_url = paginate_subject_instances(subject_instances, request, 'instance_calendar')
+
+    prepare_calendar_rows(subject_instances, years)
+
     context = {
         'years': years,
         'months': months,
         'subject_instances_list': subject_instances,
+        'next_page_url': next_page_url,
+        'calendar_columns': 1 + 12 * len(years),
     }
-    
-    return render(request, 'instance_calendar.html', context)
+
+    # Later pages only append rows to the calendar body
+    template = 'instance_calendar_rows.html' if request.GET.get('after') else 'instance_calendar.html'
+    return render(request, template, context)
 
 
 
@@ -366,13 +562,6 @@ def instance_calendar(request):
 
 
 def all_instances_info():
-    # Check if the data is already cached for this user
-    # cached_data = cache.get('instance_data')
-    # if cached_data:
-    #     return cached_data
-
-    years = set()
-
     months = {
         1: 'Jan',
         2: 'Feb',
@@ -388,25 +577,14 @@ def all_instances_info():
         12: 'Dec'
     }
 
-    # Fetch all SubjectInstance objects
-    subject_instances = SubjectInstance.objects.select_related('subject').prefetch_related('lecturer').all()
-
-    # Add years and calculate end_month for each instance
-    for subject_instance in subject_instances:
-        start_date = subject_instance.start_date
-        end_date = start_date + timedelta(weeks=12) - timedelta(days=2)  # Calculate end date (3 months)
-        subject_instance.end_month = end_date.month  # Add end_month attribute to each instance
-
-        years.add(start_date.year)
-        if end_date.year > start_date.year:
-            years.add(end_date.year)
-
-    years = sorted(list(years))
-
-    # Cache the result for this user for 10 minutes
-    # cache.set('instance_data', (years, months, subject_instances), 600)
+    # Get the range of years covered by all instances in one aggregate, including the year the last instance ends in
+    date_range = SubjectInstance.objects.aggregate(first_start=Min('start_date'), last_start=Max('start_date'))
+    if date_range['first_start'] is None:
+        return [], months
+    last_year = (date_range['last_start'] + SubjectInstance.DURATION).year
+    years = list(range(date_range['first_start'].year, last_year + 1))
 
-    return years, months, subject_instances
+    return years, months
 
 # def all_instances_info():
 #     # Check if the data is already cached for this user
@@ -469,46 +647,54 @@ def all_instances_info():
 
 
 def get_overloaded_lecturers_and_instances():
+    """
+    Helper function to build the overloaded lecturers report in two queries: one for the overloaded
+    workloads with their lecturers and one for the instances those lecturers teach in the same years.
+    The report is cached until the next workload change bumps the workload version, and only one request
+    rebuilds it at a time while the others get the previous report.
+
+    Returns:
+        dict: {lecturer: {'month/year': {'workload_percentage': ..., 'subject_instances': [...]}}}
+    """
+    return get_or_rebuild('overloaded_lecturers', workload_version(), build_overloaded_lecturers_report, 3600)
+
+
+def build_overloaded_lecturers_report():
+    """
+    Helper function to build the overloaded lecturers report returned by get_overloaded_lecturers_and_instances.
+    """
     # Filter for overloaded workloads directly using the is_overloaded boolean
-    overloaded_workloads = LecturerWorkload.objects.filter(is_overloaded=True)
-    lecturer_workload_dict = {}
+    overloaded_workloads = list(LecturerWorkload.objects.filter(is_overloaded=True).select_related('user_profile').order_by('user_profile_id', 'year', 'month'))
+
+    # Group the instances of the overloaded lecturers by (lecturer, month, year)
+    overloaded_keys = {(workload.user_profile_id, workload.month, workload.year) for workload in overloaded_workloads}
+    subject_instances = {}
+    for assignment in SubjectInstanceLecturer.objects.filter(
+        user_id__in={user_id for user_id, _, _ in overloaded_keys},
+        subject_instance__start_date__year__in={year for _, _, year in overloaded_keys},
+    ).select_related('subject_instance').order_by('subject_instance__start_date', 'subject_instance_id'):
+        start_date = assignment.subject_instance.start_date
+        key = (assignment.user_id, start_date.month, start_date.year)
+        if key in overloaded_keys:
+            subject_instances.setdefault(key, []).append(assignment.subject_instance)
 
+    lecturer_workload_dict = {}
     for workload in overloaded_workloads:
         lecturer = workload.user_profile
-        month = workload.month
-        year = workload.year
-        # Calculate workload percentage using the existing function
-        workload_percentage = lecturer.workload_percentage_for_month(month, year)
-        month_year_key = f'{month}/{year}'
-
-        print(f"Processing overloaded workload for {lecturer.first_name} {lecturer.last_name} in {month_year_key} with percentage: {workload_percentage}%")
-
-        # Initialize the lecturer's entry in the dictionary if it doesn't exist
-        if lecturer not in lecturer_workload_dict:
-            lecturer_workload_dict[lecturer] = {}
-
-        # Find all subject instances where the lecturer is assigned in the overloaded month/year
-        subject_instances = SubjectInstance.objects.filter(
-            subjectinstancelecturer__user=lecturer,
-            start_date__month=month,
-            start_date__year=year
-        )
-        print(f"Subject instances for {lecturer.first_name} in {month_year_key}: {subject_instances}")
+        max_workload = lecturer.calc_max_workload()
+        workload_percentage = round(workload.workload_value / max_workload * 100, 2) if max_workload > 0 else 0
 
         # Store both the workload_percentage and subject instances in a nested dictionary
-        lecturer_workload_dict[lecturer][month_year_key] = {
+        lecturer_workload_dict.setdefault(lecturer, {})[f'{workload.month}/{workload.year}'] = {
             'workload_percentage': workload_percentage,
-            'subject_instances': list(subject_instances)
+            'subject_instances': subject_instances.get((lecturer.user_id, workload.month, workload.year), []),
         }
 
-    print("Final lecturer workload dict:", lecturer_workload_dict)
     return lecturer_workload_dict
 
 
-
 def overloaded_lecturers(request):
     lecturer_workload_dict = get_overloaded_lecturers_and_instances()
-    print("overloaded_lecturers view:", lecturer_workload_dict)
     # Render the modal template, passing the lecturer workload dictionary
     return render(request, 'overloaded_lecturers.html', {
         'lecturer_workload_dict': lecturer_workload_dict
@@ -43,6 +43,19 @@
             }
         });
 
+        /**
+         * Close the default modal when a response answers with out-of-band row swaps instead of a 204
+         */
+        htmx.on('closeModal', () => {
+            const modalElement = document.getElementById('modal');
+            if (modalElement) {
+                const modal = bootstrap.Modal.getInstance(modalElement);
+                if (modal) {
+                    modal.hide();
+                }
+            }
+        });
+
         htmx.on('htmx:beforeSwap', (e) => {
             console.log('htmx:beforeSwap event triggered for target ID:', e.detail.target.id);
             // Hide the relevant modal before swapping content
@@ -18,6 +18,7 @@ urlpatterns = [
     path('set_expertise/<int:user_id>/', views.set_expertise, name='set_expertise'),
     path('add_user/', views.add_user, name='add_user'),
     path('user_list/', views.user_list, name='user_list'),
+    path('user_row/<int:user_id>/', views.user_row, name='user_row'),
     path('delete_user/<int:user_id>/', views.delete_user, name='delete_user'),
     path('message_modal/', views.message_modal, name='message_modal'),
     path('confirm_delete_user/<int:user_id>/', views.confirm_delete_user, name='confirm_delete_user'),
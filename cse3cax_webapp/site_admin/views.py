@@ -10,6 +10,9 @@
 # Revisions:
 #   - 17-09-24: Initial file created by Jacob Paff. Added views for user management, adding, and editing users.
 #   - 25-09-24: Added lecturer expertise form handling and user deletion confirmation modal.
+#   - 17-10-26: Answer user mutations with out-of-band row swaps instead of refetching the user list.
+#   - 17-10-26: Added user_row, refreshed by the change stream.
+#   - 17-10-26: Deleting a user swaps in a poller for the workload recalculation it queued.
 #
 
 from django.shortcuts import render, get_object_or_404
@@ -29,6 +32,15 @@ def user_management(request):
     roles = Role.objects.all()
     return render(request, 'user_management.html', {'roles': roles})
 
+# Helper to answer a mutation with just the changed user row, a new row or a delete marker as out-of-band swaps,
+# closing the modal that sent the request instead of making the page refetch the whole user list
+def user_rows_response(request, user=None, deleted_id=None, created=False, triggers='', workload_ticket=None):
+    context = {'user': user, 'deleted_id': deleted_id, 'created': created, 'workload_ticket': workload_ticket}
+    response = render(request, 'user_rows_oob.html', context)
+    response['HX-Reswap'] = 'none'
+    response['Hx-Trigger'] = ', '.join(filter(None, ['closeModal', triggers]))
+    return response
+
 # View to edit an existing user
 @user_passes_test(is_admin, login_url='login_redirect')
 def edit_user(request, user_id):
@@ -36,8 +48,7 @@ def edit_user(request, user_id):
     if request.method == "POST":
         form = UserProfileForm(request.POST, instance=user)
         if form.is_valid():
-            form.save()
-            return HttpResponse(status=204, headers={'Hx-Trigger': 'userListChanged'})
+            return user_rows_response(request, form.save())
     else:
         form = UserProfileForm(instance=user)
     form_string = f'Edit {user.first_name} {user.last_name}'
@@ -49,8 +60,7 @@ def add_user(request):
     if request.method == "POST":
         form = UserProfileForm(request.POST)
         if form.is_valid():
-            form.save()
-            return HttpResponse(status=204, headers={'Hx-Trigger': 'userListChanged'})
+            return user_rows_response(request, form.save(), created=True)
     else:
         form = UserProfileForm()
     form_string = 'Add User'
@@ -73,8 +83,8 @@ def confirm_delete_user(request, user_id):
 @user_passes_test(is_admin, login_url='login_redirect')
 def delete_user(request, user_id):
     user = get_object_or_404(UserProfile, user_id=user_id)
-    user.delete_user()  # Method handles workload recalculation
-    return HttpResponse(status=204, headers={'Hx-Trigger': 'userListChanged'})
+    workload_ticket = user.delete_user(defer=True)  # Method queues the workload recalculation
+    return user_rows_response(request, deleted_id=user_id, workload_ticket=workload_ticket)
 
 # View to list users, filtered by role if provided
 @user_passes_test(is_admin, login_url='login_redirect')
@@ -83,6 +93,15 @@ def user_list(request):
     users = UserProfile.objects.filter(role__role_id=role) if role else UserProfile.objects.all()
     return render(request, 'user_list.html', {'users': users})
 
+# View to render a single user row, fetched by the row when the change stream reports a change to the user
+@user_passes_test(is_admin, login_url='login_redirect')
+def user_row(request, user_id):
+    user = UserProfile.objects.filter(user_id=user_id).first()
+    if user is None:
+        # The user was deleted, swapping in an empty response removes the row
+        return HttpResponse()
+    return render(request, 'user_row.html', {'user': user})
+
 # View to render message modals for dynamic messaging
 def message_modal(request):
     title = request.GET.get('title', 'Message')
@@ -97,7 +116,8 @@ def set_expertise(request, user_id):
         form = LecturerExpertiseForm(request.POST, user=user)
         if form.is_valid():
             form.save()
-            return HttpResponse(status=204, headers={'Hx-Trigger': 'userListChanged'})
+            # Expertise is not shown in the user list, so there is no row to update
+            return HttpResponse(status=204)
     else:
         form = LecturerExpertiseForm(user=user)
     form_string = f'Set Lecturer Expertise for {user.first_name} {user.last_name}'